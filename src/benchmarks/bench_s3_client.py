@@ -0,0 +1,67 @@
+# =============================================================================
+#
+# measure per-file s3 upload overhead with a new boto3 client per file (the
+# old M2MTransfer.upload_file) against the shared S3Uploader
+#
+# usage (from src/):
+#   python benchmarks/bench_s3_client.py -n 50
+#   python benchmarks/bench_s3_client.py -n 50 --bucket <bucket> --key <prefix/>
+#
+# without --bucket only client construction is timed; with it, n small
+# objects are uploaded each way (and left under the prefix)
+#
+# imports======================================================================
+
+import argparse
+import os, sys
+import tempfile
+import time
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from m2m_s3 import S3Uploader
+
+# =============================================================================
+
+def per_file_client(files, bucket, key):
+    for file_name in files:
+        s3_client = boto3.client('s3')
+        s3_client.upload_file(file_name, bucket, key + os.path.basename(file_name))
+
+def shared_uploader(files, bucket, key):
+    uploader = S3Uploader()
+    for file_name in files:
+        uploader.upload_file(file_name, bucket, key + os.path.basename(file_name))
+    uploader.shutdown()
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def report(label, seconds, n):
+    print('{:<28} {:>9.3f} s total {:>9.2f} ms/file'.format(label, seconds, seconds * 1000 / n))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=50, help='number of files')
+    parser.add_argument('--size', type=int, default=1024, help='bytes per test file')
+    parser.add_argument('--bucket', help='bucket to upload test files to')
+    parser.add_argument('--key', default='m2m-bench/', help='key prefix for test files')
+    args = parser.parse_args()
+
+    print('client construction, {} files:'.format(args.n))
+    report('new client per file', timed(lambda: [boto3.client('s3') for i in range(args.n)]), args.n)
+    report('one shared client', timed(lambda: [boto3.client('s3')] * args.n), args.n)
+
+    if args.bucket:
+        with tempfile.TemporaryDirectory() as tmp:
+            files = []
+            for i in range(args.n):
+                files.append(os.path.join(tmp, 'bench_{:05d}.bin'.format(i)))
+                with open(files[-1], 'wb') as f:
+                    f.write(os.urandom(args.size))
+            print('\nupload of {} x {} byte files:'.format(args.n, args.size))
+            report('new client per file', timed(per_file_client, files, args.bucket, args.key), args.n)
+            report('shared S3Uploader', timed(shared_uploader, files, args.bucket, args.key), args.n)
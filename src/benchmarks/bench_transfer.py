@@ -0,0 +1,169 @@
+# =============================================================================
+#
+# end-to-end throughput of M2MTransfer against the local stand-in services
+# (benchmarks/m2m_standin.py): M2M api, DDS files and s3, all on localhost,
+# so performance changes can be checked without the live usgs service or aws
+#
+# usage (from src/):
+#   python benchmarks/bench_transfer.py --scenes 200 --size 20
+#   python benchmarks/bench_transfer.py --scenarios stream,async-stream --bandwidth 20 --staging-delay 2
+#   python benchmarks/bench_transfer.py --s3-endpoint http://127.0.0.1:9000 --bucket bench   (minio)
+#
+# the stand-in runs in its own process and every scenario runs in a fresh
+# process, so the cpu time and peak rss reported are the transfer's alone.
+# scenes/s and MB/s count what actually landed in s3
+#
+# imports======================================================================
+
+import argparse
+import contextlib
+import multiprocessing
+import os, sys
+import resource
+import tempfile
+import time
+import traceback
+import boto3
+from botocore.config import Config
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import m2m_standin
+
+# =============================================================================
+
+# transfer options per scenario, on top of the common ones built from the arguments
+SCENARIOS = {
+    'stream': {'stream_to_s3': True},
+    'stream-segments': {'stream_to_s3': True, 'segments': 4},
+    'staged': {'stream_to_s3': False},
+    'staged-segments': {'stream_to_s3': False, 'segments': 4},
+    'async-stream': {'stream_to_s3': True, 'use_async': True},
+    'async-staged': {'stream_to_s3': False, 'use_async': True},
+}
+
+def s3_client(endpoint):
+    return boto3.client('s3', endpoint_url=endpoint, config=Config(s3={'addressing_style': 'path'}))
+
+# objects and bytes under prefix
+def landed(endpoint, bucket, prefix):
+    count, size = 0, 0
+    for page in s3_client(endpoint).get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            count += 1
+            size += obj['Size']
+    return count, size
+
+def run_scenario(name, options, environment, results):
+    """
+    Run one transfer to completion; runs in its own process
+    :param options: M2MTransfer keyword arguments, plus use_async and concurrency
+    :param environment: environment variables the transfer reads (S3_*, M2M_*)
+    :param results: queue the (name, wall s, cpu s, peak rss bytes, error) result is put on
+    """
+    os.environ.update(environment)
+    options = dict(options)
+    use_async = options.pop('use_async', False)
+    concurrency = options.pop('concurrency')
+    verbose = options.pop('verbose')
+    error = None
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(sys.stdout if verbose else quiet):
+            if use_async:
+                from m2m_async import AsyncM2MTransfer
+                AsyncM2MTransfer(concurrency=concurrency, **options).run()
+            else:
+                from m2m_transfer import M2MTransfer
+                M2MTransfer(**options).run()
+    except Exception:
+        error = traceback.format_exc()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    # ru_maxrss is kilobytes on linux
+    results.put((name, wall, cpu, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, error))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', default='stream,staged,async-stream',
+                        help='comma separated, from: {}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--scenes', type=int, default=100)
+    parser.add_argument('--size', type=float, default=10, help='MB per file')
+    parser.add_argument('--page-size', type=int, default=100, help='scene-search results per page')
+    parser.add_argument('--staging-delay', type=float, default=0, help='seconds until a requested download is available')
+    parser.add_argument('--api-latency', type=float, default=0, help='seconds added to each api call')
+    parser.add_argument('--latency', type=float, default=0, help='seconds before each file response starts')
+    parser.add_argument('--bandwidth', type=float, default=None, help='MB/s per file connection')
+    parser.add_argument('--workers', type=int, default=4, help='download_workers for the threaded engine')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrency for the async engine')
+    parser.add_argument('--part-size', type=float, default=8, help='part_size in MB')
+    parser.add_argument('--s3-endpoint', help='use this s3-compatible store (e.g. minio) instead of the stand-in')
+    parser.add_argument('--bucket', default='bench')
+    parser.add_argument('--dir', default=None, help='staging directory (defaults to a temp directory)')
+    parser.add_argument('--verbose', action='store_true', help='show the transfer\'s own output')
+    args = parser.parse_args()
+    names = args.scenarios.split(',')
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+
+    ports = multiprocessing.Array('i', 2)
+    standin = multiprocessing.Process(target=m2m_standin.serve, args=({
+        'scenes': args.scenes, 'file_size': int(args.size * 1024 * 1024), 'page_size': args.page_size,
+        'staging_delay': args.staging_delay, 'api_latency': args.api_latency, 'dds_latency': args.latency,
+        'bandwidth': args.bandwidth * 1024 * 1024 if args.bandwidth else None}, ports), daemon=True)
+    standin.start()
+    while not ports[1]:
+        time.sleep(0.05)
+    service_url = 'http://127.0.0.1:{}/api/'.format(ports[0])
+    s3_endpoint = args.s3_endpoint or 'http://127.0.0.1:{}'.format(ports[1])
+
+    environment = {'S3_ENDPOINT_URL': s3_endpoint, 'S3_BUCKET': args.bucket, 'M2M_USER': 'bench', 'M2M_PASS': 'bench'}
+    if not args.s3_endpoint:
+        environment.update({'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench'})
+    environment.setdefault('AWS_DEFAULT_REGION', os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+    os.environ.update(environment)
+    if not args.s3_endpoint:
+        s3_client(s3_endpoint).create_bucket(Bucket=args.bucket)
+
+    print('{} scenes of {} MB, {} per page, staging delay {} s, file latency {} s, bandwidth {}'.format(
+        args.scenes, args.size, args.page_size, args.staging_delay, args.latency,
+        '{} MB/s per connection'.format(args.bandwidth) if args.bandwidth else 'unlimited'))
+    print('{:<18} {:>7} {:>9} {:>9} {:>9} {:>9} {:>11}'.format(
+        'scenario', 'scenes', 'wall s', 'cpu s', 'scenes/s', 'MB/s', 'peak RSS MB'))
+    results = multiprocessing.Queue()
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for name in names:
+            # every scenario gets its own label (so download-retrieve only lists its own
+            # downloads), staging directory and key prefix
+            prefix = 'bench/{}-{}/'.format(name, int(time.time()))
+            data_path = os.path.join(tmp, name) + '/'
+            options = dict({
+                'service_url': service_url,
+                'data_path': data_path,
+                'dataset_name': 'naip',
+                'label': 'bench {}'.format(prefix),
+                'spatial_filter': None,
+                'temporal_filter': None,
+                'acquisition_filter': None,
+                'part_size': int(args.part_size * 1024 * 1024),
+                'download_workers': args.workers,
+                'skip_existing': False,
+                'retrieve_min_wait': 0.5,
+                'retrieve_max_wait': 2,
+                'api_rate': None,
+                'concurrency': args.concurrency,
+                'verbose': args.verbose,
+                }, **SCENARIOS[name])
+            os.makedirs(data_path, exist_ok=True)
+            process = multiprocessing.Process(target=run_scenario, args=(
+                name, options, dict(environment, S3_KEY=prefix), results))
+            process.start()
+            name, wall, cpu, rss, error = results.get()
+            process.join()
+            if error:
+                print('{:<18} failed:\n{}'.format(name, error))
+                continue
+            count, size = landed(s3_endpoint, args.bucket, prefix)
+            print('{:<18} {:>7} {:>9.2f} {:>9.2f} {:>9.1f} {:>9.1f} {:>11.1f}'.format(
+                name, count, wall, cpu, count / wall, size / 1024 ** 2 / wall, rss / 1024 ** 2))
+    standin.terminate()
@@ -0,0 +1,127 @@
+# =============================================================================
+#
+# compare ways of writing a download to disk: small and large iter_content
+# chunks, response.content, shutil.copyfileobj and the RangedDownloader
+# readinto path (one stream, and parallel ranges into a preallocated file)
+#
+# usage (from src/):
+#   python benchmarks/bench_write_path.py --size 200
+#
+# the file is served from a local http server in a separate process, so the
+# cpu time reported is the client's alone
+#
+# imports======================================================================
+
+import argparse
+import multiprocessing
+import os, sys
+import shutil
+import tempfile
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from m2m_downloader import RangedDownloader
+from m2m_session import M2MSession
+
+# =============================================================================
+
+class FileHandler(BaseHTTPRequestHandler):
+    # serves the server's data with Range support, like dds.cr.usgs.gov
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = self.server.data
+        start, end = 0, len(data)
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            first, last = byte_range.split('=')[1].split('-')
+            start, end = int(first), int(last) + 1 if last else len(data)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Disposition', 'attachment; filename="bench.jp2"')
+        self.end_headers()
+        try:
+            self.wfile.write(memoryview(data)[start:end])
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(size, port):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    server.data = os.urandom(size)
+    port.value = server.server_address[1]
+    server.serve_forever()
+
+def iter_content(chunk_size):
+    def write(session, url, path):
+        with session.get(url, stream=True) as r, open(path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+    return write
+
+def content(session, url, path):
+    with session.get(url, stream=True) as r, open(path, 'wb') as f:
+        f.write(r.content)
+
+def copyfileobj(session, url, path):
+    with session.get(url, stream=True) as r, open(path, 'wb') as f:
+        shutil.copyfileobj(r.raw, f, 1024 * 1024)
+
+def readinto(buffer_size):
+    def write(session, url, path):
+        RangedDownloader(session, buffer_size=buffer_size).to_file(url, path)
+    return write
+
+def segmented(segments, size):
+    def write(session, url, path):
+        RangedDownloader(session).to_file_segmented(url, path, size, segments)
+    return write
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=200, help='MB per download')
+    parser.add_argument('--repeat', type=int, default=3, help='downloads per strategy; the best is reported')
+    parser.add_argument('--dir', default=None, help='directory to write to (defaults to a temp directory)')
+    args = parser.parse_args()
+    size = args.size * 1024 * 1024
+
+    port = multiprocessing.Value('i', 0)
+    server = multiprocessing.Process(target=serve, args=(size, port), daemon=True)
+    server.start()
+    while not port.value:
+        time.sleep(0.05)
+    url = 'http://127.0.0.1:{}/bench.jp2'.format(port.value)
+
+    strategies = [
+        ('iter_content 1 KB', iter_content(1024)),
+        ('iter_content 1 MB', iter_content(1024 * 1024)),
+        ('response.content', content),
+        ('copyfileobj 1 MB', copyfileobj),
+        ('readinto 1 MB', readinto(1024 * 1024)),
+        ('readinto 8 MB', readinto(8 * 1024 * 1024)),
+        ('4 ranges, preallocated', segmented(4, size)),
+    ]
+    session = M2MSession(pool_size=8)
+    print('{} MB download, best of {}:'.format(args.size, args.repeat))
+    print('{:<24} {:>9} {:>9} {:>9}'.format('strategy', 'wall s', 'cpu s', 'MB/s'))
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        path = os.path.join(tmp, 'bench.jp2')
+        for label, write in strategies:
+            best = None
+            for i in range(args.repeat):
+                if os.path.exists(path):
+                    os.remove(path)
+                wall, cpu = time.perf_counter(), time.process_time()
+                write(session, url, path)
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+                assert os.path.getsize(path) == size
+                if best is None or wall < best[0]:
+                    best = (wall, cpu)
+            print('{:<24} {:>9.3f} {:>9.3f} {:>9.1f}'.format(label, best[0], best[1], args.size / best[0]))
+    session.close()
+    server.terminate()
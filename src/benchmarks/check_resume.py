@@ -0,0 +1,133 @@
+# =============================================================================
+#
+# resume check against the local stand-in services (benchmarks/m2m_standin.py):
+# a run that dies after download-request has to be finished by the next run
+# with the same journal and label, even though the re-requested products come
+# back from download-request as duplicateProducts
+#
+# usage (from src/):
+#   python benchmarks/check_resume.py
+#   python benchmarks/check_resume.py --scenes 12 --page-size 4 --engines threaded
+#
+# three cases are checked for each engine:
+#   in-flight    the first page was finished (page_done) with its products
+#                left requested, so the rerun re-queues them before searching
+#   resume-page  the first page wasn't finished, so the rerun searches it
+#                again and requests its products a second time
+#   plan         a dry run wrote a plan, and a run transferring it (plan_path)
+#                died after requesting its first page
+# every product has to end up uploaded, in the journal and in s3
+#
+# imports======================================================================
+
+import argparse
+import contextlib
+import os, sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import m2m_standin
+from bench_transfer import s3_client, landed
+from m2m_journal import TransferJournal
+from m2m_transfer import M2MTransfer
+
+# =============================================================================
+
+def interrupted_run(options, page_done):
+    """
+    Search the first page (or take it from plan_path) and send its download-request, then
+    stop as if the run died
+    :param page_done: record the first page as finished in the journal
+    """
+    transfer = M2MTransfer(**options)
+    transfer.login()
+    try:
+        if transfer.plan_path:
+            page, downloads = transfer.plan_downloads()[0]
+            transfer.request_batch(downloads)
+        else:
+            transfer.dataset_searcher()
+            scenes, downloads = transfer.fetch_page(transfer.starting_num)
+            transfer.request_batch(downloads)
+            if page_done:
+                transfer.journal.page_done(transfer.starting_num, scenes['nextRecord'])
+        transfer.journal.close()
+    finally:
+        transfer.logout()
+
+def check(case, engine, options, scenes, s3_endpoint, bucket, verbose):
+    """
+    Interrupt a run, rerun it and check every product was uploaded
+    :return: error text, or None if the check passed
+    """
+    with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(sys.stdout if verbose else quiet):
+        if case == 'plan':
+            M2MTransfer(**options).plan(options['journal_path'] + '.plan.json')
+            options = dict(options, plan_path=options['journal_path'] + '.plan.json')
+        interrupted_run(options, page_done=case == 'in-flight')
+        if engine == 'async':
+            from m2m_async import AsyncM2MTransfer
+            AsyncM2MTransfer(concurrency=4, **options).run()
+        else:
+            M2MTransfer(**options).run()
+    journal = TransferJournal(options['journal_path'])
+    states = journal.summary()
+    journal.close()
+    count, size = landed(s3_endpoint, bucket, os.environ['S3_KEY'])
+    if states != {'uploaded': scenes} or count != scenes:
+        return 'journal states {}, {} of {} objects in s3'.format(states, count, scenes)
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenes', type=int, default=9)
+    parser.add_argument('--page-size', type=int, default=3, help='scene-search results per page')
+    parser.add_argument('--size', type=float, default=1, help='MB per file')
+    parser.add_argument('--staging-delay', type=float, default=0.5, help='seconds until a requested download is available')
+    parser.add_argument('--engines', default='threaded,async', help='comma separated, from: threaded, async')
+    parser.add_argument('--bucket', default='resume')
+    parser.add_argument('--verbose', action='store_true', help='show the transfers\' own output')
+    args = parser.parse_args()
+
+    standin, s3 = m2m_standin.start(scenes=args.scenes, page_size=args.page_size,
+                                    file_size=int(args.size * 1024 * 1024), staging_delay=args.staging_delay)
+    s3_endpoint = s3.url().rstrip('/')
+    os.environ.update({'S3_ENDPOINT_URL': s3_endpoint, 'S3_BUCKET': args.bucket, 'M2M_USER': 'check',
+                       'M2M_PASS': 'check', 'AWS_ACCESS_KEY_ID': 'check', 'AWS_SECRET_ACCESS_KEY': 'check'})
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    s3_client(s3_endpoint).create_bucket(Bucket=args.bucket)
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for engine in args.engines.split(','):
+            for case in ('in-flight', 'resume-page', 'plan'):
+                name = '{}-{}-{}'.format(engine, case, int(time.time()))
+                # every check gets its own label, journal and key prefix
+                os.environ['S3_KEY'] = 'resume/{}/'.format(name)
+                options = {
+                    'service_url': standin.url() + 'api/',
+                    'data_path': tmp + '/',
+                    'dataset_name': 'naip',
+                    'label': 'resume {}'.format(name),
+                    'spatial_filter': None,
+                    'temporal_filter': None,
+                    'acquisition_filter': None,
+                    'stream_to_s3': True,
+                    'skip_existing': False,
+                    'journal_path': os.path.join(tmp, name + '.db'),
+                    'retrieve_min_wait': 0.2,
+                    'retrieve_max_wait': 1,
+                    'retrieve_timeout': 60,
+                    'api_rate': None,
+                    'progress_interval': None,
+                    }
+                try:
+                    error = check(case, engine, options, args.scenes, s3_endpoint, args.bucket, args.verbose)
+                except Exception:
+                    error = traceback.format_exc()
+                print('{:<9} {:<12} {}'.format(engine, case, 'ok' if error is None else 'FAILED: ' + error))
+                failures += error is not None
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,509 @@
+# =============================================================================
+#
+# local stand-in for the services m2m_transfer.py talks to, for benchmarks
+# and offline testing:
+#
+#   - the M2M json api (login, dataset-search, scene-search with nextRecord
+#     paging, download-options, download-request, download-retrieve, logout);
+#     requested downloads only turn available after a staging delay
+#   - a DDS file server with Range support, per-request latency and a
+#     per-connection bandwidth cap
+#   - a minimal s3 api (path-style buckets, put, multipart, head, delete,
+#     tagging, list-objects-v2). object bodies are hashed for the ETag and
+#     thrown away, so any amount of data can be "uploaded" without disk
+#
+# usage (from src/):
+#   python benchmarks/m2m_standin.py --scenes 1000 --size 50 --staging-delay 5
+#
+# then point a transfer at it:
+#   service_url = "http://127.0.0.1:<api port>/api/"
+#   export S3_ENDPOINT_URL=http://127.0.0.1:<s3 port> S3_BUCKET=bench S3_KEY=test/
+#   export AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x AWS_DEFAULT_REGION=us-east-1
+#
+# imports======================================================================
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+# =============================================================================
+
+# served file bytes repeat this block, so files of any size cost no memory
+BLOCK = os.urandom(1024 * 1024)
+
+# area the scenes are spread over (texas), matching m2m_transfer.py's default spatial filter
+AREA = {'south': 25.0, 'west': -107.0, 'north': 37.0, 'east': -93.0}
+
+
+class StandinServer(ThreadingHTTPServer):
+    # the M2M api and the DDS file server, on one port
+    daemon_threads = True
+
+    def __init__(self, address, scenes=100, file_size=10 * 1024 * 1024, page_size=100, staging_delay=0,
+                 api_latency=0, dds_latency=0, bandwidth=None):
+        """
+        :param scenes: scenes the search area holds, each with one D441 product
+        :param file_size: bytes per product file
+        :param page_size: scene-search results per page when the request doesn't set maxResults
+        :param staging_delay: seconds from download-request until a download shows as available
+        :param api_latency: seconds added to every api response
+        :param dds_latency: seconds before the first byte of every file response
+        :param bandwidth: bytes/second cap per file connection; None is unlimited
+        """
+        ThreadingHTTPServer.__init__(self, address, StandinHandler)
+        self.scenes = scenes
+        self.file_size = file_size
+        self.page_size = page_size
+        self.staging_delay = staging_delay
+        self.api_latency = api_latency
+        self.dds_latency = dds_latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        # label -> {productId: download}, and downloadId -> download
+        self.labels = {}
+        self.downloads = {}
+        # calls per endpoint and bytes served, for reporting
+        self.calls = {}
+        self.bytes_served = 0
+
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address)
+
+    def entity_id(self, number):
+        return 'E{:07d}'.format(number)
+
+    def display_id(self, number):
+        return 'm_{:07d}'.format(number)
+
+    # scenes lie on a grid over AREA; scene number's (south, west, north, east) box
+    def scene_box(self, number):
+        side = max(int(self.scenes ** 0.5), 1)
+        rows = (self.scenes + side - 1) // side
+        height = (AREA['north'] - AREA['south']) / rows
+        width = (AREA['east'] - AREA['west']) / side
+        south = AREA['south'] + height * (number // side)
+        west = AREA['west'] + width * (number % side)
+        return south, west, south + height, west + width
+
+    def scene(self, number):
+        south, west, north, east = self.scene_box(number)
+        return {
+            'entityId': self.entity_id(number),
+            'displayId': self.display_id(number),
+            'spatialBounds': {'type': 'Polygon', 'coordinates': [[
+                [west, south], [east, south], [east, north], [west, north], [west, south]]]}
+            }
+
+    # scene numbers inside an mbr spatialFilter (by centroid), or all of them
+    def matching(self, spatial_filter):
+        if not spatial_filter or spatial_filter.get('filterType') != 'mbr':
+            return range(self.scenes)
+        lower, upper = spatial_filter['lowerLeft'], spatial_filter['upperRight']
+        numbers = []
+        for number in range(self.scenes):
+            south, west, north, east = self.scene_box(number)
+            latitude, longitude = (south + north) / 2, (west + east) / 2
+            if lower['latitude'] <= latitude <= upper['latitude'] and lower['longitude'] <= longitude <= upper['longitude']:
+                numbers.append(number)
+        return numbers
+
+    # the api's response data for endpoint, or raises ValueError for an unknown one
+    def api(self, endpoint, payload):
+        payload = payload or {}
+        if endpoint == 'login':
+            return uuid.uuid4().hex
+        if endpoint == 'logout':
+            return None
+        if endpoint == 'dataset-search':
+            return [{'datasetAlias': payload.get('datasetName'), 'collectionName': 'stand-in'}]
+        if endpoint == 'scene-search':
+            scene_filter = payload.get('sceneFilter') or {}
+            numbers = self.matching(scene_filter.get('spatialFilter'))
+            start = payload.get('startingNumber') or 1
+            page = numbers[start - 1:start - 1 + (payload.get('maxResults') or self.page_size)]
+            return {
+                'results': [self.scene(number) for number in page],
+                'recordsReturned': len(page),
+                'totalHits': len(numbers),
+                'startingNumber': start,
+                'nextRecord': start + len(page)
+                }
+        if endpoint == 'download-options':
+            return [self.product(entity_id) for entity_id in payload.get('entityIds') or []]
+        if endpoint == 'download-request':
+            return self.request(payload.get('label'), payload.get('downloads') or [])
+        if endpoint == 'download-retrieve':
+            return self.retrieve(payload.get('label'))
+        raise ValueError('unknown endpoint {}'.format(endpoint))
+
+    def product(self, entity_id):
+        number = int(entity_id[1:])
+        return {
+            'id': 'P' + entity_id,
+            'entityId': entity_id,
+            'displayId': self.display_id(number),
+            'productCode': 'D441',
+            'productName': 'Full Resolution',
+            'filesize': self.file_size,
+            'available': True,
+            'bulkAvailable': True,
+            'secondaryDownloads': []
+            }
+
+    def request(self, label, downloads):
+        available, preparing, duplicates = [], [], []
+        now = time.time()
+        with self.lock:
+            requested = self.labels.setdefault(label, {})
+            for item in downloads:
+                if item['productId'] in requested:
+                    duplicates.append(item['productId'])
+                    continue
+                download = dict(self.product(item['entityId']), downloadId=len(self.downloads) + 1,
+                                ready=now + self.staging_delay)
+                download['url'] = '{}dds/{}'.format(self.url(), download['downloadId'])
+                requested[item['productId']] = download
+                self.downloads[download['downloadId']] = download
+                record = {'downloadId': download['downloadId'], 'eulaCode': None, 'url': download['url']}
+                (preparing if self.staging_delay else available).append(record)
+        return {'availableDownloads': available, 'preparingDownloads': preparing,
+                'duplicateProducts': duplicates, 'failed': [], 'newRecords': [], 'numInvalidScenes': 0}
+
+    def retrieve(self, label):
+        available, requested = [], []
+        now = time.time()
+        with self.lock:
+            for download in self.labels.get(label, {}).values():
+                record = {
+                    'downloadId': download['downloadId'],
+                    'entityId': download['entityId'],
+                    'displayId': download['displayId'],
+                    'productCode': download['productCode'],
+                    'productName': download['productName'],
+                    'filesize': download['filesize'],
+                    'url': download['url']
+                    }
+                if download['ready'] <= now:
+                    available.append(dict(record, statusText='Available'))
+                else:
+                    requested.append(dict(record, statusText='Preparing'))
+        return {'available': available, 'requested': requested, 'eulas': [], 'queueSize': len(requested)}
+
+    def count(self, endpoint, served=0):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.bytes_served += served
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        if not path.startswith('/api/'):
+            return self.send_json(404, {'errorCode': 'NOT_FOUND', 'errorMessage': path, 'data': None})
+        endpoint = path.rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.server.api_latency:
+            time.sleep(self.server.api_latency)
+        self.server.count(endpoint)
+        try:
+            data = self.server.api(endpoint, json.loads(body) if body else None)
+        except ValueError as e:
+            return self.send_json(404, {'errorCode': 'UNKNOWN_ENDPOINT', 'errorMessage': str(e), 'data': None})
+        self.send_json(200, {'requestId': 1, 'version': 'stable', 'errorCode': None, 'errorMessage': None,
+                             'data': data})
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        download = None
+        if path.startswith('/dds/'):
+            download = self.server.downloads.get(int(path.rsplit('/', 1)[-1]))
+        if download is None:
+            return self.send_json(404, {'errorCode': 'NOT_FOUND', 'errorMessage': path, 'data': None})
+        size = download['filesize']
+        start, end = 0, size
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            first, last = byte_range.split('=')[1].split('-')
+            start, end = int(first), min(int(last) + 1 if last else size, size)
+        if self.server.dds_latency:
+            time.sleep(self.server.dds_latency)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if byte_range:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Disposition', 'attachment; filename="{}.jp2"'.format(download['displayId']))
+        self.end_headers()
+        try:
+            self.write_range(start, end)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.server.count('dds', end - start)
+
+    # write bytes start to end of a file, no faster than the server's bandwidth
+    def write_range(self, start, end):
+        began = time.perf_counter()
+        sent = 0
+        position = start
+        while position < end:
+            offset = position % len(BLOCK)
+            piece = memoryview(BLOCK)[offset:offset + min(end - position, len(BLOCK) - offset, 256 * 1024)]
+            self.wfile.write(piece)
+            position += len(piece)
+            sent += len(piece)
+            if self.server.bandwidth:
+                ahead = sent / self.server.bandwidth - (time.perf_counter() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def send_json(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class S3Server(ThreadingHTTPServer):
+    # a minimal path-style s3: enough for S3Uploader (put, multipart, head, delete, tagging, listing)
+    daemon_threads = True
+
+    def __init__(self, address):
+        ThreadingHTTPServer.__init__(self, address, S3Handler)
+        self.lock = threading.Lock()
+        # bucket -> {key: {'size', 'etag', 'tags'}}
+        self.buckets = {}
+        # upload id -> {part number: (size, md5 digest)}
+        self.uploads = {}
+        self.bytes_received = 0
+
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def store(self, bucket, key, size, etag):
+        with self.lock:
+            self.buckets.setdefault(bucket, {})[key] = {'size': size, 'etag': etag, 'tags': {}}
+            self.bytes_received += size
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def parse(self):
+        url = urlsplit(self.path)
+        bucket, _, key = unquote(url.path).lstrip('/').partition('/')
+        query = {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+        return bucket, key, query
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        if not key:
+            self.read_body()
+            with self.server.lock:
+                self.server.buckets.setdefault(bucket, {})
+            return self.send_xml(200, '')
+        if 'tagging' in query:
+            self.read_body()
+            return self.send_xml(200, '')
+        size, md5 = self.read_body()
+        etag = '"{}"'.format(md5.hexdigest())
+        if 'uploadId' in query:
+            with self.server.lock:
+                parts = self.server.uploads.get(query['uploadId'])
+                if parts is None:
+                    return self.send_error_xml(404, 'NoSuchUpload')
+                parts[int(query['partNumber'])] = (size, md5.digest())
+                self.server.bytes_received += size
+            return self.send_xml(200, '', {'ETag': etag})
+        self.server.store(bucket, key, size, etag)
+        self.send_xml(200, '', {'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        self.read_body()
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.uploads[upload_id] = {}
+            return self.send_xml(200, '<InitiateMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key>'
+                                      '<UploadId>{}</UploadId></InitiateMultipartUploadResult>'.format(
+                                          escape(bucket), escape(key), upload_id))
+        if 'uploadId' in query:
+            with self.server.lock:
+                parts = self.server.uploads.pop(query['uploadId'], None)
+            if parts is None:
+                return self.send_error_xml(404, 'NoSuchUpload')
+            numbers = sorted(parts)
+            digest = hashlib.md5(b''.join(parts[number][1] for number in numbers)).hexdigest()
+            etag = '"{}-{}"'.format(digest, len(numbers))
+            with self.server.lock:
+                self.server.buckets.setdefault(bucket, {})[key] = {
+                    'size': sum(parts[number][0] for number in numbers), 'etag': etag, 'tags': {}}
+            return self.send_xml(200, '<CompleteMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key>'
+                                      '<ETag>{}</ETag></CompleteMultipartUploadResult>'.format(
+                                          escape(bucket), escape(key), escape(etag)))
+        self.send_error_xml(400, 'InvalidRequest')
+
+    def do_HEAD(self):
+        bucket, key, query = self.parse()
+        with self.server.lock:
+            objects = self.server.buckets.get(bucket)
+            obj = objects.get(key) if objects is not None and key else None
+        if objects is None or (key and obj is None):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        if obj is not None:
+            self.send_header('ETag', obj['etag'])
+            self.send_header('Last-Modified', self.date_time_string())
+        self.send_header('Content-Length', str(obj['size'] if obj is not None else 0))
+        self.end_headers()
+
+    def do_DELETE(self):
+        bucket, key, query = self.parse()
+        with self.server.lock:
+            if 'uploadId' in query:
+                self.server.uploads.pop(query['uploadId'], None)
+            elif 'tagging' not in query:
+                self.server.buckets.get(bucket, {}).pop(key, None)
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        prefix = query.get('prefix', '')
+        with self.server.lock:
+            objects = dict(self.server.buckets.get(bucket) or {}) if bucket in self.server.buckets else None
+        if objects is None:
+            return self.send_error_xml(404, 'NoSuchBucket')
+        keys = sorted(name for name in objects if name.startswith(prefix))
+        start = query.get('continuation-token') or query.get('start-after')
+        if start:
+            keys = [name for name in keys if name > start]
+        limit = int(query.get('max-keys') or 1000)
+        page, truncated = keys[:limit], len(keys) > limit
+        contents = ''.join(
+            '<Contents><Key>{}</Key><Size>{}</Size><ETag>{}</ETag>'
+            '<LastModified>2021-06-01T00:00:00.000Z</LastModified><StorageClass>STANDARD</StorageClass>'
+            '</Contents>'.format(escape(name), objects[name]['size'], escape(objects[name]['etag'])) for name in page)
+        self.send_xml(200, '<ListBucketResult><Name>{}</Name><Prefix>{}</Prefix><KeyCount>{}</KeyCount>'
+                           '<MaxKeys>{}</MaxKeys><IsTruncated>{}</IsTruncated>{}{}</ListBucketResult>'.format(
+                               escape(bucket), escape(prefix), len(page), limit, 'true' if truncated else 'false',
+                               contents,
+                               '<NextContinuationToken>{}</NextContinuationToken>'.format(escape(page[-1]))
+                               if truncated else ''))
+
+    def read_body(self):
+        """
+        Read the request body, hashing it as it arrives
+        :return: (bytes read, hashlib md5 of the payload)
+        """
+        md5 = hashlib.md5()
+        size = 0
+        # newer botocore sends aws-chunked bodies with a trailing checksum
+        chunked = ('aws-chunked' in (self.headers.get('Content-Encoding') or '')
+                   or (self.headers.get('x-amz-content-sha256') or '').startswith('STREAMING-')
+                   or self.headers.get('Transfer-Encoding') == 'chunked')
+        if not chunked:
+            remaining = int(self.headers.get('Content-Length') or 0)
+            while remaining:
+                data = self.rfile.read(min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                md5.update(data)
+                size += len(data)
+                remaining -= len(data)
+            return size, md5
+        while True:
+            length = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            if not length:
+                break
+            data = self.rfile.read(length)
+            md5.update(data)
+            size += len(data)
+            self.rfile.readline()
+        # trailers, up to the blank line that ends the body
+        while self.rfile.readline().strip():
+            pass
+        return size, md5
+
+    def send_xml(self, status, body, headers=None):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>' + body).encode() if body else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_xml(self, status, code):
+        self.send_xml(status, '<Error><Code>{}</Code><Message>{}</Message></Error>'.format(code, code))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(host='127.0.0.1', api_port=0, s3_port=0, **options):
+    """
+    Start the stand-in servers on background threads
+    :param options: StandinServer options (scenes, file_size, staging_delay, ...)
+    :return: (StandinServer, S3Server); the api url is standin.url() + 'api/'
+    """
+    standin = StandinServer((host, api_port), **options)
+    s3 = S3Server((host, s3_port))
+    for server in (standin, s3):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return standin, s3
+
+# run the stand-in servers until stopped; ports, if given, is a shared array the
+# (api, s3) ports are written to once listening, for a parent process to read
+def serve(options, ports=None, host='127.0.0.1', api_port=0, s3_port=0):
+    standin, s3 = start(host, api_port, s3_port, **options)
+    if ports is not None:
+        ports[0], ports[1] = standin.server_address[1], s3.server_address[1]
+    else:
+        print('M2M api:   {}api/'.format(standin.url()))
+        print('S3:        {}'.format(s3.url()))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local M2M api, DDS and s3 stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--api-port', type=int, default=8080, help='port for the M2M api and DDS files')
+    parser.add_argument('--s3-port', type=int, default=9000)
+    parser.add_argument('--scenes', type=int, default=100)
+    parser.add_argument('--size', type=float, default=10, help='MB per file')
+    parser.add_argument('--page-size', type=int, default=100, help='scene-search results per page')
+    parser.add_argument('--staging-delay', type=float, default=0, help='seconds until a requested download is available')
+    parser.add_argument('--api-latency', type=float, default=0, help='seconds added to each api call')
+    parser.add_argument('--latency', type=float, default=0, help='seconds before each file response starts')
+    parser.add_argument('--bandwidth', type=float, default=None, help='MB/s per file connection')
+    args = parser.parse_args()
+    serve({'scenes': args.scenes, 'file_size': int(args.size * 1024 * 1024), 'page_size': args.page_size,
+           'staging_delay': args.staging_delay, 'api_latency': args.api_latency, 'dds_latency': args.latency,
+           'bandwidth': args.bandwidth * 1024 * 1024 if args.bandwidth else None},
+          host=args.host, api_port=args.api_port, s3_port=args.s3_port)
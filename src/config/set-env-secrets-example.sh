@@ -2,6 +2,8 @@
 # SET AWS S3 INFO AS ENV VARIABLES
 export S3_BUCKET="<s3 bucket where to upload>"
 export S3_KEY="<s3 bucket key>"
+# only for an s3-compatible store other than aws, e.g. minio
+# export S3_ENDPOINT_URL="http://127.0.0.1:9000"
 
 # SET USGS M2M CREDS AS ENV VARIABLES
 export M2M_USER="<usgs m2m api username>"
@@ -11,12 +11,15 @@ import sys
 import time
 import argparse
 import re
+import shutil
 import threading
 import datetime
 
 path = "" # Fill a valid download path
 maxthreads = 5 # Threads count for downloads
 sema = threading.Semaphore(value=maxthreads)
+maxretries = 3 # Attempts per download before it is given up on
+failed = [] # urls that failed every attempt
 label = datetime.datetime.now().strftime("%Y%m%d_%H%M%S") # Customized label using date time
 threads = []
 # The entityIds/displayIds need to save to a text file such as scenes.txt.
@@ -27,15 +30,18 @@ threads = []
 # LC08_L2SP_012027_20201215_20201219_02_T1
 scenesFile = 'scenes.txt'
 
+# one keep-alive session shared by every api call and download
+session = requests.Session()
+
 # Send http request
 def sendRequest(url, data, apiKey = None, exitIfNoResponse = True):
     json_data = json.dumps(data)
 
     if apiKey == None:
-        response = requests.post(url, json_data)
+        response = session.post(url, json_data)
     else:
         headers = {'X-Auth-Token': apiKey}
-        response = requests.post(url, json_data, headers = headers)
+        response = session.post(url, json_data, headers = headers)
 
     try:
       httpStatusCode = response.status_code
@@ -69,25 +75,32 @@ def sendRequest(url, data, apiKey = None, exitIfNoResponse = True):
 
     return output['data']
 
-def downloadFile(url):
+def downloadFile(url, attempt=1):
     sema.acquire()
     try:
-        response = requests.get(url, stream=True)
+        response = session.get(url, stream=True)
         disposition = response.headers['content-disposition']
         filename = re.findall("filename=(.+)", disposition)[0].strip("\"")
         print(f"Downloading {filename} ...\n")
         if path != "" and path[-1] != "/":
             filename = "/" + filename
-        open(path+filename, 'wb').write(response.content)
+        # copy the body to disk 1 MB at a time instead of holding the whole file in memory
+        response.raw.decode_content = True
+        with open(path+filename, 'wb') as f:
+            shutil.copyfileobj(response.raw, f, 1024 * 1024)
         print(f"Downloaded {filename}\n")
         sema.release()
     except Exception as e:
-        print(f"Failed to download from {url}. Will try to re-download.")
         sema.release()
-        runDownload(threads, url)
+        if attempt >= maxretries:
+            print(f"Failed to download from {url} after {attempt} attempts.")
+            failed.append(url)
+            return
+        print(f"Failed to download from {url}. Will try to re-download.")
+        runDownload(threads, url, attempt + 1)
 
-def runDownload(threads, url):
-    thread = threading.Thread(target=downloadFile, args=(url,))
+def runDownload(threads, url, attempt=1):
+    thread = threading.Thread(target=downloadFile, args=(url, attempt))
     threads.append(thread)
     thread.start()
 
@@ -263,6 +276,10 @@ if __name__ == '__main__':
         thread.join()
 
     print("Complete Downloading")
+    if len(failed) > 0:
+        print(f"{len(failed)} downloads failed:")
+        for url in failed:
+            print(url)
 
     executionTime = round((time.time() - startTime), 2)
     print(f'Total time: {executionTime} seconds')
@@ -17,15 +17,18 @@ import sys
 import time
 import argparse
 
+# one keep-alive session shared by every api call and download
+session = requests.Session()
+
 # send http request
 def sendRequest(url, data, apiKey = None):
     json_data = json.dumps(data)
 
     if apiKey == None:
-        response = requests.post(url, json_data)
+        response = session.post(url, json_data)
     else:
         headers = {'X-Auth-Token': apiKey}
-        response = requests.post(url, json_data, headers = headers)
+        response = session.post(url, json_data, headers = headers)
 
     try:
       httpStatusCode = response.status_code
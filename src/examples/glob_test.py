@@ -12,6 +12,10 @@ s3_key = os.environ['S3_KEY']
 m2m_user = os.environ['M2M_USER']
 m2m_pass = os.environ['M2M_PASS']
 
+# one s3 client for every upload; creating a client per file re-resolves
+# credentials and rebuilds its connection pool each time
+s3_client = boto3.client('s3')
+
 def upload_file(file_name, bucket, object_name=None):
     """
     Upload a file to an S3 bucket
@@ -23,8 +27,7 @@ def upload_file(file_name, bucket, object_name=None):
     # If S3 object_name was not specified, use file_name
     if object_name is None:
         object_name = file_name
-    # Upload the file
-    s3_client = boto3.client('s3')
+    # Upload the file on the shared client
     try:
         response = s3_client.upload_file(file_name, bucket, object_name)
     except ClientError as e:
@@ -38,7 +41,10 @@ def unzipper(path):
             print("found zip:", zip)
             with ZipFile(path+file, 'r') as z:
                 print('extracting {}...'.format(z))
-                z.extractall(path)
+                # only extract the members uploader wants; skip the rest instead of writing them out
+                for info in z.infolist():
+                    if info.filename.lower().endswith('.jpeg'):
+                        z.extract(info, path)
 
 def uploader(path):
     for file in os.listdir(path):
@@ -11,7 +11,7 @@
 import json, io, time
 from zipfile import ZipFile
 import requests
-import sys, os
+import sys, os, shutil
 import time, csv
 import boto3
 from botocore.exceptions import ClientError
@@ -26,16 +26,19 @@ s3_key = os.environ['S3_KEY']
 m2m_user = os.environ['M2M_USER']
 m2m_pass = os.environ['M2M_PASS']
 
+# one keep-alive session shared by every api call and download
+session = requests.Session()
+
 # send http request
 def sendRequest(url, data, apiKey = None):
 
     json_data = json.dumps(data)
 
     if apiKey == None:
-        response = requests.post(url, json_data)
+        response = session.post(url, json_data)
     else:
         headers = {'X-Auth-Token': apiKey}
-        response = requests.post(url, json_data, headers = headers)
+        response = session.post(url, json_data, headers = headers)
 
     try:
         httpStatusCode = response.status_code
@@ -94,7 +97,10 @@ def unzipper(path, file_name):
             print("found zip:", file)
             with ZipFile(path+file, 'r') as z:
                 print('extracting {}...'.format(z))
-                z.extractall(path)
+                # only extract the jp2s uploader wants; tifs and xmls are never written out
+                for info in z.infolist():
+                    if info.filename.lower().endswith('.jp2'):
+                        z.extract(info, path)
             os.remove(path+file)
     # call uploader func
     uploader(path, file_name)
@@ -120,10 +126,10 @@ def runner(r, path):
     file_name = r.headers['Content-Disposition'].rsplit('=')[1].strip('""')
     print('file_name =', file_name)
     # write file from url to local file
+    # 1 MB reads; 1 KB chunks cost hundreds of thousands of python-level writes per tile
+    r.raw.decode_content = True
     with open(path+file_name, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
+        shutil.copyfileobj(r.raw, f, 1024 * 1024)
 
     # run unzipper method
     unzipper(path, file_name)
@@ -258,7 +264,7 @@ if __name__ == '__main__':
                     for url in downloadUrls:
                         count += 1
                         print('{}---{}'.format(count, url))
-                        response = requests.get(url, stream=True)
+                        response = session.get(url, stream=True)
                         if response.ok:
                             print('response OK')
                             runner(response, data_path)
@@ -273,7 +279,7 @@ if __name__ == '__main__':
                         time.sleep(5)
 
                         for u in rerun_list:
-                            response = requests.get(u, stream=True)
+                            response = session.get(u, stream=True)
                             if response.ok:
                                 runner(response, data_path)
 
@@ -1,6 +1,6 @@
 import boto3
 import logging
-import os, sys
+import os, sys, shutil
 import requests
 import json, zipfile, io, time
 from botocore.exceptions import ClientError
@@ -16,6 +16,13 @@ m2m_pass = os.environ['M2M_PASS']
 
 rerun_list = []
 
+# one keep-alive session shared by every api call and download
+session = requests.Session()
+
+# one s3 client for every upload; creating a client per file re-resolves
+# credentials and rebuilds its connection pool each time
+s3_client = boto3.client('s3')
+
 def upload_file(file_name, bucket, object_name=None):
     """
     Upload a file to an S3 bucket
@@ -27,8 +34,7 @@ def upload_file(file_name, bucket, object_name=None):
     # If S3 object_name was not specified, use file_name
     if object_name is None:
         object_name = file_name
-    # Upload the file
-    s3_client = boto3.client('s3')
+    # Upload the file on the shared client
     try:
         response = s3_client.upload_file(file_name, bucket, object_name)
     except ClientError as e:
@@ -40,15 +46,19 @@ def runner(r):
     file_name = r.headers['Content-Disposition'].rsplit('=')[1].strip('""')
     print(file_name)
 
+    # 1 MB reads; 1 KB chunks cost hundreds of thousands of python-level writes per tile
+    r.raw.decode_content = True
     with open('../data/{}'.format(file_name), 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
+        shutil.copyfileobj(r.raw, f, 1024 * 1024)
 
     # if zip then unzip
     if file_name.endswith(".ZIP"):
         print('found zip file')
-        ZipFile.extractall('../data/{}'.format(file_name))
+        # only the jp2s are wanted; leave the other members in the zip
+        with zipfile.ZipFile('../data/{}'.format(file_name)) as z:
+            for info in z.infolist():
+                if info.filename.lower().endswith('.jp2'):
+                    z.extract(info, '../data/')
     # upload to s3
     print("uploading file: ../data/{}".format(file_name))
     with open('../data/{}'.format(file_name), 'rb') as upload:
@@ -66,7 +76,7 @@ if __name__ == "__main__":
         for obj in data['products']:
             count += 1
             print('{}---{}'.format(count, obj['url']))
-            response = requests.get(obj['url'], stream=True)
+            response = session.get(obj['url'], stream=True)
             if response.ok:
                 print('response ok')
                 runner(response)
@@ -80,6 +90,6 @@ if __name__ == "__main__":
             print("rerun_list has {} urls. preparing to run...".format(len(rerun_list)))
             time.sleep(10)
             for u in rerun_list:
-                response = requests.get(u, stream=True)
+                response = session.get(u, stream=True)
                 if response.ok:
                     runner(response)
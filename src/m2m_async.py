@@ -0,0 +1,395 @@
+# =============================================================================
+#
+# asyncio transfer engine; an alternative to the worker threads in m2m_transfer.py
+#
+# api calls, download-retrieve polling and downloads all run as coroutines on
+# one event loop with aiohttp, so a single thread can keep hundreds of
+# transfers in flight. a fixed number of worker tasks take downloads off a
+# bounded queue, so the number of tasks stays the same however many scenes
+# there are. boto3 blocks, so s3 calls go to a small thread pool
+#
+# needs aiohttp (pip install aiohttp). the journal, product selection, s3
+# index, checksum verification and report are shared with M2MTransfer, as are
+# the decisions of the download-retrieve loop (RetrieveLoop), resuming a
+# download (ByteCursor) and resuming a run; this engine only supplies the
+# calls that await
+#
+# imports======================================================================
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import m2m_journal
+from m2m_checksum import StreamChecksum
+from m2m_downloader import ByteCursor, already_complete, range_headers
+from m2m_pool import StagedFile
+from m2m_s3 import MultipartUpload
+from m2m_session import M2MError, M2MServerError, RETRYABLE, response_data, endpoint as url_endpoint
+from m2m_transfer import M2MTransfer
+
+# =============================================================================
+
+class AsyncM2MTransfer(M2MTransfer):
+    def __init__(self, *args, concurrency=100, **kwargs):
+        """
+        Takes the same arguments as M2MTransfer, plus:
+        :param concurrency: transfers in flight at once; used instead of download_workers and
+                            upload_workers. segments and zip_members are not supported here,
+                            and dry runs (plan()) go through M2MTransfer, since they only search
+        """
+        if aiohttp is None:
+            raise ImportError('the asyncio engine needs aiohttp: pip install aiohttp')
+        super(AsyncM2MTransfer, self).__init__(*args, **kwargs)
+        # without these a run would quietly stream whole files, and journal zips as skipped
+        # (finished) so no later threaded run would extract them
+        if self.zip_members:
+            raise ValueError('zip_members is not supported by the asyncio engine; use M2MTransfer')
+        if self.segments > 1:
+            raise ValueError('segments above 1 are not supported by the asyncio engine; use M2MTransfer')
+        self.concurrency = concurrency
+        self.http = None
+        self.api_key = None
+        self.failed = []
+        # boto3 calls block, so they run here instead of on the event loop
+        self.s3_executor = ThreadPoolExecutor(max_workers=self.s3.config.max_concurrency)
+
+    # run func(*args) on the s3 thread pool
+    def in_executor(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self.s3_executor, func, *args)
+
+    # call an m2m api endpoint; rate limiting and retries follow the same RetryPolicy and
+    # TokenBucket as the threaded engine, but wait with asyncio.sleep. metadata responses are
+    # answered from the cache when there is one
+    async def request(self, endpoint, data):
+        url = self.service_url + endpoint
+        if self.cache is not None:
+            cached = self.cache.get(url, data)
+            if cached is not None:
+                return cached
+        result = await self.request_uncached(url, endpoint, data)
+        if self.cache is not None:
+            self.cache.put(url, data, result)
+        return result
+
+    async def request_uncached(self, url, endpoint, data):
+        json_data = json.dumps(data)
+        policy = self.session.retry_policy
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await self.request_once(url, json_data)
+            except RETRYABLE as e:
+                if attempt >= policy.max_attempts:
+                    raise
+                delay = policy.delay(attempt, e)
+                self.session.on_retry(e, delay, endpoint)
+                print('{} - retrying in {:.1f} seconds ({}/{})'.format(e, delay, attempt, policy.max_attempts - 1))
+                await asyncio.sleep(delay)
+
+    async def request_once(self, url, json_data):
+        limiter = self.session.rate_limiter
+        started = time.perf_counter()
+        while limiter is not None:
+            wait = limiter.take()
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+        self.metrics.add('api_throttled_seconds', time.perf_counter() - started)
+        started = time.perf_counter()
+        headers = {'X-Auth-Token': self.api_key} if self.api_key else {}
+        try:
+            try:
+                async with self.http.post(url, data=json_data, headers=headers) as response:
+                    text = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise M2MServerError('{} failed: {}'.format(url, e))
+            return response_data(url, response.status, text, response.headers.get('Retry-After'))
+        finally:
+            self.metrics.observe('api_seconds', time.perf_counter() - started, endpoint=url_endpoint(url))
+
+    # open a streaming response for url from byte offset, retrying failed requests; the
+    # async counterpart of RangedDownloader.open, with the same answer to each status
+    async def open(self, url, offset=0, retries=0):
+        while True:
+            try:
+                response = await self.http.get(url, headers=range_headers(offset))
+                if response.status < 400:
+                    return response, retries
+                response.release()
+                if already_complete(response.status, response.headers, offset):
+                    return None, retries
+                error = self.fetcher.failure(url, response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            retries, delay = self.fetcher.next_retry(url, error, retries)
+            await asyncio.sleep(delay)
+
+    # yield the body of url from response onwards, resuming with a Range request whenever
+    # the stream drops; the async counterpart of RangedDownloader.chunks
+    async def chunks(self, url, response, offset=0):
+        retries = 0
+        chunk_size = self.fetcher.buffer_size or 1024 * 1024
+        cursor = ByteCursor(offset)
+        while response is not None:
+            cursor.start(response.status, response.headers)
+            try:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    chunk = cursor.take(chunk)
+                    if chunk:
+                        self.metrics.add('download_bytes', len(chunk))
+                        yield chunk
+                # a connection closed early can end the body quietly; check it all arrived
+                error = cursor.shortfall()
+                if error is None:
+                    return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                response.release()
+            retries, delay = self.fetcher.next_retry(url, error, retries)
+            await asyncio.sleep(delay)
+            response, retries = await self.open(url, cursor.offset, retries)
+
+    # stream a download into an s3 multipart upload, one part_size buffer at a time;
+    # returns the complete_multipart_upload response and checksum like M2MTransfer.stream_upload;
+    # a failed upload is aborted and raised
+    async def stream_upload(self, response, download, file_name):
+        upload = await self.in_executor(MultipartUpload, self.s3.client, self.s3_bucket, self.s3_key + file_name)
+        checksum = StreamChecksum(self.part_size)
+        buffer = bytearray()
+        part_number = 1
+        try:
+            async for chunk in self.chunks(download['url'], response):
+                checksum.update(chunk)
+                buffer += chunk
+                while len(buffer) >= self.part_size:
+                    await self.in_executor(upload.upload_part, buffer[:self.part_size], part_number)
+                    del buffer[:self.part_size]
+                    part_number += 1
+            # the last part may be short; an empty body still needs one part
+            if buffer or part_number == 1:
+                await self.in_executor(upload.upload_part, buffer, part_number)
+            uploaded = await self.in_executor(upload.complete)
+        except BaseException:
+            await self.in_executor(upload.abort)
+            raise
+        return uploaded, checksum
+
+    # download one available download record and get it into s3; runs on a worker task
+    async def fetch(self, download):
+        # hold back until the file fits in the staging area, before connecting
+        with self.metrics.timer('staging_wait_seconds'):
+            reserved = await self.reserve(download.get('filesize')) if self.staging else 0
+        try:
+            with self.metrics.timer('fetch_seconds'):
+                staged = await self.receive(download)
+        except BaseException:
+            self.release(reserved)
+            raise
+        if staged is None:
+            # streamed or skipped; nothing is left on disk
+            self.release(reserved)
+            return
+        # the uploader removes the file and gives the staging space back
+        staged.reserved = reserved
+        await self.in_executor(self.uploader, staged)
+
+    # download one record, streaming it to s3 or staging it; returns the StagedFile to upload, if any
+    async def receive(self, download):
+        response, retries = await self.open(download['url'])
+        self.count('downloader_count')
+        file_name = response.headers['Content-Disposition'].rsplit('=')[1].strip('""')
+        content_length = response.headers.get('Content-Length')
+        print('file_name =', file_name)
+        if not file_name.endswith('.jp2'):
+            response.release()
+            print('skipping', file_name)
+            self.count('skip_count')
+            self.journal.update(download['downloadId'], m2m_journal.SKIPPED, file_name)
+            return None
+        self.count('jpeg_count')
+        if self.stream_to_s3:
+            uploaded, checksum = await self.stream_upload(response, download, file_name)
+            await self.in_executor(self.verify, download, file_name, uploaded, checksum, content_length)
+            self.count('upload_count')
+            self.index_upload(self.s3_key + file_name, download.get('filesize'))
+            self.journal.update(download['downloadId'], m2m_journal.UPLOADED, file_name)
+            return None
+        # staged under a name unique to this download, then uploaded like the threaded engine's
+        path = self.staging_path(download, file_name)
+        checksum = StreamChecksum(self.s3.config.multipart_chunksize)
+        with open(path + '.part', 'wb') as f:
+            async for chunk in self.chunks(download['url'], response):
+                checksum.update(chunk)
+                f.write(chunk)
+        os.rename(path + '.part', path)
+        self.journal.update(download['downloadId'], m2m_journal.DOWNLOADED, file_name)
+        return StagedFile(path, file_name, download, checksum, content_length)
+
+    # wait without blocking the event loop until size bytes fit in the staging area
+    async def reserve(self, size):
+        while True:
+            reserved = self.staging.try_reserve(size)
+            if reserved is not None:
+                return reserved
+            await asyncio.sleep(0.5)
+
+    # take downloads off the queue until cancelled; failures are recorded, not raised
+    async def worker(self, queue):
+        while True:
+            download = await queue.get()
+            try:
+                await self.fetch(download)
+            except Exception as e:
+                print('worker failed on {}: {}'.format(download, e))
+                self.failed.append((download, e))
+            finally:
+                queue.task_done()
+
+    # queue one available download; waits while the queue is full
+    async def dispatch(self, queue, download):
+        self.dispatch_count += 1
+        print('{}---{}'.format(self.dispatch_count, download['url']))
+        self.journal.available(download)
+        await queue.put(download)
+
+    # request one page of downloads, queue each as it turns available and wait for them all
+    async def transfer_page(self, queue, downloads):
+        if not downloads:
+            print('no products to download on this page')
+            return
+        # large pages are requested in batches, request_concurrency at a time,
+        # and polling starts with the first batch back
+        size = self.request_batch_size or len(downloads)
+        limit = asyncio.Semaphore(self.request_concurrency)
+        loop = self.retrieve_loop([asyncio.ensure_future(self.request_batch(limit, downloads[i:i + size]))
+                                   for i in range(0, len(downloads), size)])
+        while True:
+            if loop.collect():
+                retrieve = await self.request('download-retrieve', {'label': self.label})
+                for download in loop.ready(retrieve):
+                    await self.dispatch(queue, download)
+            if not loop.active():
+                break
+            timeout = loop.wait_time()
+            if loop.waiting:
+                # poll again when the wait is up, or sooner if another batch comes back
+                await asyncio.wait(loop.waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(timeout)
+        await queue.join()
+
+    # send one batch of downloads to download-request, at most request_concurrency at once;
+    # returns the batch with its response
+    async def request_batch(self, limit, batch):
+        async with limit:
+            print('REQUESTED DOWNLOADS COUNT:', len(batch))
+            request = await self.request('download-request', {'downloads': batch, 'label': self.label})
+        self.journal.requested(batch)
+        return batch, request
+
+    # scene-search one page and get the download options for it
+    async def fetch_page(self, starting_num):
+        print("Searching scenes from {}...\n".format(starting_num))
+        scenes = await self.request('scene-search', self.scene_payload(starting_num))
+        downloads = []
+        scene_ids = self.page_scene_ids(scenes)
+        if scene_ids:
+            options = await self.request('download-options', self.options_payload(scene_ids))
+            downloads = self.select_downloads(options, starting_num)
+        self.progress.searched(self.total_hits, starting_num - 1 + scenes['recordsReturned'])
+        return scenes, downloads
+
+    # transfer every page, fetching the next page while the current one transfers
+    async def transfer_pages(self, queue):
+        in_flight = self.resume()
+        if in_flight:
+            await self.transfer_page(queue, in_flight)
+        starting_num = self.starting_num
+        page = asyncio.ensure_future(self.fetch_page(starting_num))
+        while page is not None:
+            scenes, downloads = await page
+            page = None
+            if scenes['recordsReturned'] == 0:
+                break
+            next_record = self.next_start(starting_num, scenes)
+            if next_record is not None:
+                page = asyncio.ensure_future(self.fetch_page(next_record))
+            self.count_page()
+            await self.transfer_page(queue, downloads)
+            self.journal.page_done(starting_num, scenes['nextRecord'])
+            starting_num = next_record
+        print('\nNo more pagination!\n')
+
+    def failed_items(self):
+        return self.failed
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        connect_timeout, read_timeout = self.session.timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency + 4)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as http:
+            self.http = http
+            await self.login()
+            queue = asyncio.Queue(maxsize=self.concurrency)
+            workers = [asyncio.ensure_future(self.worker(queue)) for i in range(self.concurrency)]
+            self.metrics.gauge('download_queue', queue.qsize)
+            self.start_metrics()
+            if self.progress.interval or self.progress.path:
+                self.progress.start()
+            try:
+                await self.in_executor(self.prepare)
+                if self.plan_path:
+                    for page, downloads in self.plan_downloads():
+                        self.count_page()
+                        await self.transfer_page(queue, downloads)
+                    print('\nPlan transferred!\n')
+                else:
+                    print("Searching datasets...\n")
+                    payload = {'datasetName': self.dataset_name, 'spatialFilter': self.spatial_filter,
+                               'temporalFilter': self.temporal_filter}
+                    if self.pick_dataset(await self.request('dataset-search', payload)):
+                        await self.transfer_pages(queue)
+                    else:
+                        print("Search found no results.\n")
+                self.s3_executor.shutdown()
+                self.s3.shutdown()
+                self.progress.stop()
+                self.report()
+                self.journal.close()
+            finally:
+                self.progress.cancel()
+                self.stop_metrics()
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                await self.logout()
+
+    async def login(self):
+        print('running login method')
+        self.api_key = await self.request('login', {'username': self.m2m_user, 'password': self.m2m_pass})
+
+    async def logout(self):
+        print('running logout method')
+        try:
+            if await self.request('logout', None) is None:
+                print("Logged Out\n\n")
+            else:
+                print("Logout Failed\n\n")
+        except M2MError as e:
+            # don't hide whatever error ended the run
+            print("Logout Failed:", e, "\n\n")
+        self.api_key = None
+        self.session.close()
@@ -0,0 +1,155 @@
+# =============================================================================
+#
+# on-disk cache of m2m api metadata responses used by m2m_transfer.py
+#
+# dataset-search, scene-search and download-options answer the same way for
+# the same filters, so a restarted run, a dry run or a debugging session can
+# reuse them instead of asking the api again. each response is stored in a
+# file named after the sha256 of its endpoint and normalized payload. entries
+# older than the ttl are ignored and removed, and once the cache grows past
+# its size limit the least recently used entries are removed first (a hit
+# touches its file, so file mtime is the last use) until it is well under the
+# limit, so the directory is only walked once in a while rather than on every
+# write to a full cache
+#
+# imports======================================================================
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from m2m_session import endpoint
+
+# =============================================================================
+
+# endpoints whose responses only change when usgs updates the inventory
+CACHED_ENDPOINTS = ('dataset-search', 'scene-search', 'download-options')
+
+
+class ResponseCache(object):
+    def __init__(self, path, ttl=7 * 24 * 3600, max_bytes=1024 * 1024 * 1024, endpoints=CACHED_ENDPOINTS,
+                 metrics=None, low_water=0.9):
+        """
+        :param path: cache directory; created if missing
+        :param ttl: seconds an entry is used for; None keeps entries until they are evicted
+        :param max_bytes: size the cache is held to by removing the least recently used entries
+        :param endpoints: endpoint names (the last part of the url) that are cached
+        :param metrics: Metrics to count hits and misses per endpoint in
+        :param low_water: share of max_bytes the cache is brought down to once it goes over
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.endpoints = endpoints
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.size = sum(size for name, size, used in self.entries())
+
+    # True if responses from url are cached
+    def caches(self, url):
+        return endpoint(url) in self.endpoints
+
+    # file an api call's response is stored in
+    def file_for(self, url, payload):
+        key = json.dumps([url, normalize(payload)], sort_keys=True, separators=(',', ':'))
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + '.json')
+
+    def get(self, url, payload):
+        """
+        Cached response data for an api call
+        :return: the data, or None when it isn't cached (or has expired)
+        """
+        if not self.caches(url):
+            return None
+        path = self.file_for(url, payload)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            # missing, or half written by a run that died
+            self.count('cache_misses', url)
+            return None
+        if self.ttl is not None and time.time() - entry['created'] > self.ttl:
+            self.remove(path)
+            self.count('cache_misses', url)
+            return None
+        # mark it used, for lru eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.count('cache_hits', url)
+        return entry['data']
+
+    def put(self, url, payload, data):
+        if not self.caches(url):
+            return
+        path = self.file_for(url, payload)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        body = json.dumps({'url': url, 'payload': payload, 'created': time.time(), 'data': data})
+        # written under a temporary name and renamed, so readers never see half an entry
+        temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(temporary, 'w') as f:
+            f.write(body)
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temporary, path)
+        with self.lock:
+            self.size += len(body) - replaced
+            over = self.size > self.max_bytes
+        if over:
+            self.evict()
+
+    # (path, size, last used) of every entry
+    def entries(self):
+        entries = []
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    # remove the least recently used entries until the cache is down to low_water of max_bytes
+    def evict(self):
+        with self.lock:
+            entries = sorted(self.entries(), key=lambda entry: entry[2])
+            self.size = sum(size for path, size, used in entries)
+            target = self.max_bytes * self.low_water
+            for path, size, used in entries:
+                if self.size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.size -= size
+
+    def remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self.lock:
+            self.size -= size
+
+    def count(self, name, url):
+        if self.metrics is not None:
+            self.metrics.add(name, endpoint=endpoint(url))
+
+
+# payload with dict keys in a fixed order and None values dropped (the api treats them as
+# absent), so equivalent payloads share a cache entry
+def normalize(payload):
+    if isinstance(payload, dict):
+        return dict((key, normalize(value)) for key, value in sorted(payload.items()) if value is not None)
+    if isinstance(payload, (list, tuple)):
+        return [normalize(item) for item in payload]
+    return payload
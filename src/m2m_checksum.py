@@ -0,0 +1,90 @@
+# =============================================================================
+#
+# streaming checksums used by m2m_transfer.py to verify transfers
+#
+# bytes are hashed as they pass from the download to s3 (or the staging file),
+# so verifying a transfer never reads the data a second time. alongside the
+# whole-file md5/sha256, the md5 of every part_size part is kept so the etag
+# s3 gives a multipart upload (md5 of the part md5s, "-" part count) can be
+# worked out locally and compared
+#
+# imports======================================================================
+
+import hashlib
+
+# =============================================================================
+
+class IntegrityError(Exception):
+    # stored bytes don't match what usgs served
+    pass
+
+
+class StreamChecksum(object):
+    def __init__(self, part_size=None, whole_file=True):
+        """
+        :param part_size: s3 part size to track part md5s for; None skips them
+        :param whole_file: also keep whole-file md5 and sha256 (off for ranges of a file
+                           fetched in parallel, which can't be hashed as one stream)
+        """
+        self.part_size = part_size
+        self.size = 0
+        self.md5 = hashlib.md5() if whole_file else None
+        self.sha256 = hashlib.sha256() if whole_file else None
+        self.part_digests = []
+        self.part = hashlib.md5()
+        self.part_length = 0
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        if self.md5 is not None:
+            self.md5.update(chunk)
+            self.sha256.update(chunk)
+        if self.part_size is None:
+            return
+        view = memoryview(chunk)
+        while len(view):
+            take = min(len(view), self.part_size - self.part_length)
+            self.part.update(view[:take])
+            self.part_length += take
+            view = view[take:]
+            if self.part_length == self.part_size:
+                self.part_digests.append(self.part.digest())
+                self.part = hashlib.md5()
+                self.part_length = 0
+
+    # pass chunks through unchanged, hashing them on the way
+    def wrap(self, chunks):
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    # md5 digests of every part, including a final short one
+    def parts(self):
+        if self.part_length or not self.part_digests:
+            return self.part_digests + [self.part.digest()]
+        return list(self.part_digests)
+
+    # the etag s3 gives this data uploaded in part_size parts (or in one put when single_part)
+    def etag(self, single_part=False):
+        if single_part:
+            return '"{}"'.format(self.md5.hexdigest())
+        parts = self.parts()
+        return '"{}-{}"'.format(hashlib.md5(b''.join(parts)).hexdigest(), len(parts))
+
+    # fields worth recording next to the object
+    def record(self):
+        record = {'size': self.size}
+        if self.md5 is not None:
+            record['md5'] = self.md5.hexdigest()
+            record['sha256'] = self.sha256.hexdigest()
+        return record
+
+    # merge checksums of consecutive ranges, each starting on a part boundary, into one
+    # (part md5s only; whole-file hashes can't be joined)
+    @staticmethod
+    def combine(checksums, part_size):
+        combined = StreamChecksum(part_size, whole_file=False)
+        for checksum in checksums:
+            combined.size += checksum.size
+            combined.part_digests.extend(checksum.parts())
+        return combined
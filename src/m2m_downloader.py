@@ -0,0 +1,288 @@
+# =============================================================================
+#
+# resumable downloads from dds.cr.usgs.gov used by m2m_transfer.py
+#
+# a download that drops part way through is picked up again with an http
+# Range request from the last byte already received, instead of starting the
+# whole file over. each file gets a bounded number of retries, after which a
+# DownloadError is raised so the caller can report it and move on
+#
+# bodies are read with readinto into one large buffer per download rather than
+# as many small bytes objects, so a tile costs a few hundred python-level reads
+# instead of hundreds of thousands
+#
+# imports======================================================================
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError, SSLError
+
+# =============================================================================
+
+class DownloadError(Exception):
+    pass
+
+
+class RangedDownloader(object):
+    def __init__(self, session, max_retries=5, retry_delay=5, buffer_size=1024 * 1024, metrics=None):
+        """
+        :param session: M2MSession (or anything with a requests-style get) to download with
+        :param max_retries: retries per file, counting both failed requests and dropped streams
+        :param retry_delay: seconds before the first retry; doubles with each retry
+        :param buffer_size: bytes read at a time into a buffer reused for the whole download;
+                            0 reads with iter_content(chunk_size) instead
+        :param metrics: Metrics to count bytes downloaded and retries in
+        """
+        self.session = session
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.buffer_size = buffer_size
+        self.metrics = metrics
+
+    # open a streaming response for url from byte offset up to (not including) end,
+    # retrying failed requests; the response is None when offset is already the end of the file
+    def open(self, url, offset=0, retries=0, end=None):
+        while True:
+            try:
+                response = self.session.get(url, stream=True, headers=range_headers(offset, end))
+                if response.ok:
+                    return response, retries
+                response.close()
+                if already_complete(response.status_code, response.headers, offset, end):
+                    return None, retries
+                error = self.failure(url, response.status_code)
+            except requests.exceptions.RequestException as e:
+                error = e
+            retries = self.retry(url, error, retries)
+
+    # the error to retry a failed response on; client errors other than a timeout or rate
+    # limit won't get better by retrying, so those raise DownloadError
+    def failure(self, url, status):
+        error = 'HTTP {}'.format(status)
+        if status < 500 and status not in (408, 429):
+            raise DownloadError('{} for {}'.format(error, url))
+        return error
+
+    # sleep before the next retry, or raise once the retry budget is spent
+    def retry(self, url, error, retries):
+        retries, delay = self.next_retry(url, error, retries)
+        time.sleep(delay)
+        return retries
+
+    # count one more retry and return it with the seconds to wait first;
+    # raises once the retry budget is spent
+    def next_retry(self, url, error, retries):
+        if retries >= self.max_retries:
+            raise DownloadError('giving up on {} after {} retries: {}'.format(url, retries, error))
+        retries += 1
+        if self.metrics is not None:
+            self.metrics.add('download_retries')
+        delay = self.retry_delay * 2 ** (retries - 1)
+        print('download of {} failed ({}); retry {}/{} in {} seconds'.format(url, error, retries, self.max_retries, delay))
+        return retries, delay
+
+    def chunks(self, url, response=None, offset=0, chunk_size=1024 * 1024, end=None):
+        """
+        Yield the body of url from byte offset, resuming with a Range request whenever the
+        stream drops, so the caller sees one unbroken sequence of bytes. with buffer_size set
+        each chunk is a memoryview of the same buffer, only valid until the next one is read
+        :param url: url to download
+        :param response: an already open streaming response for url at offset, if there is one
+        :param offset: byte to start from
+        :param chunk_size: bytes per chunk when reading with iter_content
+        :param end: byte to stop before; None reads to the end of the file
+        """
+        retries = 0
+        buffer = bytearray(self.buffer_size) if self.buffer_size else None
+        cursor = ByteCursor(offset, end)
+        if response is None:
+            response, retries = self.open(url, offset, end=end)
+        while response is not None:
+            cursor.start(response.status_code, response.headers)
+            try:
+                with response:
+                    for chunk in self.read(response, buffer, chunk_size):
+                        chunk = cursor.take(chunk)
+                        if chunk:
+                            if self.metrics is not None:
+                                self.metrics.add('download_bytes', len(chunk))
+                            yield chunk
+                        if cursor.finished():
+                            return
+                # a connection closed early can end the body quietly; check it all arrived
+                error = cursor.shortfall()
+                if error is None:
+                    return
+                retries = self.retry(url, error, retries)
+            except requests.exceptions.RequestException as e:
+                retries = self.retry(url, e, retries)
+            response, retries = self.open(url, cursor.offset, retries, end=end)
+
+    # the body of response as chunks, read into buffer when there is one; a compressed
+    # body goes through iter_content, which decodes it
+    def read(self, response, buffer, chunk_size):
+        if buffer is None or response.headers.get('Content-Encoding', 'identity') != 'identity':
+            return response.iter_content(chunk_size=chunk_size)
+        return readinto_chunks(response.raw, buffer)
+
+    # download url to path, resuming from whatever is already in path; wrap, if given,
+    # is applied to the chunk stream (e.g. to hash it on the way to disk)
+    def to_file(self, url, path, response=None, chunk_size=1024 * 1024, wrap=None):
+        with open(path, 'ab') as f:
+            offset = f.tell()
+            if offset and response is not None:
+                # the open response starts at byte 0; a file already that long was finished
+                # (e.g. by a run that died before renaming it), otherwise reopen from where it left off
+                size = body_end(response.headers, 0)
+                response.close()
+                if size == offset:
+                    return
+                response = None
+            chunks = self.chunks(url, response, offset, chunk_size)
+            for chunk in wrap(chunks) if wrap else chunks:
+                f.write(chunk)
+
+    def to_file_segmented(self, url, path, size, segments, chunk_size=1024 * 1024, align=1, wrap=None):
+        """
+        Download url to path as segments byte ranges fetched at the same time, each written
+        straight to its place in a preallocated file and resumed on its own if it drops
+        :param url: url to download
+        :param path: file to write
+        :param size: total bytes, e.g. from the first response's Content-Length
+        :param segments: number of ranges fetched in parallel
+        :param align: range boundaries fall on multiples of this many bytes
+        :param wrap: wrap(start, end, chunks) applied to each range's chunk stream
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            preallocate(fd, size)
+            with ThreadPoolExecutor(max_workers=segments) as executor:
+                futures = [executor.submit(self.range_to_fd, url, fd, start, end, chunk_size, wrap)
+                           for start, end in split_ranges(size, segments, align)]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
+
+    # write bytes [start, end) of url into fd at the same offsets
+    def range_to_fd(self, url, fd, start, end, chunk_size, wrap=None):
+        offset = start
+        chunks = self.chunks(url, offset=start, end=end, chunk_size=chunk_size)
+        for chunk in wrap(start, end, chunks) if wrap else chunks:
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+
+
+class ByteCursor(object):
+    # how far a download has got across the responses it is read from (the first one, and
+    # one per resume); shared by RangedDownloader and the asyncio engine, which only differ
+    # in how they read a response
+    def __init__(self, offset=0, end=None):
+        """
+        :param offset: byte to start from
+        :param end: byte to stop before; None reads to the end of the file
+        """
+        self.offset = offset
+        self.end = end
+        self.skip = 0
+        self.stop = None
+
+    # start reading a response opened at offset, from its status and headers
+    def start(self, status, headers):
+        # a server that ignores Range sends the whole file again; skip what we already have
+        self.skip = self.offset if self.offset and status == 200 else 0
+        self.stop = body_end(headers, self.offset - self.skip)
+        if self.end is not None:
+            self.stop = self.end if self.stop is None else min(self.stop, self.end)
+
+    # the part of chunk that is wanted (possibly none of it), counted as read
+    def take(self, chunk):
+        if self.skip:
+            dropped = min(self.skip, len(chunk))
+            chunk = chunk[dropped:]
+            self.skip -= dropped
+        if self.end is not None and self.offset + len(chunk) > self.end:
+            chunk = chunk[:self.end - self.offset]
+        self.offset += len(chunk)
+        return chunk
+
+    # True once every byte up to end has been read
+    def finished(self):
+        return self.end is not None and self.offset >= self.end
+
+    # the error to resume on when a response's body ended before its Content-Length said it
+    # would, or None if it all arrived
+    def shortfall(self):
+        if self.stop is None or self.offset >= self.stop:
+            return None
+        return 'stream ended at byte {} of {}'.format(self.offset, self.stop)
+
+
+# Range header asking for bytes [offset, end) of a file; no header for the whole file
+def range_headers(offset=0, end=None):
+    if end is not None:
+        return {'Range': 'bytes={}-{}'.format(offset, end - 1)}
+    if offset:
+        return {'Range': 'bytes={}-'.format(offset)}
+    return {}
+
+# byte offset a body starting at start should end at, from its Content-Length, or None if
+# unknown; a compressed body is decoded on the way in, so its Content-Length says nothing
+def body_end(headers, start):
+    length = headers.get('Content-Length')
+    if length is None or not length.isdigit() or headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    return start + int(length)
+
+# True if a failed answer to a resume from offset means every byte is here already: a 416
+# whose Content-Range total (e.g. bytes */1234) is offset
+def already_complete(status, headers, offset, end=None):
+    if status != 416 or not offset or end is not None:
+        return False
+    total = headers.get('Content-Range', '').rpartition('/')[2]
+    return total.isdigit() and int(total) == offset
+
+# read raw (a urllib3 response) into buffer until the body ends, yielding a view of the
+# filled part each time; urllib3 errors are raised as the requests errors iter_content raises
+def readinto_chunks(raw, buffer):
+    view = memoryview(buffer)
+    while True:
+        try:
+            count = raw.readinto(view)
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except SSLError as e:
+            raise requests.exceptions.SSLError(e)
+        if not count:
+            return
+        yield view[:count]
+
+# give fd size bytes of disk up front, so a full disk fails the download at the start
+# rather than part way through; falls back to a sparse file where that isn't supported
+def preallocate(fd, size):
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+# split [0, size) into count contiguous (start, end) ranges whose boundaries fall on
+# multiples of align, e.g. s3 part boundaries
+def split_ranges(size, count, align=1):
+    units = max(1, -(-size // align))
+    count = max(1, min(count, units))
+    ranges = []
+    for i in range(count):
+        start = units * i // count * align
+        end = min(size, units * (i + 1) // count * align)
+        if end > start:
+            ranges.append((start, end))
+    return ranges
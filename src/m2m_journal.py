@@ -0,0 +1,180 @@
+# =============================================================================
+#
+# on-disk transfer journal used by m2m_transfer.py so a run can be restarted
+#
+# every product moves through the states below and each change is written to
+# a sqlite file straight away. on restart the transfer resumes from the page
+# after the last finished one, skips products that are already done and
+# re-queues anything that was still in flight
+#
+# imports======================================================================
+
+import sqlite3
+import threading
+import time
+
+# =============================================================================
+
+SEARCHED = 'searched'
+REQUESTED = 'requested'
+AVAILABLE = 'available'
+DOWNLOADED = 'downloaded'
+UPLOADED = 'uploaded'
+# not wanted (e.g. a zip when only jp2s are kept); finished like uploaded
+SKIPPED = 'skipped'
+
+FINISHED = (UPLOADED, SKIPPED)
+# how far along each state is, for picking the furthest when journals are merged
+ORDER = (SEARCHED, REQUESTED, AVAILABLE, DOWNLOADED, SKIPPED, UPLOADED)
+IN_FLIGHT = (REQUESTED, AVAILABLE, DOWNLOADED)
+
+
+class TransferJournal(object):
+    def __init__(self, path):
+        # one connection shared by all workers, serialized by a lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS products (
+                entity_id TEXT NOT NULL,
+                product_id TEXT NOT NULL,
+                product_code TEXT,
+                display_id TEXT,
+                filesize INTEGER,
+                page INTEGER,
+                download_id INTEGER,
+                file_name TEXT,
+                state TEXT NOT NULL,
+                updated REAL,
+                PRIMARY KEY (entity_id, product_id))""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS products_download_id ON products (download_id)")
+            # checksum columns were added after the first journals were written
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(products)")]
+            for column, kind in (('bytes', 'INTEGER'), ('md5', 'TEXT'), ('sha256', 'TEXT'), ('etag', 'TEXT')):
+                if column not in columns:
+                    self.db.execute("ALTER TABLE products ADD COLUMN {} {}".format(column, kind))
+            self.db.execute("""CREATE TABLE IF NOT EXISTS pages (
+                starting_number INTEGER PRIMARY KEY,
+                next_record INTEGER,
+                state TEXT NOT NULL,
+                updated REAL)""")
+
+    def execute(self, sql, params=()):
+        with self.lock, self.db:
+            return self.db.execute(sql, params).fetchall()
+
+    # record download-options products found on the page starting at page;
+    # products already past the searched state keep their state
+    def searched(self, page, products):
+        with self.lock, self.db:
+            self.db.executemany("""INSERT OR IGNORE INTO products
+                (entity_id, product_id, product_code, display_id, filesize, page, state, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                [(p['entityId'], p['id'], p.get('productCode'), p.get('displayId'), p.get('filesize'),
+                  page, SEARCHED, time.time()) for p in products])
+
+    # record a download-request for {'entityId', 'productId'} downloads
+    def requested(self, downloads):
+        with self.lock, self.db:
+            self.db.executemany("""UPDATE products SET state = ?, updated = ?
+                WHERE entity_id = ? AND product_id = ? AND state NOT IN (?, ?)""",
+                [(REQUESTED, time.time(), d['entityId'], d['productId']) + FINISHED for d in downloads])
+
+    # record a download-retrieve record turning available; matched on entityId and productCode
+    # since download-retrieve does not return the productId
+    def available(self, download):
+        if 'entityId' not in download:
+            return
+        self.execute("""UPDATE products SET state = ?, download_id = ?, updated = ?
+            WHERE entity_id = ? AND product_code = ? AND state NOT IN (?, ?)""",
+            (AVAILABLE, download['downloadId'], time.time(), download['entityId'], download.get('productCode')) + FINISHED)
+
+    # productCode of each {'entityId', 'productId'} download, keyed by (entityId, productId)
+    def product_codes(self, downloads):
+        codes = {}
+        # sqlite allows 999 parameters per statement
+        for start in range(0, len(downloads), 900):
+            entity_ids = [download['entityId'] for download in downloads[start:start + 900]]
+            rows = self.execute("SELECT entity_id, product_id, product_code FROM products WHERE entity_id IN ({})".format(
+                ', '.join('?' * len(entity_ids))), entity_ids)
+            codes.update(((entity_id, product_id), product_code) for entity_id, product_id, product_code in rows)
+        return codes
+
+    # move a product to state by its downloadId
+    def update(self, download_id, state, file_name=None):
+        self.execute("""UPDATE products SET state = ?, file_name = COALESCE(?, file_name), updated = ?
+            WHERE download_id = ?""", (state, file_name, time.time(), download_id))
+
+    # record the verified size and checksums of a product's uploaded object
+    def verified(self, download_id, record):
+        self.execute("""UPDATE products SET bytes = ?, md5 = ?, sha256 = ?, etag = ?, updated = ?
+            WHERE download_id = ?""", (record.get('size'), record.get('md5'), record.get('sha256'),
+                                       record.get('etag'), time.time(), download_id))
+
+    # move a product to state by its entityId and productId
+    def mark(self, entity_id, product_id, state):
+        self.execute("UPDATE products SET state = ?, updated = ? WHERE entity_id = ? AND product_id = ?",
+                     (state, time.time(), entity_id, product_id))
+
+    def finished(self, entity_id, product_id):
+        rows = self.execute("SELECT state FROM products WHERE entity_id = ? AND product_id = ?", (entity_id, product_id))
+        return bool(rows) and rows[0][0] in FINISHED
+
+    # record a page as done along with the nextRecord it pointed to
+    def page_done(self, starting_number, next_record):
+        self.execute("INSERT OR REPLACE INTO pages (starting_number, next_record, state, updated) VALUES (?, ?, ?, ?)",
+                     (starting_number, next_record, 'done', time.time()))
+
+    # startingNumber to resume scene-search from; pages are finished in order
+    def resume_point(self, default=1):
+        rows = self.execute("SELECT MAX(next_record) FROM pages WHERE state = 'done'")
+        return rows[0][0] or default
+
+    # {'entityId', 'productId'} downloads requested but not finished on pages before page
+    # (on any page when page is None)
+    def in_flight(self, page=None):
+        if page is None:
+            rows = self.execute("SELECT entity_id, product_id FROM products WHERE state IN (?, ?, ?)", IN_FLIGHT)
+        else:
+            rows = self.execute("SELECT entity_id, product_id FROM products WHERE page < ? AND state IN (?, ?, ?)",
+                                (page,) + IN_FLIGHT)
+        return [{'entityId': entity_id, 'productId': product_id} for entity_id, product_id in rows]
+
+    # downloadIds of downloads requested but not finished
+    def in_flight_download_ids(self):
+        rows = self.execute("SELECT download_id FROM products WHERE download_id IS NOT NULL AND state IN (?, ?, ?)",
+                            IN_FLIGHT)
+        return set(row[0] for row in rows)
+
+    # fold the products of the journal at path into this one (e.g. the journals of the shards of
+    # one job); a product in both keeps the record that is further along. pages aren't merged,
+    # since page numbers only mean something within the search that wrote them
+    def merge(self, path):
+        other = sqlite3.connect(path)
+        try:
+            columns = [row[1] for row in other.execute("PRAGMA table_info(products)")]
+            rows = other.execute("SELECT {} FROM products".format(', '.join(columns))).fetchall()
+        finally:
+            other.close()
+        rank = dict((state, i) for i, state in enumerate(ORDER))
+        insert = "INSERT OR REPLACE INTO products ({}) VALUES ({})".format(', '.join(columns), ', '.join('?' * len(columns)))
+        with self.lock, self.db:
+            for row in rows:
+                record = dict(zip(columns, row))
+                current = self.db.execute("SELECT state FROM products WHERE entity_id = ? AND product_id = ?",
+                                          (record['entity_id'], record['product_id'])).fetchone()
+                if current is None or rank.get(record['state'], 0) > rank.get(current[0], 0):
+                    self.db.execute(insert, row)
+
+    # product count per state
+    def summary(self):
+        return dict(self.execute("SELECT state, COUNT(*) FROM products GROUP BY state"))
+
+    # (product count, total filesize) per state
+    def progress(self):
+        rows = self.execute("SELECT state, COUNT(*), COALESCE(SUM(filesize), 0) FROM products GROUP BY state")
+        return dict((state, (count, size)) for state, count, size in rows)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
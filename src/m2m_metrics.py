@@ -0,0 +1,291 @@
+# =============================================================================
+#
+# run metrics used by m2m_transfer.py
+#
+# every stage records into one Metrics object: api call latency and retries
+# per endpoint, time from download-request to available per download, bytes
+# downloaded and uploaded, s3 call latency, per-file transfer time and the
+# depth of the queues between stages. the numbers can be appended to a file
+# as periodic json snapshots and served as prometheus text, so a long run
+# shows where its time goes while it is still going
+#
+# imports======================================================================
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# =============================================================================
+
+# upper bounds, in seconds, of the buckets every timing is counted into
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+
+class Timing(object):
+    # count, total, max and bucket counts of one timed thing
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # observations per bucket, plus one for anything over the last bound
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    # seconds that about fraction of the observations fall under, to bucket precision
+    def quantile(self, fraction):
+        seen = 0
+        for i, count in enumerate(self.buckets[:-1]):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(BUCKETS[i], self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'max': self.max
+            }
+
+
+class Metrics(object):
+    def __init__(self):
+        # counters and timings are keyed by (name, labels), labels being a sorted tuple of
+        # (label, value) pairs, e.g. ('api_seconds', (('endpoint', 'scene-search'),))
+        self.counters = {}
+        self.timings = {}
+        # gauges are either set by a stage or read from a function when a snapshot is taken
+        self.values = {}
+        self.functions = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    # add amount to a counter, e.g. add('download_bytes', len(chunk))
+    def add(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    # a counter summed over all its labels
+    def total(self, name):
+        with self.lock:
+            return sum(value for key, value in self.counters.items() if key[0] == name)
+
+    # record one duration in seconds
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = Timing()
+            timing.observe(seconds)
+
+    # time the body of a with block
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    # set a gauge to its current value
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    # read a gauge from func() whenever a snapshot is taken, e.g. a queue's qsize
+    def gauge(self, name, func):
+        with self.lock:
+            self.functions[name] = func
+
+    def snapshot(self, previous=None):
+        """
+        Current state of every metric
+        :param previous: an earlier snapshot to work out recent rates from, if any
+        :return: json-ready dict of counters, timing summaries, gauges, and MB/s for every
+                 *_bytes counter over the whole run and (with previous) since previous
+        """
+        now = time.time()
+        with self.lock:
+            counters = dict(self.counters)
+            timings = dict((key, timing.summary()) for key, timing in self.timings.items())
+            gauges = dict(self.values)
+            functions = dict(self.functions)
+        for name, func in functions.items():
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                gauges[name] = str(e)
+        rates = {}
+        for key, value in counters.items():
+            if key[0].endswith('_bytes'):
+                rate = {'mb_per_s': value / 1024 ** 2 / max(now - self.started, 1e-9)}
+                if previous is not None and now > previous['time']:
+                    rate['recent_mb_per_s'] = ((value - previous['counters'].get(key_name(key), 0)) / 1024 ** 2
+                                               / (now - previous['time']))
+                rates[key_name(key)] = rate
+        return {
+            'time': now,
+            'elapsed': now - self.started,
+            'counters': dict((key_name(key), value) for key, value in counters.items()),
+            'timings': dict((key_name(key), summary) for key, summary in timings.items()),
+            'gauges': gauges,
+            'rates': rates
+            }
+
+    # every metric in the prometheus text exposition format, names prefixed with m2m_
+    def prometheus(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timings = sorted((key, timing.count, timing.total, list(timing.buckets))
+                             for key, timing in self.timings.items())
+            gauges = dict(self.values)
+            functions = dict(self.functions)
+        for name, func in functions.items():
+            try:
+                gauges[name] = func()
+            except Exception:
+                pass
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            metric = 'm2m_{}_total'.format(name)
+            if metric not in typed:
+                lines.append('# TYPE {} counter'.format(metric))
+                typed.add(metric)
+            lines.append('{}{} {}'.format(metric, label_text(labels), value))
+        for (name, labels), count, total, buckets in timings:
+            metric = 'm2m_{}'.format(name)
+            if metric not in typed:
+                lines.append('# TYPE {} histogram'.format(metric))
+                typed.add(metric)
+            seen = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                seen += bucket
+                lines.append('{}_bucket{} {}'.format(metric, label_text(labels + (('le', str(bound)),)), seen))
+            lines.append('{}_bucket{} {}'.format(metric, label_text(labels + (('le', '+Inf'),)), count))
+            lines.append('{}_sum{} {}'.format(metric, label_text(labels), total))
+            lines.append('{}_count{} {}'.format(metric, label_text(labels), count))
+        for name, value in sorted(gauges.items()):
+            if isinstance(value, (int, float)):
+                lines.append('# TYPE m2m_{} gauge'.format(name))
+                lines.append('m2m_{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    # one line per timing and byte counter, for the end of run report
+    def summary(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, timing in sorted(snapshot['timings'].items()):
+            lines.append('{}: {} times, mean {:.2f} s, p95 {:.2f} s, max {:.2f} s'.format(
+                name, timing['count'], timing['mean'], timing['p95'], timing['max']))
+        for name, value in sorted(snapshot['counters'].items()):
+            if name in snapshot['rates']:
+                lines.append('{}: {:.1f} MB, {:.1f} MB/s'.format(name, value / 1024 ** 2, snapshot['rates'][name]['mb_per_s']))
+            else:
+                lines.append('{}: {}'.format(name, value))
+        return lines
+
+
+# 'name' or 'name{label=value,...}'
+def key_name(key):
+    name, labels = key
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}={}'.format(label, value) for label, value in labels))
+
+# prometheus label set, e.g. {endpoint="scene-search"}
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                                   .replace('\n', '\\n')) for label, value in labels))
+
+
+class SnapshotWriter(object):
+    def __init__(self, metrics, path, interval=60):
+        """
+        Append a json snapshot of metrics to path every interval seconds, one per line
+        :param metrics: Metrics to snapshot
+        :param path: file to append to; each line is one json object
+        :param interval: seconds between snapshots
+        """
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        # the last snapshot written, so each one carries the rates since the one before it
+        self.last = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, name='metrics-snapshots', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        self.last = self.metrics.snapshot(self.last)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(self.last, default=str) + '\n')
+
+    # stop the thread and write one last snapshot
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # /metrics is prometheus text, anything else the json snapshot
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body = self.server.metrics.prometheus().encode()
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            body = json.dumps(self.server.metrics.snapshot(), default=str).encode()
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(object):
+    def __init__(self, metrics, port, host=''):
+        """
+        Serve metrics over http on a background thread: GET /metrics for prometheus
+        :param port: port to listen on; 0 picks a free one
+        :param host: address to listen on; '' is every interface
+        """
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.metrics = metrics
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print('serving metrics on http://{}:{}/metrics'.format(*self.server.server_address))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,192 @@
+# =============================================================================
+#
+# transfer plans: the products a transfer would move, worked out without
+# requesting anything
+#
+# M2MTransfer.plan() walks every scene-search page, selects products from
+# download-options as a real run would and writes them here with their
+# totals, the time the job would take at a given bandwidth and what it would
+# add to s3. the plan file can be reviewed, split into parts for separate
+# machines, and handed back to M2MTransfer (plan_path) to transfer exactly
+# those products
+#
+# usage (from src/):
+#   python m2m_plan.py ./texas_naip_2020_plan.json --bandwidth 50
+#   python m2m_plan.py ./texas_naip_2020_plan.json --split 4
+#
+# imports======================================================================
+
+import argparse
+import json
+import os
+import threading
+import time
+
+# =============================================================================
+
+# fields of each planned product, as written to the plan file
+FIELDS = ('entityId', 'productId', 'displayId', 'productCode', 'filesize', 'page')
+
+
+class TransferPlan(object):
+    def __init__(self, dataset=None, label=None, spatial_filter=None, temporal_filter=None, products=None,
+                 total_hits=None, scene_count=0, page_count=0, skipped=None, created=None):
+        """
+        :param products: planned products, dicts of FIELDS
+        :param total_hits: totalHits of the scene search
+        :param scene_count: scenes searched through
+        :param skipped: {reason: [count, bytes]} of selected products left out of the plan
+        """
+        self.dataset = dataset
+        self.label = label
+        self.spatial_filter = spatial_filter
+        self.temporal_filter = temporal_filter
+        self.products = products or []
+        self.total_hits = total_hits
+        self.scene_count = scene_count
+        self.page_count = page_count
+        self.skipped = skipped or {}
+        self.created = created or time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.lock = threading.Lock()
+
+    # record one selected download-options product; skipped is why it won't be transferred
+    # (e.g. 'finished' or 'exists'), None to plan it
+    def add(self, page, product, skipped=None):
+        with self.lock:
+            if skipped is not None:
+                count, size = self.skipped.get(skipped, (0, 0))
+                self.skipped[skipped] = [count + 1, size + (product.get('filesize') or 0)]
+                return
+            self.products.append({
+                'entityId': product['entityId'],
+                'productId': product['id'],
+                'displayId': product.get('displayId'),
+                'productCode': product.get('productCode'),
+                'filesize': product.get('filesize'),
+                'page': page
+                })
+
+    @property
+    def size(self):
+        return sum(product['filesize'] or 0 for product in self.products)
+
+    def pages(self):
+        """
+        Planned products page by page, in the order they were searched
+        :return: list of (page, products) with each product shaped like a download-options
+                 entry ('id' for productId), ready for the journal and product checks
+        """
+        pages = []
+        for product in self.products:
+            if not pages or pages[-1][0] != product['page']:
+                pages.append((product['page'], []))
+            pages[-1][1].append(dict(product, id=product['productId']))
+        return pages
+
+    def totals(self, bandwidth=None):
+        """
+        Summary numbers of the plan
+        :param bandwidth: sustained MB/s to estimate the transfer time at, if any
+        :return: dict of products, bytes (also what the job adds to s3), scenes, pages,
+                 skipped products and the estimated seconds
+        """
+        size = self.size
+        totals = {
+            'products': len(self.products),
+            'bytes': size,
+            'gb': size / 1024 ** 3,
+            's3_bytes': size,
+            'largest_bytes': max([product['filesize'] or 0 for product in self.products] or [0]),
+            'total_hits': self.total_hits,
+            'scenes': self.scene_count,
+            'pages': self.page_count,
+            'skipped': self.skipped
+            }
+        if bandwidth:
+            totals['bandwidth_mb_per_s'] = bandwidth
+            totals['estimated_seconds'] = size / (bandwidth * 1024 ** 2)
+        return totals
+
+    # lines for the end of a dry run, or for the command line
+    def summary(self, bandwidth=None):
+        totals = self.totals(bandwidth)
+        lines = [
+            'PLANNED PRODUCTS: {}'.format(totals['products']),
+            'PLANNED SIZE: {:.2f} GB (largest file {:.1f} MB)'.format(totals['gb'], totals['largest_bytes'] / 1024 ** 2),
+            'SCENES SEARCHED: {} of {} in {} pages'.format(totals['scenes'], totals['total_hits'], totals['pages']),
+            'S3 FOOTPRINT: {:.2f} GB added'.format(totals['s3_bytes'] / 1024 ** 3)
+            ]
+        for reason, (count, size) in sorted(self.skipped.items()):
+            lines.append('LEFT OUT ({}): {} products, {:.2f} GB'.format(reason, count, size / 1024 ** 3))
+        if bandwidth:
+            lines.append('ESTIMATED TRANSFER TIME: {:.1f} hours at {} MB/s'.format(
+                totals['estimated_seconds'] / 3600, bandwidth))
+        return lines
+
+    def write(self, path, bandwidth=None):
+        plan = {
+            'created': self.created,
+            'dataset': self.dataset,
+            'label': self.label,
+            'spatial_filter': self.spatial_filter,
+            'temporal_filter': self.temporal_filter,
+            'totals': self.totals(bandwidth),
+            'products': self.products
+            }
+        # written under a temporary name and renamed, so a reader never sees half a plan
+        with open(path + '.tmp', 'w') as f:
+            json.dump(plan, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            plan = json.load(f)
+        totals = plan.get('totals', {})
+        return cls(dataset=plan.get('dataset'), label=plan.get('label'), spatial_filter=plan.get('spatial_filter'),
+                   temporal_filter=plan.get('temporal_filter'), products=plan['products'],
+                   total_hits=totals.get('total_hits'), scene_count=totals.get('scenes', 0),
+                   page_count=totals.get('pages', 0), skipped=totals.get('skipped'), created=plan.get('created'))
+
+    def split(self, parts):
+        """
+        Split the plan into parts of about the same size, keeping each page whole
+        :return: list of up to parts TransferPlans
+        """
+        pages = self.pages()
+        target = self.size / parts
+        plans, products, size = [], [], 0
+        for i, (page, page_products) in enumerate(pages):
+            products.extend(dict((field, product[field]) for field in FIELDS) for product in page_products)
+            size += sum(product['filesize'] or 0 for product in page_products)
+            # close a part once the running size reaches its share; the last part takes the rest
+            if (size >= target * (len(plans) + 1) and len(plans) < parts - 1) or i == len(pages) - 1:
+                plans.append(TransferPlan(dataset=self.dataset, label=self.label, spatial_filter=self.spatial_filter,
+                                          temporal_filter=self.temporal_filter, products=products,
+                                          total_hits=self.total_hits, created=self.created,
+                                          page_count=len(set(product['page'] for product in products))))
+                products = []
+        return plans
+
+
+# file name of part number of parts, e.g. plan.json -> plan_part1of4.json
+def part_path(path, number, parts):
+    stem, extension = os.path.splitext(path)
+    return '{}_part{}of{}{}'.format(stem, number, parts, extension or '.json')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='summarize or split a plan written by M2MTransfer.plan()')
+    parser.add_argument('plan')
+    parser.add_argument('--bandwidth', type=float, default=None, help='MB/s to estimate the transfer time at')
+    parser.add_argument('--split', type=int, default=None, help='write the plan out as this many parts')
+    args = parser.parse_args()
+
+    plan = TransferPlan.load(args.plan)
+    for line in plan.summary(args.bandwidth):
+        print(line)
+    if args.split:
+        for number, part in enumerate(plan.split(args.split), 1):
+            path = part_path(args.plan, number, args.split)
+            part.write(path, args.bandwidth)
+            print('{}: {} products, {:.2f} GB'.format(path, len(part.products), part.size / 1024 ** 3))
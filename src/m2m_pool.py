@@ -0,0 +1,120 @@
+# =============================================================================
+#
+# bounded download/upload worker pool used by m2m_transfer.py
+#
+# downloads and uploads run on separate groups of threads joined by bounded
+# queues, so a slow stage blocks the stage feeding it (backpressure) instead
+# of piling up files in the staging area
+#
+# imports======================================================================
+
+import queue
+import threading
+
+# =============================================================================
+
+# sentinel put on a queue to stop one worker
+_STOP = object()
+
+
+class StagedFile(object):
+    # a downloaded file handed from the download stage to the upload stage. only the
+    # upload worker that takes it off the queue touches path, and removes it when done
+    def __init__(self, path, file_name, download, checksum=None, content_length=None, reserved=0):
+        """
+        :param path: local file, named uniquely for this download
+        :param file_name: file name from Content-Disposition, used for the s3 key
+        :param download: the download-retrieve record it came from
+        :param checksum: StreamChecksum taken while it was written, if any
+        :param content_length: Content-Length the server sent for it
+        :param reserved: staging bytes reserved for it, released once it is removed
+        """
+        self.path = path
+        self.file_name = file_name
+        self.download = download
+        self.checksum = checksum
+        self.content_length = content_length
+        self.reserved = reserved
+
+    def __repr__(self):
+        return 'StagedFile({!r})'.format(self.file_name)
+
+
+class TransferPool(object):
+    def __init__(self, download_func, upload_func, download_workers=4, upload_workers=2, queue_size=None):
+        """
+        Start the download and upload worker threads
+        :param download_func: called with each submitted item on a download worker; its return
+                              value is handed to the upload stage unless it is None
+        :param upload_func: called with each download result on an upload worker
+        :param download_workers: number of concurrent downloads
+        :param upload_workers: number of concurrent uploads
+        :param queue_size: max items waiting on each stage; defaults to the stage's worker count
+        """
+        self.download_func = download_func
+        self.upload_func = upload_func
+        self.download_queue = queue.Queue(maxsize=queue_size or download_workers)
+        self.upload_queue = queue.Queue(maxsize=queue_size or upload_workers)
+        self.failed = []
+        self.failed_lock = threading.Lock()
+        self.download_threads = [self.start_worker(self.download_worker, 'download-{}'.format(i))
+                                 for i in range(download_workers)]
+        self.upload_threads = [self.start_worker(self.upload_worker, 'upload-{}'.format(i))
+                               for i in range(upload_workers)]
+
+    def start_worker(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    # queue an item for download; blocks while the download stage is full
+    def submit(self, item):
+        self.download_queue.put(item)
+
+    # wait until every submitted item has been downloaded and uploaded;
+    # used at the end of each page before moving on
+    def join(self):
+        self.download_queue.join()
+        self.upload_queue.join()
+
+    # stop all workers once the queues have drained
+    def close(self):
+        self.join()
+        for thread in self.download_threads:
+            self.download_queue.put(_STOP)
+        for thread in self.upload_threads:
+            self.upload_queue.put(_STOP)
+        for thread in self.download_threads + self.upload_threads:
+            thread.join()
+
+    def record_failure(self, item, error):
+        print('worker failed on {}: {}'.format(item, error))
+        with self.failed_lock:
+            self.failed.append((item, error))
+
+    def download_worker(self):
+        while True:
+            item = self.download_queue.get()
+            try:
+                if item is _STOP:
+                    return
+                result = self.download_func(item)
+                if result is not None:
+                    # blocks while the upload stage is full
+                    self.upload_queue.put(result)
+            except Exception as e:
+                self.record_failure(item, e)
+            finally:
+                self.download_queue.task_done()
+
+    def upload_worker(self):
+        while True:
+            result = self.upload_queue.get()
+            try:
+                if result is _STOP:
+                    return
+                self.upload_func(result)
+            except Exception as e:
+                self.record_failure(result, e)
+            finally:
+                self.upload_queue.task_done()
@@ -0,0 +1,48 @@
+# =============================================================================
+#
+# product selection for download-options results used by m2m_transfer.py
+#
+# products are chosen before download-request so unwanted ones (e.g. the
+# NAIP "Compressed" zip next to every "Full Resolution" jp2) are never
+# staged by usgs or fetched
+#
+# imports======================================================================
+
+# =============================================================================
+
+class ProductSelector(object):
+    def __init__(self, product_codes=None, product_names=None, bulk_only=False, include_secondary=False):
+        """
+        :param product_codes: productCodes to keep, e.g. ['D441'] for NAIP Full Resolution; None keeps any
+        :param product_names: productNames to keep, e.g. ['Full Resolution']; None keeps any
+        :param bulk_only: keep only products with bulkAvailable set
+        :param include_secondary: also consider each product's secondaryDownloads
+        """
+        self.product_codes = set(product_codes) if product_codes else None
+        self.product_names = set(product_names) if product_names else None
+        self.bulk_only = bulk_only
+        self.include_secondary = include_secondary
+
+    # True if a single download-options product should be requested
+    def wanted(self, product):
+        if not product.get('available', True):
+            return False
+        if self.product_codes is not None and product.get('productCode') not in self.product_codes:
+            return False
+        if self.product_names is not None and product.get('productName') not in self.product_names:
+            return False
+        if self.bulk_only and not product.get('bulkAvailable'):
+            return False
+        return True
+
+    # the wanted products out of a download-options response
+    def select(self, products):
+        selected = []
+        for product in products:
+            if self.wanted(product):
+                selected.append(product)
+            if self.include_secondary:
+                for secondary in product.get('secondaryDownloads') or []:
+                    if self.wanted(secondary):
+                        selected.append(secondary)
+        return selected
@@ -0,0 +1,172 @@
+# =============================================================================
+#
+# progress and eta reporting used by m2m_transfer.py
+#
+# the journal holds every selected product with its filesize and state, so
+# bytes planned and bytes finished come from one query. until every
+# scene-search page has been fetched, the planned total is extrapolated from
+# the share of totalHits searched so far. the eta divides what is left by the
+# rate bytes were transferred over a rolling window, so it follows the run's
+# recent speed rather than its average. products found in s3 already or
+# skipped count as finished but never as transferred, so an incremental
+# re-run doesn't report their bytes as throughput. one line is printed every interval, and only
+# when something moved (or as a heartbeat every few intervals)
+#
+# imports======================================================================
+
+import collections
+import json
+import os
+import threading
+import time
+
+import m2m_journal
+
+# =============================================================================
+
+class ProgressReporter(object):
+    def __init__(self, journal, interval=60, path=None, window=900, failed=None, transferred=None, heartbeat=10):
+        """
+        :param journal: TransferJournal of the run
+        :param interval: seconds between progress checks; None prints nothing (path is still written)
+        :param path: file rewritten with the latest progress as json at every check, if given
+        :param window: seconds of history the rate behind the eta is taken over
+        :param failed: function returning the number of failed transfers, if any
+        :param transferred: function returning the bytes this run has moved (e.g. uploaded to s3),
+                            for the rate; None takes the rate from the bytes finished instead
+        :param heartbeat: print at least every this many checks, even if nothing moved
+        """
+        self.journal = journal
+        self.interval = interval
+        self.path = path
+        self.window = window
+        self.failed = failed
+        self.transferred = transferred
+        self.heartbeat = heartbeat
+        self.total_hits = None
+        self.searched_through = 0
+        self.started = time.time()
+        # (time, bytes transferred) samples over the last window seconds
+        self.samples = collections.deque()
+        self.status = {}
+        self.printed = None
+        self.quiet_checks = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, name='progress', daemon=True)
+
+    # record a scene-search page: totalHits and the last record number it covered
+    def searched(self, total_hits, searched_through):
+        with self.lock:
+            self.total_hits = total_hits
+            self.searched_through = max(self.searched_through, searched_through)
+
+    def start(self):
+        self.thread.start()
+
+    def loop(self):
+        while not self.stopped.wait(self.interval or 60):
+            self.check()
+
+    # work out progress, print it if it moved and write it to path
+    def check(self, force=False):
+        status = self.progress()
+        line = format_status(status)
+        # the counts and bytes, without the rate and eta, decide whether anything moved
+        moved = (status['states'], status['done_bytes']) != self.printed
+        self.quiet_checks = 0 if moved else self.quiet_checks + 1
+        if self.interval and (force or moved or self.quiet_checks >= self.heartbeat):
+            print(line)
+            self.printed = (status['states'], status['done_bytes'])
+            self.quiet_checks = 0
+        if self.path:
+            # replaced in one step, so a reader never sees half a file
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(status, f, indent=2)
+            os.replace(self.path + '.tmp', self.path)
+        return status
+
+    def progress(self):
+        """
+        Current progress of the run
+        :return: dict of product counts per state, bytes planned (extrapolated to the whole
+                 search while pages remain), finished and transferred, the rolling rate and the eta
+        """
+        now = time.time()
+        states = self.journal.progress()
+        with self.lock:
+            total_hits, searched_through = self.total_hits, self.searched_through
+        counts = dict((state, count) for state, (count, size) in states.items())
+        known_bytes = sum(size for count, size in states.values())
+        done_bytes = sum(states.get(state, (0, 0))[1] for state in m2m_journal.FINISHED)
+        planned_bytes = known_bytes
+        if total_hits and 0 < searched_through < total_hits:
+            planned_bytes = known_bytes * total_hits / searched_through
+        transferred_bytes = self.transferred() if self.transferred else done_bytes
+        self.samples.append((now, transferred_bytes))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+        first_time, first_bytes = self.samples[0]
+        rate = (transferred_bytes - first_bytes) / (now - first_time) if now > first_time else 0
+        remaining = max(planned_bytes - done_bytes, 0)
+        eta = remaining / rate if rate > 0 else None
+        status = {
+            'time': now,
+            'elapsed': now - self.started,
+            'total_hits': total_hits,
+            'searched_through': searched_through,
+            'states': counts,
+            'failed': self.failed() if self.failed else 0,
+            'known_bytes': known_bytes,
+            'planned_bytes': planned_bytes,
+            'planned_estimated': planned_bytes != known_bytes,
+            'done_bytes': done_bytes,
+            'transferred_bytes': transferred_bytes,
+            'bytes_per_second': rate,
+            'eta_seconds': eta,
+            'finish_time': now + eta if eta is not None else None
+            }
+        self.status = status
+        return status
+
+    # stop checking and report once more
+    def stop(self):
+        self.cancel()
+        if self.interval or self.path:
+            return self.check(force=True)
+
+    # stop checking without reporting, e.g. when the run failed
+    def cancel(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+# one progress line, e.g.
+# PROGRESS: 1200/5000 scenes | uploaded 900, requested 80 ... | 120.5 of ~480.0 GB (25.1%) | 35.2 MB/s | ETA 2d 03:12 (Sat 14:05)
+def format_status(status):
+    scenes = 'scenes not searched yet'
+    if status['total_hits'] is not None:
+        scenes = '{}/{} scenes'.format(status['searched_through'], status['total_hits'])
+    states = ', '.join('{} {}'.format(state, status['states'][state])
+                       for state in m2m_journal.ORDER if status['states'].get(state))
+    if status['failed']:
+        states += ', failed {}'.format(status['failed'])
+    planned = status['planned_bytes']
+    percent = 100.0 * status['done_bytes'] / planned if planned else 0
+    size = '{:.1f} of {}{:.1f} GB ({:.1f}%)'.format(status['done_bytes'] / 1024 ** 3,
+                                                  '~' if status['planned_estimated'] else '',
+                                                  planned / 1024 ** 3, percent)
+    eta = 'ETA unknown'
+    if status['eta_seconds'] is not None:
+        eta = 'ETA {} ({})'.format(format_duration(status['eta_seconds']),
+                                   time.strftime('%a %H:%M', time.localtime(status['finish_time'])))
+    return 'PROGRESS: {} | {} | {} | {:.1f} MB/s | {}'.format(
+        scenes, states or 'no products yet', size, status['bytes_per_second'] / 1024 ** 2, eta)
+
+# seconds as e.g. 2d 03:12 or 00:05
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    text = '{:02d}:{:02d}'.format(minutes // 60, minutes % 60)
+    return '{}d {}'.format(days, text) if days else text
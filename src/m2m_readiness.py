@@ -0,0 +1,167 @@
+# =============================================================================
+#
+# readiness tracking for download-request results used by m2m_transfer.py
+#
+# every requested download is kept in a dict keyed by downloadId until a
+# download-retrieve poll reports it available, at which point it is handed
+# back once (and only once) so it can start downloading right away.
+# products download-request reports as duplicates (already requested, e.g.
+# by a run that died) get no new downloadId, so they are waited for by
+# entityId and productCode instead.
+# polling backs off while nothing new turns up and speeds up again as soon
+# as something does
+#
+# RetrieveLoop makes the decisions of one page's download-retrieve loop
+# (which download-request batches are back, whether to poll, when to give up
+# and how long to wait), so the threaded and asyncio engines only supply the
+# calls that block or await
+#
+# imports======================================================================
+
+import time
+
+# =============================================================================
+
+class ReadinessTracker(object):
+    def __init__(self, min_wait=2, max_wait=60, backoff=1.5, timeout=None, metrics=None):
+        """
+        :param min_wait: seconds between polls while downloads keep turning available
+        :param max_wait: longest wait between polls while nothing changes
+        :param backoff: factor the wait grows by after a poll with nothing new
+        :param timeout: seconds to wait for the slowest download before giving up on it; None waits forever
+        :param metrics: Metrics to record each download's time from add to ready in, and the pending count
+        """
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.backoff = backoff
+        self.timeout = timeout
+        self.wait_time = min_wait
+        self.started = time.time()
+        # downloadId -> download record for everything not yet available
+        self.pending = {}
+        # downloadIds already handed out
+        self.dispatched = set()
+        # downloadId -> time it was added, for time to ready
+        self.added = {}
+        # (entityId, productCode) of products that may be duplicates, and how many duplicates
+        # are still to turn up in download-retrieve
+        self.products = set()
+        self.duplicates = 0
+        self.metrics = metrics
+
+    # start tracking downloads (e.g. download-request preparingDownloads)
+    def add(self, downloads):
+        for download in downloads or []:
+            if download['downloadId'] not in self.dispatched:
+                self.pending[download['downloadId']] = download
+                self.added.setdefault(download['downloadId'], time.time())
+        if self.metrics is not None:
+            self.metrics.set('preparing', len(self.pending))
+
+    # wait for count duplicateProducts of a download-request; products is the (entityId,
+    # productCode) of every product of the request that could be one of them
+    def expect(self, products, count):
+        self.products.update(products)
+        self.duplicates += count
+
+    # downloads and duplicates still to turn available
+    def outstanding(self):
+        return len(self.pending) + self.duplicates
+
+    # stop waiting; returns the downloads, and the products that may be the duplicates,
+    # that never turned available
+    def give_up(self):
+        missing = list(self.pending.values())
+        if self.duplicates:
+            missing.extend({'entityId': entity_id, 'productCode': product_code}
+                           for entity_id, product_code in sorted(self.products, key=str))
+        self.pending.clear()
+        self.products.clear()
+        self.duplicates = 0
+        return missing
+
+    # return tracked downloads and duplicates that are newly available; records from
+    # other requests under the same label are ignored
+    def ready(self, available):
+        ready = []
+        for download in available or []:
+            product = (download.get('entityId'), download.get('productCode'))
+            if self.pending.pop(download['downloadId'], None) is not None:
+                self.products.discard(product)
+            elif self.duplicates and product in self.products and download['downloadId'] not in self.dispatched:
+                self.products.discard(product)
+                self.duplicates -= 1
+            else:
+                continue
+            self.dispatched.add(download['downloadId'])
+            ready.append(download)
+            added = self.added.pop(download['downloadId'], None)
+            if self.metrics is not None and added is not None:
+                self.metrics.observe('time_to_ready_seconds', time.time() - added)
+        if self.metrics is not None:
+            self.metrics.set('preparing', len(self.pending))
+        # back off only while polls keep coming back with nothing new
+        if ready:
+            self.wait_time = self.min_wait
+        else:
+            self.wait_time = min(self.wait_time * self.backoff, self.max_wait)
+        return ready
+
+    # sleep until the next poll
+    def wait(self):
+        time.sleep(self.wait_time)
+
+    # True once the timeout has passed with downloads still pending
+    def expired(self):
+        return self.timeout is not None and time.time() - self.started > self.timeout
+
+
+class RetrieveLoop(object):
+    def __init__(self, tracker, submitted, track, unavailable):
+        """
+        :param tracker: ReadinessTracker for the page
+        :param submitted: futures of the page's download-request batches, each giving (batch, request);
+                          concurrent.futures and asyncio futures both work
+        :param track: track(tracker, batch, request) starts tracking a batch that came back and
+                      returns its availableDownloads (M2MTransfer.track_request)
+        :param unavailable: list the downloads given up on are added to
+        """
+        self.tracker = tracker
+        self.track = track
+        self.unavailable = unavailable
+        # batches not back yet, and availableDownloads of batches back since the last poll
+        self.waiting = set(submitted)
+        self.available = []
+
+    # pick up the batches that came back; True if download-retrieve should be polled now
+    def collect(self):
+        for future in [future for future in self.waiting if future.done()]:
+            self.waiting.discard(future)
+            self.available.extend(self.track(self.tracker, *future.result()))
+        return bool(self.tracker.outstanding())
+
+    # downloads to dispatch from a download-retrieve response
+    def ready(self, retrieve):
+        # one ready() per poll, so the backoff sees the whole poll; anything
+        # download-request called available but retrieve didn't list goes as-is
+        ready = self.tracker.ready((retrieve['available'] or []) + self.available)
+        self.available = []
+        return ready
+
+    # False once every batch is back and nothing is outstanding; downloads still outstanding
+    # past the tracker's timeout are given up on here
+    def active(self):
+        if self.tracker.outstanding() and self.tracker.expired():
+            print('giving up on {} downloads that never became available'.format(self.tracker.outstanding()))
+            self.unavailable.extend(self.tracker.give_up())
+        return bool(self.waiting or self.tracker.outstanding())
+
+    # seconds to wait before the next step; a batch coming back ends the wait early, and
+    # None waits for one with nothing to poll for meanwhile
+    def wait_time(self):
+        if not self.tracker.outstanding():
+            return None
+        if not self.waiting:
+            print(self.tracker.outstanding(), "downloads are not available. waiting for {:.0f} seconds...\n".format(
+                self.tracker.wait_time))
+        return self.tracker.wait_time
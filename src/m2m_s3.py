@@ -0,0 +1,237 @@
+# =============================================================================
+#
+# long-lived s3 uploader used by m2m_transfer.py
+#
+# one boto3 client and one s3transfer TransferManager are created per run and
+# shared by every worker; both are thread-safe, so uploads no longer pay for
+# credential resolution and a fresh connection pool on every file
+#
+# imports======================================================================
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from s3transfer.manager import TransferManager
+
+from m2m_downloader import split_ranges
+
+# =============================================================================
+
+# server-side encryption under which s3 ETags aren't made from the md5 of the data
+KMS_ENCRYPTION = ('aws:kms', 'aws:kms:dsse')
+
+
+class S3Uploader(object):
+    def __init__(self, multipart_threshold=32 * 1024 * 1024, multipart_chunksize=32 * 1024 * 1024,
+                 max_concurrency=10, max_pool_connections=None, endpoint_url=None, metrics=None):
+        """
+        Create the shared s3 client and transfer manager
+        :param multipart_threshold: files at least this size (bytes) are sent as multipart uploads
+        :param multipart_chunksize: part size (bytes) for multipart file uploads
+        :param max_concurrency: part uploads in flight across all files sharing this uploader
+        :param max_pool_connections: http connections kept by the client; defaults to max_concurrency
+        :param endpoint_url: url of an s3-compatible store (minio, the benchmark stand-in) to use instead of aws
+        :param metrics: Metrics to record s3 call latency and bytes uploaded in
+        """
+        config = Config(max_pool_connections=max_pool_connections or max_concurrency)
+        if endpoint_url:
+            # buckets on a local or self-hosted store are addressed by path, not by hostname
+            config = config.merge(Config(s3={'addressing_style': 'path'}))
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, config=config)
+        self.config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize,
+                                     max_concurrency=max_concurrency, use_threads=True)
+        self.manager = TransferManager(self.client, self.config)
+        self.metrics = metrics
+        if metrics is not None:
+            # every call on the client is timed, whichever part of the code makes it
+            self.client.meta.events.register('before-parameter-build.s3', self.call_started)
+            self.client.meta.events.register('after-call.s3', self.call_finished)
+
+    # botocore event handlers timing each s3 call; put_object and upload_part bodies count as uploaded
+    def call_started(self, params, context, **kwargs):
+        body = params.get('Body')
+        context['m2m_started'] = time.perf_counter()
+        context['m2m_bytes'] = body_size(body)
+
+    def call_finished(self, model, context, **kwargs):
+        if 'm2m_started' not in context:
+            return
+        self.metrics.observe('s3_seconds', time.perf_counter() - context['m2m_started'], operation=model.name)
+        if model.name in ('PutObject', 'UploadPart') and context['m2m_bytes']:
+            self.metrics.add('upload_bytes', context['m2m_bytes'])
+
+    def upload_file(self, file_name, bucket, object_name):
+        """
+        Upload a local file to an S3 bucket
+        :param file_name: File to upload
+        :param bucket: Bucket to upload to
+        :param object_name: S3 object name
+        :return: True once the file is uploaded; a failed upload raises (e.g. botocore's ClientError)
+        """
+        self.manager.upload(file_name, bucket, object_name).result()
+        return True
+
+    def upload_stream(self, chunks, bucket, object_name, part_size):
+        """
+        Upload an iterable of byte chunks as a multipart upload without touching disk
+        :param chunks: iterable of bytes, e.g. a requests response's iter_content()
+        :param bucket: Bucket to upload to
+        :param object_name: S3 object name
+        :param part_size: bytes per part, held in memory until sent; every part but the last is exactly this size
+        :return: the complete_multipart_upload response (ETag, ServerSideEncryption); a failed upload
+                 is aborted and its error raised
+        """
+        upload = MultipartUpload(self.client, bucket, object_name)
+        try:
+            send_parts(upload, chunks, part_size, 1)
+            # an empty body still needs one part
+            if not upload.parts:
+                upload.upload_part(b'', 1)
+            return upload.complete()
+        except BaseException:
+            # s3 or the download side gave up; don't leave the parts behind
+            upload.abort()
+            raise
+
+    def upload_ranges(self, read_range, size, bucket, object_name, part_size, segments):
+        """
+        Upload size bytes as a multipart upload fed by segments parallel readers; each reader
+        covers a run of whole parts, so only segments * part_size bytes are buffered at once
+        :param read_range: read_range(start, end) returns an iterable of the bytes in [start, end)
+        :param size: total bytes
+        :param bucket: Bucket to upload to
+        :param object_name: S3 object name
+        :param part_size: bytes per part; every part but the last is exactly this size
+        :param segments: number of parallel readers
+        :return: the complete_multipart_upload response (ETag, ServerSideEncryption); a failed upload
+                 is aborted and its error raised
+        """
+        upload = MultipartUpload(self.client, bucket, object_name)
+        try:
+            with ThreadPoolExecutor(max_workers=segments) as executor:
+                futures = [executor.submit(send_parts, upload, read_range(start, end), part_size, start // part_size + 1)
+                           for start, end in split_ranges(size, segments, part_size)]
+                for future in futures:
+                    future.result()
+            return upload.complete()
+        except BaseException:
+            upload.abort()
+            raise
+
+    # head_object response (ETag, ServerSideEncryption) of an existing object, without reading it
+    def head(self, bucket, object_name):
+        return self.client.head_object(Bucket=bucket, Key=object_name)
+
+    # attach tags (e.g. checksums) to an uploaded object; False if tagging isn't allowed
+    def tag(self, bucket, object_name, tags):
+        try:
+            self.client.put_object_tagging(Bucket=bucket, Key=object_name, Tagging={
+                'TagSet': [{'Key': key, 'Value': str(value)} for key, value in sorted(tags.items())]})
+        except ClientError as e:
+            logging.error(e)
+            return False
+        return True
+
+    def delete(self, bucket, object_name):
+        self.client.delete_object(Bucket=bucket, Key=object_name)
+
+    # index of the objects already under prefix, built from one paginated listing
+    def index(self, bucket, prefix):
+        return S3Index(self.client, bucket, prefix)
+
+    # wait for queued transfers and release the transfer manager's threads
+    def shutdown(self):
+        self.manager.shutdown()
+
+
+# send chunks as consecutive parts of exactly part_size bytes (the last may be short),
+# numbered from part_number
+# True if the ETag of an s3 response can be checked against the md5s of the data; objects
+# encrypted with sse-kms get ETags that aren't made from them
+def md5_etag(response):
+    return response.get('ServerSideEncryption') not in KMS_ENCRYPTION
+
+def send_parts(upload, chunks, part_size, part_number):
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= part_size:
+            upload.upload_part(buffer[:part_size], part_number)
+            del buffer[:part_size]
+            part_number += 1
+    if buffer:
+        upload.upload_part(buffer, part_number)
+
+
+# bytes in a request body: bytes, a file chunk with a length, or a seekable file from its position
+def body_size(body):
+    if hasattr(body, '__len__'):
+        return len(body)
+    if hasattr(body, 'seek') and hasattr(body, 'tell'):
+        position = body.tell()
+        size = body.seek(0, 2) - position
+        body.seek(position)
+        return size
+    return 0
+
+
+class S3Index(object):
+    # in-memory key -> size index of everything under a prefix, so existence checks
+    # don't cost a HEAD request per object
+    def __init__(self, client, bucket, prefix):
+        self.sizes = {}
+        # lowercased file name without extension -> size, for matching m2m displayIds
+        self.stems = {}
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                self.add(obj['Key'], obj['Size'])
+
+    def add(self, object_name, size):
+        self.sizes[object_name] = size
+        stem = object_name.rsplit('/', 1)[-1].rsplit('.', 1)[0].lower()
+        self.stems[stem] = size
+
+    # True if object_name exists (with size bytes, when given)
+    def exists(self, object_name, size=None):
+        return object_name in self.sizes and (size is None or self.sizes[object_name] == size)
+
+    # True if a file named after display_id (any case or extension) exists with size bytes
+    def has_product(self, display_id, size):
+        return self.stems.get(display_id.lower()) == size
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+class MultipartUpload(object):
+    # one in-progress s3 multipart upload; parts are numbered in the order sent unless
+    # a part_number is given, and may be sent from several threads
+    def __init__(self, client, bucket, object_name):
+        self.client = client
+        self.bucket = bucket
+        self.object_name = object_name
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=object_name)['UploadId']
+        self.parts = []
+        self.lock = threading.Lock()
+
+    def upload_part(self, data, part_number=None):
+        if part_number is None:
+            part_number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.object_name, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=bytes(data))
+        with self.lock:
+            self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def complete(self):
+        parts = sorted(self.parts, key=lambda part: part['PartNumber'])
+        return self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.object_name,
+                                                     UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+
+    def abort(self):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.object_name, UploadId=self.upload_id)
@@ -0,0 +1,244 @@
+# =============================================================================
+#
+# shared http client used by m2m_transfer.py for both the m2m json api
+# (m2m.cr.usgs.gov) and file downloads (dds.cr.usgs.gov)
+#
+# one requests.Session keeps connections alive between calls so each api call
+# and download reuses an open TCP+TLS connection instead of setting up a new one.
+# api calls go through a shared token-bucket rate limiter and are retried with
+# exponential backoff on rate limits and transient failures; anything that
+# can't be retried is raised as one of the M2MError types below
+#
+# imports======================================================================
+
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+
+# =============================================================================
+
+class M2MError(Exception):
+    # an m2m api call failed; error_code is the api's errorCode when there was one
+    def __init__(self, message, error_code=None, status_code=None, retry_after=None):
+        super(M2MError, self).__init__(message)
+        self.error_code = error_code
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class M2MAuthError(M2MError):
+    # bad credentials or api key; not retried
+    pass
+
+class M2MRequestError(M2MError):
+    # the api rejected the request itself (bad input, not found); not retried
+    pass
+
+class M2MRateLimitError(M2MError):
+    # 429 or a RATE_LIMIT errorCode; retried after Retry-After or backoff
+    pass
+
+class M2MServerError(M2MError):
+    # 5xx, dropped connection, timeout or unreadable response; retried
+    pass
+
+RETRYABLE = (M2MRateLimitError, M2MServerError)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        """
+        Client-side rate limiter shared by every thread making api calls
+        :param rate: calls per second allowed on average
+        :param burst: calls allowed back to back; defaults to rate
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst or max(rate, 1))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # block until a call is allowed
+    def acquire(self):
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    # take a token if one is free and return 0, else return the seconds until one might be
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+    # hold every caller back for seconds, e.g. after the server says we are rate limited
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=8, base_delay=1, max_delay=300):
+        """
+        Exponential backoff with full jitter
+        :param max_attempts: tries per call before the last error is raised
+        :param base_delay: seconds before the first retry (before jitter)
+        :param max_delay: cap on any single wait
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    # seconds to wait before retry number attempt (1-based); Retry-After wins when given
+    def delay(self, attempt, error):
+        if error.retry_after is not None:
+            return min(error.retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    # call func until it succeeds, raises something not retryable or runs out of attempts
+    def call(self, func, on_retry=None):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func()
+            except RETRYABLE as e:
+                if attempt >= self.max_attempts:
+                    raise
+                delay = self.delay(attempt, e)
+                if on_retry is not None:
+                    on_retry(e, delay)
+                print('{} - retrying in {:.1f} seconds ({}/{})'.format(e, delay, attempt, self.max_attempts - 1))
+                time.sleep(delay)
+
+
+class M2MSession(object):
+    def __init__(self, pool_size=10, connect_timeout=10, read_timeout=300, retry_policy=None, rate_limiter=None,
+                 metrics=None):
+        """
+        Create a pooled, keep-alive session
+        :param pool_size: connections kept open per host; size it to the worker count
+        :param connect_timeout: seconds to wait for a connection
+        :param read_timeout: seconds to wait between bytes from the server
+        :param retry_policy: RetryPolicy for api calls; defaults to RetryPolicy()
+        :param rate_limiter: TokenBucket shared by all api calls; None doesn't limit
+        :param metrics: Metrics to record api call latency, retries and rate limit waits in
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # attach the m2m api key to every following request; None removes it
+    def set_api_key(self, api_key):
+        if api_key is None:
+            self.session.headers.pop('X-Auth-Token', None)
+        else:
+            self.session.headers['X-Auth-Token'] = api_key
+
+    # post a json body to the m2m api
+    def post(self, url, json_data, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, json_data, **kwargs)
+
+    # get a url; pass stream=True for file downloads
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    # call an m2m api endpoint with retries and return the response's data
+    def request_json(self, url, data):
+        json_data = json.dumps(data)
+        return self.retry_policy.call(lambda: self.request_once(url, json_data),
+                                      on_retry=lambda error, delay: self.on_retry(error, delay, url))
+
+    def on_retry(self, error, delay, url=None):
+        if self.metrics is not None:
+            self.metrics.add('api_retries', endpoint=endpoint(url), error=type(error).__name__)
+        # a rate limit applies to everyone sharing the limiter, not just this call
+        if isinstance(error, M2MRateLimitError) and self.rate_limiter is not None:
+            self.rate_limiter.pause(delay)
+
+    # one attempt at an api call; raises an M2MError on any failure
+    def request_once(self, url, json_data):
+        started = time.perf_counter()
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        if self.metrics is not None:
+            self.metrics.add('api_throttled_seconds', time.perf_counter() - started)
+            started = time.perf_counter()
+        try:
+            try:
+                response = self.post(url, json_data)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                raise M2MServerError('{} failed: {}'.format(url, e))
+            with response:
+                return response_data(url, response.status_code, response.text, response.headers.get('Retry-After'))
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('api_seconds', time.perf_counter() - started, endpoint=endpoint(url))
+
+    def close(self):
+        self.session.close()
+
+
+# the data out of an m2m api response, or the M2MError it amounts to
+def response_data(url, status, text, retry_after_header=None):
+    if status == 429:
+        raise M2MRateLimitError('429 Rate Limit', status_code=status, retry_after=retry_after(retry_after_header))
+    if status >= 500:
+        raise M2MServerError('{} Server Error'.format(status), status_code=status)
+    try:
+        output = json.loads(text)
+    except ValueError:
+        raise M2MServerError('unreadable response from {} ({})'.format(url, status), status_code=status)
+    if output.get('errorCode') is not None:
+        raise api_error(output['errorCode'], output.get('errorMessage'), status)
+    if status == 401:
+        raise M2MAuthError('401 Unauthorized', status_code=status)
+    if status >= 400:
+        raise M2MRequestError('Error Code {}'.format(status), status_code=status)
+    return output['data']
+
+# endpoint name at the end of an api url, e.g. scene-search, for labelling metrics
+def endpoint(url):
+    return (url or '').rstrip('/').rsplit('/', 1)[-1]
+
+# map an m2m errorCode onto the matching M2MError type
+def api_error(error_code, error_message, status_code):
+    message = '{} - {}'.format(error_code, error_message)
+    if 'RATE_LIMIT' in error_code:
+        return M2MRateLimitError(message, error_code, status_code)
+    if error_code.startswith('AUTH'):
+        return M2MAuthError(message, error_code, status_code)
+    if error_code in ('UNKNOWN', 'SERVER_ERROR', 'SERVICE_UNAVAILABLE'):
+        return M2MServerError(message, error_code, status_code)
+    return M2MRequestError(message, error_code, status_code)
+
+# seconds from a Retry-After header (delta-seconds or http-date), or None
+def retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,239 @@
+# =============================================================================
+#
+# sharded transfer: split the search area into a grid of boxes and run one
+# M2MTransfer per box, in local worker processes or on separate machines
+#
+# scene-search returns every scene whose footprint touches a box, so a scene
+# on the edge between two boxes comes back in both. each shard keeps only the
+# scenes whose centroid falls inside its own box, so every scene is owned by
+# exactly one shard. the boxes on the edge of the search area reach out past
+# it, so a scene that only touches the area (its centroid outside) still has
+# an owner. every shard writes its own journal (and uses its own
+# download label); the journals can be merged into one for reporting
+#
+# usage (from src/):
+#   python m2m_shards.py --rows 4 --cols 4 --list
+#   python m2m_shards.py --rows 4 --cols 4 --processes 4
+#   python m2m_shards.py --rows 4 --cols 4 --node 0/3 --processes 2   (on each of 3 machines)
+#   python m2m_shards.py --merge ./texas_naip_2020.db ./shards/*.db
+#
+# imports======================================================================
+
+import argparse
+import multiprocessing
+import os, sys
+import traceback
+
+from m2m_journal import TransferJournal
+
+# =============================================================================
+
+class Shard(object):
+    def __init__(self, index, south, west, north, east, open_south=False, open_west=False, open_north=False,
+                 open_east=False):
+        """
+        One box of the grid; a box owns the points on its south and west edges but not on its
+        north and east ones, and an edge that is also the edge of the whole area is open: the box
+        owns everything on and beyond it
+        :param index: shard number, counted row by row from the south-west corner
+        :param open_south: the south edge is the edge of the whole area
+        :param open_west: the west edge is the edge of the whole area
+        :param open_north: the north edge is the edge of the whole area
+        :param open_east: the east edge is the edge of the whole area
+        """
+        self.index = index
+        self.south = south
+        self.west = west
+        self.north = north
+        self.east = east
+        self.open_south = open_south
+        self.open_west = open_west
+        self.open_north = open_north
+        self.open_east = open_east
+
+    # mbr spatialFilter for scene-search
+    def spatial_filter(self):
+        return {
+            'filterType': "mbr",
+            'lowerLeft': {'latitude': self.south, 'longitude': self.west},
+            'upperRight': {'latitude': self.north, 'longitude': self.east}
+            }
+
+    def contains(self, latitude, longitude):
+        south_ok = self.open_south or self.south <= latitude
+        west_ok = self.open_west or self.west <= longitude
+        north_ok = self.open_north or latitude < self.north
+        east_ok = self.open_east or longitude < self.east
+        return south_ok and west_ok and north_ok and east_ok
+
+    # True if this shard should transfer a scene-search result; a scene without a
+    # footprint can't be placed, so every shard that finds it keeps it
+    def owns(self, scene):
+        point = centroid(scene.get('spatialBounds') or scene.get('spatialCoverage'))
+        return point is None or self.contains(*point)
+
+    def __repr__(self):
+        return 'Shard({}: {},{} to {},{})'.format(self.index, self.south, self.west, self.north, self.east)
+
+
+# split an mbr spatialFilter into rows x cols shards
+def grid(spatial_filter, rows, cols):
+    south = spatial_filter['lowerLeft']['latitude']
+    west = spatial_filter['lowerLeft']['longitude']
+    north = spatial_filter['upperRight']['latitude']
+    east = spatial_filter['upperRight']['longitude']
+    shards = []
+    for row in range(rows):
+        for col in range(cols):
+            shards.append(Shard(len(shards),
+                                south + (north - south) * row / rows, west + (east - west) * col / cols,
+                                south + (north - south) * (row + 1) / rows, west + (east - west) * (col + 1) / cols,
+                                open_south=row == 0, open_west=col == 0,
+                                open_north=row == rows - 1, open_east=col == cols - 1))
+    return shards
+
+# (latitude, longitude) at the middle of a geojson geometry's bounding box, or None
+def centroid(geometry):
+    if not geometry or 'coordinates' not in geometry:
+        return None
+    points = list(flatten(geometry['coordinates']))
+    if not points:
+        return None
+    longitudes = [point[0] for point in points]
+    latitudes = [point[1] for point in points]
+    return (min(latitudes) + max(latitudes)) / 2, (min(longitudes) + max(longitudes)) / 2
+
+# every [longitude, latitude] position in nested geojson coordinates
+def flatten(coordinates):
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for item in coordinates:
+        for point in flatten(item):
+            yield point
+
+# the shards one machine of node_count runs, when a job is split across machines
+def node_shards(shards, node, node_count):
+    return [shard for shard in shards if shard.index % node_count == node]
+
+# journal file for a shard
+def shard_journal(journal_dir, shard):
+    return os.path.join(journal_dir, 'shard_{:03d}.db'.format(shard.index))
+
+# run one shard to completion in this process; returns (index, journal states or the error)
+def run_shard(shard, options, journal_dir):
+    # imported here so the coordinator doesn't need the environment variables the transfer reads
+    from m2m_transfer import M2MTransfer
+    options = dict(options)
+    options['spatial_filter'] = shard.spatial_filter()
+    # each shard polls download-retrieve for its own label only
+    options['label'] = '{} shard {}'.format(options['label'], shard.index)
+    options['journal_path'] = shard_journal(journal_dir, shard)
+    try:
+        M2MTransfer(shard=shard, **options).run()
+    except Exception:
+        return shard.index, traceback.format_exc()
+    journal = TransferJournal(options['journal_path'])
+    try:
+        return shard.index, journal.summary()
+    finally:
+        journal.close()
+
+def run_shards(shards, options, journal_dir, processes, node_count=1):
+    """
+    Run shards on a pool of worker processes, each with its own M2M session and journal
+    :param shards: Shards to run
+    :param options: keyword arguments for M2MTransfer, with the whole search area's label
+    :param journal_dir: directory the per-shard journals are written to
+    :param processes: shards run at once
+    :param node_count: machines running shards of the same job at once, each with processes workers
+    :return: {shard index: journal states, or the traceback if the shard failed}
+    """
+    os.makedirs(journal_dir, exist_ok=True)
+    options = dict(options)
+    # the api rate limit is per user, so every process on every machine shares it
+    if options.get('api_rate'):
+        options['api_rate'] = float(options['api_rate']) / (processes * node_count)
+    # the processes on this machine stage to the same disk, so they split its staging budget
+    options['staging_shares'] = processes
+    results = {}
+    with multiprocessing.Pool(processes) as pool:
+        jobs = [pool.apply_async(run_shard, (shard, options, journal_dir)) for shard in shards]
+        for job in jobs:
+            index, result = job.get()
+            results[index] = result
+            print('shard {} finished: {}'.format(index, result))
+    return results
+
+# merge per-shard journals into one; returns the merged product count per state
+def merge_journals(out_path, paths):
+    journal = TransferJournal(out_path)
+    try:
+        for path in paths:
+            print('merging', path)
+            journal.merge(path)
+        return journal.summary()
+    finally:
+        journal.close()
+
+
+if __name__ == "__main__":
+    #
+    # CHANGE THE VALUES BELOW AS NEEDED; every shard runs with these transfer options
+    #
+    transfer_options = {
+        'service_url': "https://m2m.cr.usgs.gov/api/api/json/stable/",
+        'data_path': "../data/",
+        'dataset_name': "naip",
+        'label': "Texas NAIP 2020",
+        'temporal_filter': {'start': '2020-01-01', 'end': '2021-06-01'},
+        'acquisition_filter': {'end': '2021-06-01', 'start': '2020-01-01'},
+        'stream_to_s3': True,
+        'download_workers': 4,
+        'api_rate': 2,
+        }
+    # texas bbox; split into the grid given on the command line
+    spatial_filter = {
+        'filterType': "mbr",
+        'lowerLeft': {'latitude': 25, 'longitude': -107},
+        'upperRight': {'latitude': 37, 'longitude': -93}
+        }
+
+    parser = argparse.ArgumentParser(description='run M2MTransfer over a grid of shards of the search area')
+    parser.add_argument('--rows', type=int, default=4, help='grid rows (south to north)')
+    parser.add_argument('--cols', type=int, default=4, help='grid columns (west to east)')
+    parser.add_argument('--shards', help='comma separated shard numbers to run; default all (or this node\'s)')
+    parser.add_argument('--node', help='i/n: run the shards for machine i of n (shard number % n == i)')
+    parser.add_argument('--processes', type=int, default=1, help='shards run at once on this machine')
+    parser.add_argument('--journal-dir', default='./shards', help='directory for per-shard journals')
+    parser.add_argument('--list', action='store_true', help='print the shards and exit')
+    parser.add_argument('--merge', nargs='+', metavar=('OUT', 'JOURNAL'),
+                        help='merge shard journals into OUT and exit')
+    args = parser.parse_args()
+
+    if args.merge:
+        if len(args.merge) < 2:
+            parser.error('--merge needs an output journal and at least one shard journal')
+        print('merged journal states:', merge_journals(args.merge[0], args.merge[1:]))
+        sys.exit(0)
+
+    shards = grid(spatial_filter, args.rows, args.cols)
+    node_count = 1
+    if args.node:
+        node, node_count = (int(part) for part in args.node.split('/'))
+        shards = node_shards(shards, node, node_count)
+    if args.shards:
+        wanted = set(int(index) for index in args.shards.split(','))
+        shards = [shard for shard in shards if shard.index in wanted]
+    if args.list:
+        for shard in shards:
+            print(shard)
+        sys.exit(0)
+
+    results = run_shards(shards, transfer_options, args.journal_dir, args.processes, node_count)
+    failed = [index for index, result in results.items() if not isinstance(result, dict)]
+    print('\n{} shards finished, {} failed'.format(len(results) - len(failed), len(failed)))
+    for index in failed:
+        print('shard {} failed:\n{}'.format(index, results[index]))
+    print('merge the journals with: python m2m_shards.py --merge <out.db> {}/shard_*.db'.format(args.journal_dir))
+    sys.exit(1 if failed else 0)
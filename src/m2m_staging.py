@@ -0,0 +1,130 @@
+# =============================================================================
+#
+# staging area used by m2m_transfer.py when downloads are written to disk
+# before upload
+#
+# each download reserves its filesize against a byte budget before it starts
+# and gives it back once its file has been uploaded and removed, so the
+# staging directory never holds more than the budget however many workers are
+# running; a download that doesn't fit waits for one that does. processes
+# staging to the same filesystem at once (the shards of m2m_shards.py) each
+# take an even share of the budget. staged files left behind by a run that
+# died are removed at startup, except partial downloads the run will resume
+#
+# imports======================================================================
+
+import os
+import shutil
+import threading
+import time
+
+# =============================================================================
+
+# memory-backed filesystem on linux; staging there avoids the disk entirely
+TMPFS = '/dev/shm/'
+
+
+class StagingArea(object):
+    def __init__(self, path, budget=None, keep_free=1024 * 1024 * 1024, shares=1):
+        """
+        :param path: staging directory; created if missing
+        :param budget: bytes that may be reserved at once; None allows whatever the filesystem
+                       has free when the run starts, less keep_free
+        :param keep_free: bytes of the filesystem left free when budget is None
+        :param shares: processes staging to the same filesystem at once; each gets this share
+                       of the budget, so together they stay within it
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.budget = budget
+        self.keep_free = keep_free
+        self.shares = shares
+        self.reserved = 0
+        # in-flight files waiting for space, for reporting
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    # this process's share of the budget to hold reservations to; worked out on first use
+    def limit(self):
+        if self.budget is None:
+            self.budget = max(shutil.disk_usage(self.path).free - self.keep_free, 0)
+            print('staging budget: {:.1f} GB free in {}'.format(self.budget / 1024 ** 3, self.path))
+        if self.shares > 1:
+            self.budget //= self.shares
+            print('staging budget: {:.1f} GB for this process ({} sharing)'.format(
+                self.budget / 1024 ** 3, self.shares))
+            self.shares = 1
+        return self.budget
+
+    # True if size more bytes fit; a file bigger than the whole budget goes when nothing else is staged
+    def fits(self, size):
+        return self.reserved + size <= self.limit() or self.reserved == 0
+
+    def reserve(self, size):
+        """
+        Block until size bytes fit in the budget, then reserve them
+        :param size: bytes the download will take on disk (its filesize); None or 0 reserves nothing
+        :return: bytes reserved, to be passed to release()
+        """
+        if not size:
+            return 0
+        with self.condition:
+            self.waiting += 1
+            try:
+                while not self.fits(size):
+                    self.condition.wait()
+            finally:
+                self.waiting -= 1
+            self.reserved += size
+        return size
+
+    # reserve size bytes only if they fit now; returns the bytes reserved, or None if they don't fit
+    def try_reserve(self, size):
+        if not size:
+            return 0
+        with self.condition:
+            if not self.fits(size):
+                return None
+            self.reserved += size
+        return size
+
+    # give back a reservation once its file is gone
+    def release(self, size):
+        if not size:
+            return
+        with self.condition:
+            self.reserved -= size
+            self.condition.notify_all()
+
+    def clean(self, resumable=(), min_age=300):
+        """
+        Remove staged files (<downloadId>_<file name>, finished or .part) a previous run left behind
+        :param resumable: downloadIds still in flight in the journal; their .part files are kept,
+                          since their downloads resume from them. finished files are removed either
+                          way, as they are downloaded again rather than uploaded from here
+        :param min_age: seconds since a file last changed before it counts as orphaned,
+                        so files still in use by another process sharing path are left alone
+        :return: bytes removed
+        """
+        removed = 0
+        now = time.time()
+        for entry in os.scandir(self.path):
+            download_id, separator, file_name = entry.name.partition('_')
+            if not entry.is_file() or not separator or not download_id.isdigit():
+                continue
+            if file_name.endswith('.part') and int(download_id) in resumable:
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime >= min_age:
+                os.remove(entry.path)
+                removed += stat.st_size
+        if removed:
+            print('removed {:.1f} MB of orphaned staged files from {}'.format(removed / 1024 ** 2, self.path))
+        return removed
+
+
+# staging directory under tmpfs, or None when there is no tmpfs
+def tmpfs_path(name='m2m_staging'):
+    if not os.path.isdir(TMPFS):
+        return None
+    return os.path.join(TMPFS, name) + '/'
@@ -11,16 +11,47 @@
 
 import json, io, time
 from zipfile import ZipFile
-import requests
 import sys, os
 import time, csv
-import boto3
-from botocore.exceptions import ClientError
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from m2m_pool import TransferPool, StagedFile
+from m2m_readiness import ReadinessTracker, RetrieveLoop
+import m2m_journal
+from m2m_journal import TransferJournal
+from m2m_checksum import StreamChecksum, IntegrityError
+from m2m_downloader import RangedDownloader
+from m2m_products import ProductSelector
+from m2m_s3 import S3Uploader, md5_etag
+from m2m_staging import StagingArea, tmpfs_path
+from m2m_zip import RangeFile, ZipMembers
+from m2m_session import M2MSession, M2MError, RetryPolicy, TokenBucket
+from m2m_metrics import Metrics, SnapshotWriter, MetricsServer
+from m2m_progress import ProgressReporter
+from m2m_cache import ResponseCache
+from m2m_plan import TransferPlan
 
 # =============================================================================
 
 class M2MTransfer(object):
-    def __init__(self, service_url, data_path, dataset_name, label, spatial_filter, temporal_filter, acquisition_filter):
+    def __init__(self, service_url, data_path, dataset_name, label, spatial_filter, temporal_filter, acquisition_filter,
+                 stream_to_s3=False, part_size=8 * 1024 * 1024, download_workers=4, upload_workers=2,
+                 connect_timeout=10, read_timeout=300,
+                 multipart_threshold=32 * 1024 * 1024, multipart_chunksize=32 * 1024 * 1024, s3_concurrency=10,
+                 retrieve_min_wait=2, retrieve_max_wait=60, retrieve_timeout=None, journal_path=None,
+                 skip_existing=True, product_selector=None,
+                 api_rate=2, api_burst=5, max_attempts=8, max_backoff=300,
+                 download_retries=5, failed_report_path=None, segments=1,
+                 verify_uploads=True, tag_checksums=False, buffer_size=1024 * 1024,
+                 zip_members=None, shard=None,
+                 staging_budget=None, staging_keep_free=1024 * 1024 * 1024, staging_tmpfs=False, staging_shares=1,
+                 request_batch_size=500, request_concurrency=2,
+                 metrics_path=None, metrics_interval=60, metrics_port=None,
+                 progress_interval=60, progress_path=None, progress_window=900,
+                 cache_path=None, cache_ttl=7 * 24 * 3600, cache_max_bytes=1024 * 1024 * 1024,
+                 plan_path=None):
         # setup variables from environment variables
         self.s3_bucket = os.environ['S3_BUCKET']
         self.s3_key = os.environ['S3_KEY']
@@ -37,50 +68,164 @@ class M2MTransfer(object):
         self.product_count = 0
         self.downloader_count = 0
         self.upload_count = 0
+        self.exists_count = 0
+        self.unselected_count = 0
         self.jpeg_count = 0
         self.skip_count = 0
+        self.zip_count = 0
+        self.member_count = 0
+        self.other_shard_count = 0
 
         self.spatial_filter = spatial_filter
         self.temporal_filter = temporal_filter
         self.acquisition_filter = acquisition_filter
 
-    # send http request
-    def send_request(self, url, data, api_key = None):
+        # streaming mode pipes each download straight into an s3 multipart
+        # upload; part_size is the in-memory buffer flushed as one part
+        self.stream_to_s3 = stream_to_s3
+        self.part_size = part_size
+
+        # worker pool sizes; upload_workers only matters when staging to data_path
+        self.download_workers = download_workers
+        self.upload_workers = upload_workers
+        self.pool = None
+        # download-retrieve polling backs off from retrieve_min_wait to retrieve_max_wait
+        # seconds while nothing new is available; retrieve_timeout (seconds) gives up on
+        # downloads that never become available
+        self.retrieve_min_wait = retrieve_min_wait
+        self.retrieve_max_wait = retrieve_max_wait
+        self.retrieve_timeout = retrieve_timeout
+        self.dispatch_count = 0
+        self.unavailable = []
+        # each page's downloads go to download-request in batches of request_batch_size,
+        # request_concurrency at a time; polling and downloads start with the first batch back
+        self.request_batch_size = request_batch_size
+        self.request_concurrency = request_concurrency
+        self.duplicate_count = 0
+
+        # product states are journaled so a restarted run can pick up where it stopped;
+        # without a journal_path the journal only lives for this run
+        self.journal = TransferJournal(journal_path or ':memory:')
+
+        # a progress line (products per state, bytes finished of planned, rate and eta) is
+        # printed every progress_interval seconds when something moved, and written to
+        # progress_path as json; the eta follows the rate bytes were uploaded over the last
+        # progress_window seconds, so products found in s3 already don't count as throughput
+        self.progress = ProgressReporter(self.journal, interval=progress_interval, path=progress_path,
+                                         window=progress_window, failed=lambda: len(self.failed_items()),
+                                         transferred=lambda: self.metrics.total('upload_bytes'))
+
+        # with skip_existing, products already in s3 at the expected size are never
+        # requested; the index is built from one listing of s3_key at the start of run()
+        self.skip_existing = skip_existing
+        self.s3_index = None
+
+        # chooses which download-options products get requested; by default every available one
+        self.product_selector = product_selector or ProductSelector()
+
+        # counters are bumped from worker threads
+        self.count_lock = threading.Lock()
+
+        # every stage records api latency, time to ready, bytes moved, retries and queue depths
+        # here. with metrics_path a json snapshot is appended to that file every metrics_interval
+        # seconds; with metrics_port prometheus text is served on http://<host>:<port>/metrics
+        self.metrics = Metrics()
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self.metrics_port = metrics_port
+        self.metrics_outputs = []
+
+        # with cache_path, dataset-search, scene-search and download-options responses are kept
+        # in that directory for cache_ttl seconds (cache_max_bytes at most, least recently used
+        # removed first), so a rerun with the same filters doesn't ask the api for them again
+        self.cache = None
+        if cache_path:
+            self.cache = ResponseCache(cache_path, ttl=cache_ttl, max_bytes=cache_max_bytes, metrics=self.metrics)
+
+        # one keep-alive session for every api call and download; pooled to
+        # cover all download workers plus the api calls made alongside them.
+        # api calls share a token bucket of api_rate calls/second (api_burst back to back)
+        # and are retried up to max_attempts times with backoff capped at max_backoff seconds
+        self.session = M2MSession(pool_size=download_workers * segments + 1,
+                                  connect_timeout=connect_timeout, read_timeout=read_timeout,
+                                  retry_policy=RetryPolicy(max_attempts=max_attempts, max_delay=max_backoff),
+                                  rate_limiter=TokenBucket(api_rate, api_burst) if api_rate else None,
+                                  metrics=self.metrics)
+
+        # downloads that drop part way resume with a Range request from the last byte received;
+        # each file gets download_retries retries before it is given up on and reported.
+        # failed_report_path, if set, is where the list of failed downloads is written at the end.
+        # bodies are read buffer_size bytes at a time into one reused buffer per download
+        self.fetcher = RangedDownloader(self.session, max_retries=download_retries, buffer_size=buffer_size,
+                                        metrics=self.metrics)
+        self.failed_report_path = failed_report_path
+        # files larger than part_size are fetched as this many byte ranges at once when the
+        # server accepts ranges; 1 keeps one stream per file
+        self.segments = segments
+
+        # one s3 client and transfer manager for the whole run, shared by all workers;
+        # streaming download workers send parts on the same client. S3_ENDPOINT_URL, if set,
+        # points it at an s3-compatible store instead of aws
+        self.s3 = S3Uploader(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize,
+                             max_concurrency=s3_concurrency,
+                             max_pool_connections=s3_concurrency + download_workers * segments,
+                             endpoint_url=os.environ.get('S3_ENDPOINT_URL'), metrics=self.metrics)
+
+        # every transfer is hashed as it streams; with verify_uploads the size is checked
+        # against filesize and Content-Length and the s3 ETag against the one worked out
+        # locally, and a mismatched object is deleted and reported as failed. the md5/sha256
+        # go in the journal, and onto the object as tags with tag_checksums
+        self.verify_uploads = verify_uploads
+        self.tag_checksums = tag_checksums
+
+        # zip_members is a list of patterns (e.g. ['*.jp2']); when set, zip products are
+        # opened in place with range requests and only the matching members are streamed
+        # to s3. None skips zips
+        self.zip_members = zip_members
+
+        # staged downloads reserve their filesize against staging_budget bytes (by default the
+        # space free in data_path at the start, less staging_keep_free) and wait while it is
+        # used up; with staging_tmpfs, files are staged in memory under /dev/shm instead.
+        # staging_shares processes staging to the same filesystem split the budget evenly, and
+        # a shard stages in its own subdirectory so its startup clean never touches another's files
+        if staging_tmpfs:
+            if tmpfs_path() is None:
+                raise ValueError('staging_tmpfs is set but there is no tmpfs at /dev/shm')
+            self.data_path = tmpfs_path()
+        if shard is not None:
+            self.data_path = '{}shard_{:03d}/'.format(self.data_path, shard.index)
+        self.staging = None
+        if not stream_to_s3:
+            self.staging = StagingArea(self.data_path, budget=staging_budget, keep_free=staging_keep_free,
+                                       shares=staging_shares)
+
+        # a Shard (m2m_shards.py) when this transfer covers one box of a larger search area;
+        # scenes whose centroid lies in another shard's box are left to that shard
+        self.shard = shard
+
+        # with plan_path, run() transfers the products in that plan file (written by plan(),
+        # m2m_plan.py) instead of searching; planned is the plan a dry run is filling in
+        self.plan_path = plan_path
+        self.planned = None
+
+    # thread-safe increment of one of the counters above
+    def count(self, name):
+        with self.count_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    # send http request; the api key is attached by the session after login. rate limits and
+    # transient failures are retried by the session; anything else raises an M2MError.
+    # metadata responses are answered from the cache when there is one
+    def send_request(self, url, data):
         # print('running send_request method')
-        json_data = json.dumps(data)
-        if api_key == None:
-            response = requests.post(url, json_data)
-        else:
-            headers = {'X-Auth-Token': api_key}
-            response = requests.post(url, json_data, headers = headers)
-        # print('response:', response.__dict__['reason'])
-        try:
-            httpStatusCode = response.status_code
-            if response == None:
-                print("No output from service")
-                sys.exit()
-            output = json.loads(response.text)
-            if output['errorCode'] != None:
-                print(output['errorCode'], "- ", output['errorMessage'])
-                sys.exit()
-            if  httpStatusCode == 404:
-                print("404 Not Found")
-                sys.exit()
-            elif httpStatusCode == 401:
-                print("401 Unauthorized")
-                sys.exit()
-            elif httpStatusCode == 429:
-                print("429 Rate Limit")
-                sys.exit()
-            elif httpStatusCode == 400:
-                print("Error Code", httpStatusCode)
-                sys.exit()
-        except Exception as e:
-            response.close()
-            print(e)
-            sys.exit()
-        response.close()
-        return output['data']
+        if self.cache is not None:
+            cached = self.cache.get(url, data)
+            if cached is not None:
+                return cached
+        result = self.session.request_json(url, data)
+        if self.cache is not None:
+            self.cache.put(url, data, result)
+        return result
 
     # method to upload file to s3
     def upload_file(self, file_name, bucket, object_name=None):
@@ -90,273 +235,668 @@ class M2MTransfer(object):
         :param file_name: File to upload
         :param bucket: Bucket to upload to
         :param object_name: S3 object name. If not specified then file_name is used
-        :return: True if file was uploaded, else False
+        :return: True once the file is uploaded; a failed upload raises, so the pool reports it
         """
         # If S3 object_name was not specified, use file_name
         if object_name is None:
             object_name = file_name
-        # Upload the file
-        s3_client = boto3.client('s3')
+        # Upload the file on the shared uploader
+        return self.s3.upload_file(file_name, bucket, object_name)
+
+    # method to stream a download response into an s3 multipart upload;
+    # at most one part_size buffer is held in memory and nothing is written to data_path
+    # returns the complete_multipart_upload response and the checksum of the bytes sent; a failed upload raises
+    def stream_upload(self, r, download, file_name):
+        size = self.segmented_size(r)
+        if size is not None:
+            # parallel ranges go straight into their multipart parts, each hashed on its own
+            r.close()
+            ranges = {}
+            def read_range(start, end):
+                ranges[start] = StreamChecksum(self.part_size, whole_file=False)
+                return ranges[start].wrap(self.fetcher.chunks(download['url'], offset=start, end=end))
+            uploaded = self.s3.upload_ranges(read_range, size, self.s3_bucket, self.s3_key + file_name,
+                                             self.part_size, self.segments)
+            checksum = StreamChecksum.combine([ranges[start] for start in sorted(ranges)], self.part_size)
+        else:
+            checksum = StreamChecksum(self.part_size)
+            chunks = self.fetcher.chunks(download['url'], r, chunk_size=1024 * 1024)
+            uploaded = self.s3.upload_stream(checksum.wrap(chunks), self.s3_bucket, self.s3_key + file_name,
+                                             self.part_size)
+        return uploaded, checksum
+
+    # total size of the file behind response r if it should be fetched as parallel ranges, else None
+    def segmented_size(self, r):
+        length = r.headers.get('Content-Length', '')
+        if self.segments < 2 or r.headers.get('Accept-Ranges') != 'bytes' or not length.isdigit():
+            return None
+        size = int(length)
+        return size if size > self.part_size else None
+
+    # method to stream the zip members matching zip_members to s3; the zip's central directory
+    # and the wanted members are read with range requests, so the zip never touches data_path.
+    # a server without range support gets the zip staged as a .part file and read from there.
+    # a member that fails to upload raises, so the pool reports the zip as failed
+    def extract_zip(self, r, download, file_name):
+        length = r.headers.get('Content-Length', '')
+        path = None
+        if r.headers.get('Accept-Ranges') == 'bytes' and length.isdigit():
+            r.close()
+            source = RangeFile(self.fetcher, download['url'], int(length))
+        else:
+            path = self.staging_path(download, file_name) + '.part'
+            self.fetcher.to_file(download['url'], path, response=r)
+            source = open(path, 'rb')
         try:
-            response = s3_client.upload_file(file_name, bucket, object_name)
-        except ClientError as e:
-            logging.error(e)
-            return False
-        return True
-
-    # def rerun_list(self, list):
-    #     print('rerun_list method')
-    #     # check if any urls have been added to rerun list;
-    #     # if so, try response again with downloader func
-    #     if len(list) > 0:
-    #         print("rerun_list has {} urls. preparing to run...".format(len(list)))
-    #         time.sleep(3)
-    #
-    #         for u in list:
-    #             response = requests.get(u, stream=True)
-    #             if response.ok:
-    #                 self.downloader(response, data_path)
-
-    # method to unzip and remove local file from staging area
-    # def unzipper(self, path, file_name):
-    #     print('unzipper method')
-    #     for file in os.listdir(path):
-    #         if file.endswith('.ZIP') or file.endswith('.zip'):
-    #             print("found zip:", file)
-    #             with ZipFile(path + file, 'r') as z:
-    #                 print('extracting {}...'.format(z))
-    #                 z.extractall(path)
-    #             os.remove(path + file)
-    #     # call uploader func
-    #     self.uploader(path, file_name)
-
-    # method to upload file to s3; uses upload_file method
-    def uploader(self, path, file_name):
+            members = ZipMembers(source, self.zip_members)
+            print('{}: {} wanted members, {} skipped'.format(file_name, len(members.members), members.skipped))
+            for info in members.members:
+                self.upload_member(members, info)
+            members.close()
+            if path is None:
+                print('{}: read {} of {} bytes in {} requests'.format(file_name, source.bytes_read, length, source.requests))
+        finally:
+            source.close()
+            if path is not None:
+                os.remove(path)
+
+    # method to stream one zip member to s3 under its own file name and check it arrived whole
+    def upload_member(self, members, info):
+        name = posixpath.basename(info.filename)
+        object_name = self.s3_key + name
+        checksum = StreamChecksum(self.part_size)
+        uploaded = self.s3.upload_stream(checksum.wrap(members.chunks(info)), self.s3_bucket, object_name,
+                                         self.part_size)
+        etag = uploaded['ETag']
+        # sse-kms ETags aren't md5s, so only the size is checked for those
+        mismatched = md5_etag(uploaded) and etag != checksum.etag()
+        if self.verify_uploads and (checksum.size != info.file_size or mismatched):
+            self.s3.delete(self.s3_bucket, object_name)
+            raise IntegrityError('{} failed verification: {} bytes of {}, ETag {}, expected {}'.format(
+                object_name, checksum.size, info.file_size, etag, checksum.etag()))
+        if self.tag_checksums:
+            record = checksum.record()
+            record['etag'] = etag.strip('"')
+            self.s3.tag(self.s3_bucket, object_name, record)
+        self.count('member_count')
+        self.index_upload(object_name, info.file_size)
+
+    # method to download a jp2 into path while hashing it in s3 upload_file part sizes, so the
+    # object's ETag can be checked once it is uploaded
+    def download_to_file(self, r, download, path):
+        part_size = self.s3.config.multipart_chunksize
+        size = self.segmented_size(r)
+        if size is not None:
+            r.close()
+            ranges = {}
+            def wrap(start, end, chunks):
+                ranges[start] = StreamChecksum(part_size, whole_file=False)
+                return ranges[start].wrap(chunks)
+            # ranges start on part boundaries so their part md5s can be joined
+            self.fetcher.to_file_segmented(download['url'], path, size, self.segments, align=part_size, wrap=wrap)
+            return StreamChecksum.combine([ranges[start] for start in sorted(ranges)], part_size)
+        checksum = StreamChecksum(part_size)
+        if os.path.exists(path):
+            # a .part left by an earlier attempt is resumed; hash what it already holds
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    checksum.update(chunk)
+        self.fetcher.to_file(download['url'], path, response=r, wrap=checksum.wrap)
+        return checksum
+
+    # method to check an uploaded object against what usgs served and record its checksums;
+    # uploaded is the complete_multipart_upload or head_object response. a mismatched object is
+    # deleted and IntegrityError raised so the pool reports it as failed
+    def verify(self, download, file_name, uploaded, checksum, content_length=None, single_part=False):
+        object_name = self.s3_key + file_name
+        etag = uploaded['ETag']
+        if self.verify_uploads:
+            problems = []
+            if download.get('filesize') is not None and checksum.size != download['filesize']:
+                problems.append('{} bytes, filesize is {}'.format(checksum.size, download['filesize']))
+            if content_length is not None and content_length.isdigit() and checksum.size != int(content_length):
+                problems.append('{} bytes, Content-Length is {}'.format(checksum.size, content_length))
+            # a file fetched as ranges has no whole-file md5 to check a single-part ETag against,
+            # and sse-kms ETags aren't md5s at all, so only the sizes are checked for those
+            comparable = md5_etag(uploaded) and not (single_part and checksum.md5 is None)
+            if comparable and etag != checksum.etag(single_part):
+                problems.append('ETag {}, expected {}'.format(etag, checksum.etag(single_part)))
+            if problems:
+                self.s3.delete(self.s3_bucket, object_name)
+                raise IntegrityError('{} failed verification: {}'.format(object_name, '; '.join(problems)))
+        record = checksum.record()
+        record['etag'] = etag.strip('"')
+        self.journal.verified(download['downloadId'], record)
+        if self.tag_checksums:
+            self.s3.tag(self.s3_bucket, object_name, record)
+
+    # method to upload one staged file handed over by a download worker, then remove it;
+    # the file belongs to this worker alone, so there is no directory to scan or claim from
+    def uploader(self, staged):
         print('running uploader method')
-        for file in os.listdir(path):
-            if file.endswith('.jp2'):
-                # upload jp2 file to s3
-                with open(path + file, 'rb'):
-                    # print('upload path + file_name', path + file)
-                    self.upload_file(path + file, self.s3_bucket, object_name=self.s3_key+file)
-                    self.upload_count += 1
-                os.remove(path + file)
-
-    # method to setup file_name and download file if jp2; calls uploader method
-    def downloader(self, r):
+        object_name = self.s3_key + staged.file_name
+        size = os.path.getsize(staged.path)
+        try:
+            # upload jp2 file to s3
+            with self.metrics.timer('upload_seconds'):
+                self.upload_file(staged.path, self.s3_bucket, object_name=object_name)
+            if staged.checksum is not None:
+                self.verify_staged(staged)
+            self.count('upload_count')
+            self.index_upload(object_name, size)
+            self.journal.update(staged.download['downloadId'], m2m_journal.UPLOADED)
+        finally:
+            os.remove(staged.path)
+            self.release(staged.reserved)
+
+    # method to verify a staged file's upload with the checksum taken while it was downloaded
+    def verify_staged(self, staged):
+        # upload_file sends files under multipart_threshold in one put, with a plain md5 ETag
+        single_part = staged.checksum.size < self.s3.config.multipart_threshold
+        uploaded = self.s3.head(self.s3_bucket, self.s3_key + staged.file_name)
+        self.verify(staged.download, staged.file_name, uploaded, staged.checksum, staged.content_length, single_part)
+
+    # method to setup file_name and download file if jp2; runs on a download worker.
+    # returns a StagedFile for the upload stage, or None when there is nothing to upload
+    def downloader(self, r, download):
         print('running downloader method')
-        self.downloader_count += 1
+        self.count('downloader_count')
         file_name = r.headers['Content-Disposition'].rsplit('=')[1].strip('""')
         print('file_name =', file_name)
         # write file from url to local file
-        if file_name.endswith('.jp2'):
+        if file_name.endswith('.jp2') and self.stream_to_s3:
+            print('found a jp2, streaming to s3')
+            self.count('jpeg_count')
+            uploaded, checksum = self.stream_upload(r, download, file_name)
+            self.verify(download, file_name, uploaded, checksum, r.headers.get('Content-Length'))
+            self.count('upload_count')
+            self.index_upload(self.s3_key + file_name, download.get('filesize'))
+            self.journal.update(download['downloadId'], m2m_journal.UPLOADED, file_name)
+        elif file_name.endswith('.jp2'):
             print('found a jp2')
-            with open(self.data_path + file_name, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-            self.jpeg_count += 1
-            # if jp2 file, call uploader method
-            self.uploader(self.data_path, file_name)
-            # when downloader_count == product_count,
-            # run paginator to search for more pages of data
-            if self.downloader_count == self.product_count:
-                print('downloader_count: {} --- product_count: {}'.format(self.downloader_count, self.scene_count))
-                self.paginator(self.scene_payload, self.scenes)
+            # staged under a name unique to this download, so no two workers share a file;
+            # written to .part first, and a .part left by an earlier attempt is resumed
+            path = self.staging_path(download, file_name)
+            checksum = self.download_to_file(r, download, path + '.part')
+            os.rename(path + '.part', path)
+            self.count('jpeg_count')
+            self.journal.update(download['downloadId'], m2m_journal.DOWNLOADED, file_name)
+            # hand the jp2 to the upload stage
+            return StagedFile(path, file_name, download, checksum, r.headers.get('Content-Length'))
+        elif (file_name.endswith('.ZIP') or file_name.endswith('.zip')) and self.zip_members:
+            print('found a zip, streaming its {} members to s3'.format(', '.join(self.zip_members)))
+            self.count('zip_count')
+            self.extract_zip(r, download, file_name)
+            self.journal.update(download['downloadId'], m2m_journal.UPLOADED, file_name)
         elif file_name.endswith('.ZIP') or file_name.endswith('.zip'):
             print('skipping zip file')
-            self.skip_count += 1
-            if self.downloader_count == self.product_count:
-                print('downloader_count: {} --- product_count: {}'.format(self.downloader_count, self.scene_count))
-                self.paginator(self.scene_payload, self.scenes)
+            self.count('skip_count')
+            self.journal.update(download['downloadId'], m2m_journal.SKIPPED, file_name)
         else:
             print('found different file type:', file_name)
-            self.skip_count += 1
+            self.count('skip_count')
+            self.journal.update(download['downloadId'], m2m_journal.SKIPPED, file_name)
+        return None
+
+    # method to fetch one download record's url; runs on a download worker.
+    # a DownloadError once retries run out is recorded by the pool as a failed item
+    def fetch(self, download):
+        # hold back until the file fits in the staging area, before connecting
+        with self.metrics.timer('staging_wait_seconds'):
+            reserved = self.staging.reserve(download.get('filesize')) if self.staging else 0
+        started = time.perf_counter()
+        try:
+            response, retries = self.fetcher.open(download['url'])
+            with response:
+                print('response OK')
+                staged = self.downloader(response, download)
+        except BaseException:
+            self.release(reserved)
+            raise
+        finally:
+            # download, or download and upload when streaming
+            self.metrics.observe('fetch_seconds', time.perf_counter() - started)
+        if staged is None:
+            # streamed or skipped; nothing is left on disk
+            self.release(reserved)
+        else:
+            staged.reserved = reserved
+        return staged
+
+    # method to give staging space back
+    def release(self, reserved):
+        if self.staging is not None:
+            self.staging.release(reserved)
 
-    def download_retrieve(self, count, request):
+    # method to keep the s3 index current with files uploaded during this run
+    def index_upload(self, object_name, size):
+        if self.s3_index is not None and size is not None:
+            self.s3_index.add(object_name, size)
+
+    # method to upload one staged file; runs on an upload worker
+    def stage_upload(self, staged):
+        self.uploader(staged)
+
+    # local path a download is staged at; prefixed with its downloadId so the same file
+    # name arriving twice (e.g. re-queued from the journal) never shares a path
+    def staging_path(self, download, file_name):
+        return '{}{}_{}'.format(self.data_path, download['downloadId'], file_name)
+
+    # method to start a page's download-retrieve loop over submitted, the futures of its
+    # download-request batches; both engines drive the RetrieveLoop with their own calls
+    def retrieve_loop(self, submitted):
+        tracker = ReadinessTracker(self.retrieve_min_wait, self.retrieve_max_wait, timeout=self.retrieve_timeout,
+                                   metrics=self.metrics)
+        return RetrieveLoop(tracker, submitted, self.track_request, self.unavailable)
+
+    # submitted is the futures of the page's download-request batches, picked up as they come back
+    def download_retrieve(self, submitted):
         print('running download_retrieve method')
         # PreparingDownloads has a valid link that can be used but data may not be immediately available
-        # Call the download-retrieve method to get download that is available for immediate download
-        if request['preparingDownloads'] != None and len(request['preparingDownloads']) > 0:
-            payload = {'label': self.label}
-            retrieve = self.send_request(self.service_url + "download-retrieve", payload, self.api_key)
-            # print('retrieve response:', retrieve)
-            download_urls = []
-            sleep_count = 0
-
-            for download in retrieve['available']:
-                # print('adding retrieve[available] url:', download['url'])
-                download_urls.append(download['url'])
-
-            # print("count is: {} VS download_urls length: {}".format(count, len(download_urls)))
-
-            # if didn't get all of the requested downloads, call the download-retrieve method again after 5 seconds
-            while len(download_urls) < count:
-                preparing = count - len(download_urls)
-                sleep_count += 1
-                print(preparing, "downloads are not available. waiting for 10 seconds...\n")
-                available_length = len(retrieve['available'])
-                time.sleep(10)
-                print("Attempting to retrieve data...\n")
-                retrieve = self.send_request(self.service_url + "download-retrieve", payload, self.api_key)
-                # if available_length < len(retrieve['available']):
-                #     print('found some new data available')
-                # go ahead and search retrieve['requested'] for urls not yet added
-                for download in retrieve['available']:
-                    if download['url'] not in download_urls:
-                        download_urls.append(download['url'])
-
-            # print("download_urls COUNT:", len(download_urls))
-            # print("FINAL download_urls LIST:", download_urls)
-
-            count = 0
-            # rerun_list = []
-            # start download, unzip, and upload processes
-            # calls the downloader function above at the start
-            for url in download_urls:
-                count += 1
-                print('{}---{}'.format(count, url))
-                response = requests.get(url, stream=True)
-                if response.ok:
-                    print('response OK')
-                    self.downloader(response)
-                else:
-                    print('response NO good')
-                    # rerun_list.append(url)
+        # Poll download-retrieve and dispatch each download the moment it turns available,
+        # so downloads overlap with usgs staging the rest. availableDownloads are tracked too
+        # and picked up on the next poll, whose records carry the entityId the journal needs
+        loop = self.retrieve_loop(submitted)
+        payload = {'label': self.label}
+        while True:
+            if loop.collect():
+                retrieve = self.send_request(self.service_url + "download-retrieve", payload)
+                for download in loop.ready(retrieve):
+                    self.dispatch(download)
+            if not loop.active():
+                break
+            timeout = loop.wait_time()
+            if loop.waiting:
+                # poll again when the wait is up, or sooner if another batch comes back
+                wait(loop.waiting, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(timeout)
 
-        else:
-            # Get all available downloads
-            for download in request['availableDownloads']:
-                # TODO :: Implement a downloading routine
-                print("DOWNLOAD: " + download['url'])
+        # wait for the whole page to finish before moving on to the next page
+        self.pool.join()
+
+    # method to queue one available download on the worker pool;
+    # blocks while the download stage is full
+    def dispatch(self, download):
+        self.dispatch_count += 1
+        print('{}---{}'.format(self.dispatch_count, download['url']))
+        self.journal.available(download)
+        self.pool.submit(download)
+
+    # method to start tracking the downloads of one download-request response for batch;
+    # returns its availableDownloads
+    def track_request(self, tracker, batch, request):
+        tracker.add(request['availableDownloads'])
+        tracker.add(request['preparingDownloads'])
+        duplicates = request.get('duplicateProducts') or []
+        if duplicates:
+            # already requested (e.g. by a run that died) so no new downloadId comes back, but
+            # download-retrieve still lists them; they are matched there by entityId and
+            # productCode. records that name their entityId rule their product out
+            print('{} products were already requested'.format(len(duplicates)))
+            with self.count_lock:
+                self.duplicate_count += len(duplicates)
+            returned = set(download.get('entityId') for download in
+                           (request['availableDownloads'] or []) + (request['preparingDownloads'] or []))
+            codes = self.journal.product_codes(batch)
+            tracker.expect([(item['entityId'], codes.get((item['entityId'], item['productId'])))
+                            for item in batch if item['entityId'] not in returned], len(duplicates))
+        return request['availableDownloads'] or []
+
+    # method to send one batch of downloads to download-request; runs on a request thread.
+    # returns the batch with its response
+    def request_batch(self, batch):
+        request = self.download_request(batch)
+        self.journal.requested(batch)
+        return batch, request
 
     def download_request(self, downloads):
         print('running download_request method')
-        # Did we find products?
-        if downloads:
-            downloads_count = len(downloads)
-            print('REQUESTED DOWNLOADS COUNT:', downloads_count)
-            payload = {'downloads': downloads, 'label': self.label}
-            # Call the download to get the direct download urls
-            download_request = self.send_request(self.service_url + "download-request", payload, self.api_key)
-
-        # call download_retrieve method
-        self.download_retrieve(downloads_count, download_request)
-
-    def download_options(self, ids):
+        downloads_count = len(downloads)
+        print('REQUESTED DOWNLOADS COUNT:', downloads_count)
+        payload = {'downloads': downloads, 'label': self.label}
+        # Call the download to get the direct download urls
+        return self.send_request(self.service_url + "download-request", payload)
+
+    def download_options(self, ids, page):
         print('running download_options method')
         # Find the download options for these scenes
-        # NOTE :: Remember the scene list cannot exceed 50,000 items!
-        payload = {'datasetName': self.dataset['datasetAlias'], 'entityIds': ids}
-        download_options = self.send_request(self.service_url + "download-options", payload, self.api_key)
+        download_options = self.send_request(self.service_url + "download-options", self.options_payload(ids))
         # print('download options:', download_options)
+        return self.select_downloads(download_options, page)
+
+    # method to turn a download-options response into the {'entityId', 'productId'} downloads
+    # to request, journaling the selected products and skipping finished or existing ones
+    def select_downloads(self, download_options, page):
         # Aggregate a list of available products
         downloads = []
-        for product in download_options:
-            # Make sure the product is available for this scene
-            if product['available'] == True:
-                self.product_count += 1
+        # Make sure the product is available for this scene and one we want
+        products = self.product_selector.select(download_options)
+        with self.count_lock:
+            self.unselected_count += max(len(download_options) - len(products), 0)
+        self.journal.searched(page, products)
+        for product in products:
+            skipped = self.skip_reason(product)
+            if self.planned is not None:
+                self.planned.add(page, product, skipped)
+            if skipped is None:
+                self.count('product_count')
                 downloads.append({'entityId': product['entityId'], 'productId': product['id']})
 
-        print('(line 259) downloads list length --- {}'.format(len(downloads)))
-        print('(line 260) product_count --- {}'.format(self.product_count))
-
-        # call download_request method
-        self.download_request(downloads)
-
-    def paginator(self, payload, scenes):
-        # for pagination; add scenes['nextRecord'] as payload['startingNumber']
-        print('running paginator method')
-        if self.scenes['nextRecord'] and self.page_count > 0:
-            scene_ids = []
-            self.page_count += 1
-            print('self.page_count =', self.page_count)
-            self.starting_num = self.scenes['nextRecord']
-            self.scene_payload = {
-                'datasetName': self.dataset['datasetAlias'],
-                # 'maxResults': 3,
-                'startingNumber': self.starting_num,
-                'sceneFilter': {
-                    'spatialFilter': self.spatial_filter,
-                    'acquisitionFilter': self.temporal_filter
-                    }
-                }
-            print('new starting_num in scene payload:', self.scene_payload)
-            self.scenes = self.send_request(self.service_url + "scene-search", self.scene_payload, self.api_key)
-            for result in self.scenes['results']:
-                scene_ids.append(result['entityId'])
-            for e in scene_ids:
-                self.scene_count += 1
-            # when finished compiling scene ids, print out total number of scenes
-            # to compare with scenes['totalHits']
-            print('{} of {} scene_ids built.\n'.format(self.scene_count, self.total_hits))
-            # call download_options method
-            self.download_options(scene_ids)
+        print('downloads list length --- {}'.format(len(downloads)))
+        return downloads
 
-        else:
-            print('\nNo more pagination!\n')
-            print('TOTAL PRODUCTS:', self.product_count)
-            print('TOTAL SKIPPED PRODUCTS:', self.skip_count)
-            print('TOTAL DOWNLOADED JP2s:', self.jpeg_count)
-            print('TOTAL UPLOADED JP2s:', self.upload_count)
-            self.logout()
+    # method to tell why a selected product won't be transferred: 'finished' by a previous
+    # run, 'exists' in s3 already, or None to transfer it
+    def skip_reason(self, product):
+        # skip products a previous run already finished
+        if self.journal.finished(product['entityId'], product['id']):
+            return 'finished'
+        # skip products already in s3 with the expected size
+        if self.s3_index is not None and self.s3_index.has_product(product['displayId'], product['filesize']):
+            self.count('exists_count')
+            self.journal.mark(product['entityId'], product['id'], m2m_journal.UPLOADED)
+            return 'exists'
+        return None
 
-    def scene_search(self):
+    def scene_search(self, starting_num):
         print('running scene_search method')
+        # Now I need to run a scene search to find data to download
+        print("Searching scenes from {}...\n".format(starting_num))
+        return self.send_request(self.service_url + "scene-search", self.scene_payload(starting_num))
+
+    def scene_payload(self, starting_num):
         # set more or remove filters here; for testing, setting the maxResults filter may be useful
-        print('self.dataset["datasetAlias"]:', self.dataset['datasetAlias'])
-        self.scene_payload = {
+        return {
             'datasetName': self.dataset['datasetAlias'],
             # 'maxResults': 3,
-            'startingNumber': self.starting_num,
+            'startingNumber': starting_num,
             'sceneFilter': {
                 'spatialFilter': self.spatial_filter,
                 'acquisitionFilter': self.temporal_filter
                 }
             }
-        # Now I need to run a scene search to find data to download
-        print("Searching scenes...\n")
-        self.scenes = self.send_request(self.service_url + "scene-search", self.scene_payload, self.api_key)
-        # print('print initial scenes response:', self.scenes)
-        self.total_hits = self.scenes['totalHits']
-        print('scenes request total hits:', self.total_hits, '\n')
 
+    def options_payload(self, ids):
+        # NOTE :: Remember the scene list cannot exceed 50,000 items!
+        return {'datasetName': self.dataset['datasetAlias'], 'entityIds': ids}
+
+    # method to fetch one page of scenes and the download options for them;
+    # runs on the prefetch thread
+    def fetch_page(self, starting_num):
+        scenes = self.scene_search(starting_num)
+        downloads = []
+        scene_ids = self.page_scene_ids(scenes)
+        if scene_ids:
+            downloads = self.download_options(scene_ids, starting_num)
+        # the page's products are in the journal now, so they count towards the planned bytes
+        self.progress.searched(self.total_hits, starting_num - 1 + scenes['recordsReturned'])
+        return scenes, downloads
+
+    # method to count a scene-search page and pick the entityIds to get download options for
+    def page_scene_ids(self, scenes):
+        self.total_hits = scenes['totalHits']
         # Did we find anything?
-        if self.scenes['recordsReturned'] > 0:
-            # add to page_count
-            self.page_count += 1
-            # Aggregate a list of scene ids
-            scene_ids = []
-            for result in self.scenes['results']:
-                # Add scene to list
-                scene_ids.append(result['entityId'])
-
-            for e in scene_ids:
-                self.scene_count += 1
-            # when finished compiling scene ids, print out total number of scenes
-            # to compare with scenes['totalHits']
-            print('{} of {} scene_ids built.\n'.format(self.scene_count, self.total_hits))
-            # call download_options method
-            self.download_options(scene_ids)
-        else:
-            print("Search found no results.\n")
+        if scenes['recordsReturned'] == 0:
+            return []
+        # Aggregate a list of scene ids
+        scene_ids = self.scene_ids(scenes)
+        with self.count_lock:
+            self.scene_count += len(scene_ids)
+        # print out total number of scenes to compare with scenes['totalHits']
+        print('{} of {} scene_ids built.\n'.format(self.scene_count, self.total_hits))
+        return scene_ids
+
+    # method to pick the entityIds to transfer out of a scene-search page
+    def scene_ids(self, scenes):
+        results = scenes['results']
+        if self.shard is not None:
+            owned = [result for result in results if self.shard.owns(result)]
+            with self.count_lock:
+                self.other_shard_count += len(results) - len(owned)
+            results = owned
+        return [result['entityId'] for result in results]
+
+    # generator over scene-search pages using startingNumber/nextRecord; the next page
+    # and its download options are fetched in the background while the caller transfers
+    # the current one, and the stack stays flat however many pages there are
+    def pages(self):
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            starting_num = self.starting_num
+            future = prefetcher.submit(self.fetch_page, starting_num)
+            while future is not None:
+                scenes, downloads = future.result()
+                future = None
+                if scenes['recordsReturned'] == 0:
+                    break
+                next_record = self.next_start(starting_num, scenes)
+                if next_record is not None:
+                    future = prefetcher.submit(self.fetch_page, next_record)
+                yield starting_num, scenes, downloads
+                if future is not None:
+                    starting_num = next_record
+
+    # method to tell the startingNumber of the page after a scene-search page, or None after the last
+    def next_start(self, starting_num, scenes):
+        next_record = scenes['nextRecord']
+        if next_record and next_record > starting_num and next_record <= scenes['totalHits']:
+            return next_record
+        return None
+
+    # method to resume after the last page a previous run finished; moves starting_num there and
+    # returns the downloads that run left in flight before it, to be re-queued first
+    def resume(self):
+        self.starting_num = self.journal.resume_point(self.starting_num)
+        in_flight = self.journal.in_flight(self.starting_num)
+        if in_flight:
+            print('re-queueing {} products left in flight by a previous run'.format(len(in_flight)))
+        return in_flight
+
+    # method to count a page about to be transferred
+    def count_page(self):
+        self.page_count += 1
+        print('self.page_count =', self.page_count)
+
+    # method to request, retrieve, download and upload one page of products
+    def transfer_page(self, downloads):
+        if not downloads:
+            print('no products to download on this page')
+            return
+        # large pages are requested in batches so no single call times out
+        size = self.request_batch_size or len(downloads)
+        batches = [downloads[i:i + size] for i in range(0, len(downloads), size)]
+        with ThreadPoolExecutor(max_workers=self.request_concurrency) as requester:
+            self.download_retrieve([requester.submit(self.request_batch, batch) for batch in batches])
+
+    # method to journal the products of the plan at plan_path and pick the ones still to
+    # transfer; returns (page, downloads) for every page of the plan
+    def plan_downloads(self):
+        plan = TransferPlan.load(self.plan_path)
+        print('transferring {} products ({:.2f} GB) planned {} from {}\n'.format(
+            len(plan.products), plan.size / 1024 ** 3, plan.created, self.plan_path))
+        # products of the plan a previous run left in flight go first, as they do when searching;
+        # re-requested, they come back as duplicateProducts and are picked up by entityId
+        planned = set((product['entityId'], product['productId']) for product in plan.products)
+        in_flight = [download for download in self.journal.in_flight()
+                     if (download['entityId'], download['productId']) in planned]
+        requeued = set((download['entityId'], download['productId']) for download in in_flight)
+        pages = []
+        if in_flight:
+            print('re-queueing {} planned products left in flight by a previous run'.format(len(in_flight)))
+            pages.append((None, in_flight))
+        for page, products in plan.pages():
+            self.journal.searched(page, products)
+            downloads = []
+            for product in products:
+                if (product['entityId'], product['productId']) in requeued:
+                    continue
+                if self.skip_reason(product) is None:
+                    self.count('product_count')
+                    downloads.append({'entityId': product['entityId'], 'productId': product['productId']})
+            pages.append((page, downloads))
+        # every planned product is in the journal now, so the planned bytes are exact
+        self.progress.searched(len(plan.products), len(plan.products))
+        return pages
+
+    def plan(self, path, bandwidth=None):
+        """
+        Dry run: search every page and select products as run() would, and write what would be
+        transferred to a plan file, without calling download-request
+        :param path: plan file to write (json; see m2m_plan.py)
+        :param bandwidth: sustained MB/s to estimate the transfer time at, if any
+        :return: the TransferPlan written
+        """
+        self.login()
+        try:
+            self.index_existing()
+            self.planned = TransferPlan(dataset=self.dataset_name, label=self.label,
+                                        spatial_filter=self.spatial_filter, temporal_filter=self.temporal_filter)
+            if self.dataset_searcher():
+                for starting_num, scenes, downloads in self.pages():
+                    self.page_count += 1
+                self.planned.total_hits = self.total_hits
+                self.planned.scene_count = self.scene_count
+                self.planned.page_count = self.page_count
+            else:
+                print("Search found no results.\n")
+            self.planned.write(path, bandwidth)
+            for line in self.planned.summary(bandwidth):
+                print(line)
+            print('plan written to', path)
+            self.journal.close()
+        finally:
+            self.logout()
+        return self.planned
 
     def dataset_searcher(self):
         print('running dataset_searcher method')
         payload = {'datasetName': self.dataset_name, 'spatialFilter': self.spatial_filter, 'temporalFilter': self.temporal_filter}
 
         print("Searching datasets...\n")
-        datasets = self.send_request(self.service_url + "dataset-search", payload, self.api_key)
+        datasets = self.send_request(self.service_url + "dataset-search", payload)
+        return self.pick_dataset(datasets)
+
+    # method to keep the dataset named dataset_name out of a dataset-search response
+    def pick_dataset(self, datasets):
         if datasets:
             print("Found datasets:", len(datasets))
-        # download datasets
         for dataset in datasets:
-            # skip any other datasets that might be found, logging it in case I want to look into it later
+            # skip any other datasets that might be found
             if dataset['datasetAlias'] == self.dataset_name:
-                # print("Found dataset " + dataset['collectionName'] + " but skipping it.\n")
                 self.dataset = dataset
-                # call scene_search method
-                self.scene_search()
+                return dataset
+        return None
+
+    # print run totals
+    def report(self):
+        print('TOTAL PAGES:', self.page_count)
+        print('TOTAL PRODUCTS:', self.product_count)
+        print('TOTAL UNSELECTED PRODUCTS:', self.unselected_count)
+        print('TOTAL SKIPPED PRODUCTS:', self.skip_count)
+        print('TOTAL DOWNLOADED JP2s:', self.jpeg_count)
+        print('TOTAL UPLOADED JP2s:', self.upload_count)
+        if self.zip_members:
+            print('TOTAL ZIPS EXTRACTED:', self.zip_count)
+            print('TOTAL ZIP MEMBERS UPLOADED:', self.member_count)
+        print('TOTAL ALREADY IN S3:', self.exists_count)
+        if self.shard is not None:
+            print('TOTAL LEFT TO OTHER SHARDS:', self.other_shard_count)
+        failed = self.failed_items()
+        print('TOTAL FAILED TRANSFERS:', len(failed))
+        for item, error in failed:
+            print('    FAILED: {} - {}'.format(item, error))
+        if self.failed_report_path:
+            with open(self.failed_report_path, 'w') as f:
+                json.dump([{'item': item, 'error': str(error)} for item, error in failed], f, indent=2, default=str)
+            print('failed items written to', self.failed_report_path)
+        print('TOTAL NEVER AVAILABLE:', len(self.unavailable))
+        print('TOTAL ALREADY REQUESTED:', self.duplicate_count)
+        print('JOURNAL STATES:', self.journal.summary())
+        print('STAGE METRICS:')
+        for line in self.metrics.summary():
+            print('    ' + line)
+
+    # start writing metrics snapshots and serving prometheus text, whichever are configured
+    def start_metrics(self):
+        self.metrics.gauge('dispatched', lambda: self.dispatch_count)
+        self.metrics.gauge('uploaded', lambda: self.upload_count)
+        self.metrics.gauge('failed', lambda: len(self.failed_items()))
+        self.metrics.gauge('planned_bytes', lambda: self.progress.status.get('planned_bytes'))
+        self.metrics.gauge('done_bytes', lambda: self.progress.status.get('done_bytes'))
+        self.metrics.gauge('eta_seconds', lambda: self.progress.status.get('eta_seconds'))
+        if self.staging is not None:
+            self.metrics.gauge('staging_reserved_bytes', lambda: self.staging.reserved)
+            self.metrics.gauge('staging_waiting', lambda: self.staging.waiting)
+        if self.metrics_path:
+            self.metrics_outputs.append(SnapshotWriter(self.metrics, self.metrics_path, self.metrics_interval))
+        if self.metrics_port is not None:
+            self.metrics_outputs.append(MetricsServer(self.metrics, self.metrics_port))
+        for output in self.metrics_outputs:
+            output.start()
+
+    # stop the metrics outputs; the snapshot file gets one last snapshot
+    def stop_metrics(self):
+        for output in self.metrics_outputs:
+            output.stop()
+        self.metrics_outputs = []
+
+    # (item, error) for every transfer that failed
+    def failed_items(self):
+        return self.pool.failed
+
+    # method to get ready to transfer: index what is in s3 already (skip_existing) and clear what
+    # a previous run left in the staging area. blocks, so the asyncio engine runs it in its executor
+    def prepare(self):
+        self.index_existing()
+        if self.staging is not None:
+            self.staging.clean(self.journal.in_flight_download_ids())
+
+    # method to list what is under s3_key already, when products found there are skipped
+    def index_existing(self):
+        if self.skip_existing:
+            print('indexing existing objects under s3://{}/{}...'.format(self.s3_bucket, self.s3_key))
+            self.s3_index = self.s3.index(self.s3_bucket, self.s3_key)
+            print('found {} existing objects\n'.format(len(self.s3_index)))
+
+    # run the whole transfer: login, find the dataset, transfer each page of scenes, logout
+    def run(self):
+        self.login()
+        # start the download/upload workers used by download_retrieve
+        self.pool = TransferPool(self.fetch, self.stage_upload, self.download_workers, self.upload_workers)
+        self.metrics.gauge('download_queue', self.pool.download_queue.qsize)
+        self.metrics.gauge('upload_queue', self.pool.upload_queue.qsize)
+        self.start_metrics()
+        if self.progress.interval or self.progress.path:
+            self.progress.start()
+        try:
+            self.prepare()
+            if self.plan_path:
+                for page, downloads in self.plan_downloads():
+                    self.count_page()
+                    self.transfer_page(downloads)
+                print('\nPlan transferred!\n')
+            elif self.dataset_searcher():
+                # resume after the last finished page and re-queue anything a previous
+                # run left in flight before it
+                in_flight = self.resume()
+                if in_flight:
+                    self.transfer_page(in_flight)
+                for starting_num, scenes, downloads in self.pages():
+                    self.count_page()
+                    self.transfer_page(downloads)
+                    self.journal.page_done(starting_num, scenes['nextRecord'])
+                print('\nNo more pagination!\n')
+            else:
+                print("Search found no results.\n")
+            self.pool.close()
+            self.s3.shutdown()
+            self.progress.stop()
+            self.report()
+            self.journal.close()
+        finally:
+            self.progress.cancel()
+            self.stop_metrics()
+            self.logout()
 
     def login(self):
         print('running login method')
@@ -364,17 +904,22 @@ class M2MTransfer(object):
         payload = {'username': self.m2m_user, 'password': self.m2m_pass}
         self.api_key = self.send_request(self.service_url + "login", payload)
         print("API Key: " + self.api_key + "\n")
-        # call dataset_searcher
-        self.dataset_searcher()
+        self.session.set_api_key(self.api_key)
 
     def logout(self):
         print('running logout method')
         # Logout so the API Key cannot be used anymore
         endpoint = "logout"
-        if self.send_request(self.service_url + endpoint, None, self.api_key) == None:
-            print("Logged Out\n\n")
-        else:
-            print("Logout Failed\n\n")
+        try:
+            if self.send_request(self.service_url + endpoint, None) == None:
+                print("Logged Out\n\n")
+            else:
+                print("Logout Failed\n\n")
+        except M2MError as e:
+            # don't hide whatever error ended the run
+            print("Logout Failed:", e, "\n\n")
+        self.session.set_api_key(None)
+        self.session.close()
 
 
 if __name__ == "__main__":
@@ -400,11 +945,135 @@ if __name__ == "__main__":
     temporal_filter = {'start': '2020-01-01', 'end': '2021-06-01'}
     # set acquisitionFilter
     acquisition_filter = {'end': '2021-06-01', 'start': '2020-01-01'}
+    # set stream_to_s3 to pipe downloads straight into s3 without staging them in data_path
+    stream_to_s3 = True
+    # set part_size (bytes) for streamed multipart uploads; s3 needs at least 5 MB per part
+    part_size = 8 * 1024 * 1024
+    # set number of concurrent downloads and (when not streaming) concurrent s3 uploads
+    download_workers = 4
+    upload_workers = 2
+    # set http timeouts (seconds) for connecting and for waiting on data
+    connect_timeout = 10
+    read_timeout = 300
+    # set s3 transfer tuning; one client and transfer manager is shared by every upload.
+    # s3_concurrency is the number of part uploads in flight across all files
+    multipart_threshold = 32 * 1024 * 1024
+    multipart_chunksize = 32 * 1024 * 1024
+    s3_concurrency = 10
+    # set download-retrieve polling; waits back off from min to max seconds while
+    # nothing new is available. set retrieve_timeout (seconds) to stop waiting on stuck downloads
+    retrieve_min_wait = 2
+    retrieve_max_wait = 60
+    retrieve_timeout = None
+    # set journal_path to a sqlite file recording every product's progress; rerunning
+    # with the same file resumes the job instead of starting over
+    journal_path = "./texas_naip_2020.db"
+    # set skip_existing to skip products already in s3 (same name and size) under S3_KEY
+    skip_existing = True
+    # set product_selector to choose products before they are requested; D441 is NAIP
+    # Full Resolution (jp2), so the Compressed (D482 zip) products are never requested
+    product_selector = ProductSelector(product_codes=['D441'])
+    # set api rate limiting and retries; api_rate is calls per second across all workers
+    # (None for no limit), failed calls are retried up to max_attempts times with
+    # exponential backoff capped at max_backoff seconds
+    api_rate = 2
+    api_burst = 5
+    max_attempts = 8
+    max_backoff = 300
+    # set download_retries for retries per file (dropped downloads resume from the last byte
+    # received); files that still fail are listed in failed_report_path at the end
+    download_retries = 5
+    failed_report_path = "./failed_downloads.json"
+    # set segments above 1 to fetch each large file as that many byte ranges in parallel
+    # (needs a server that accepts ranges); uses segments x part_size of memory per file when streaming
+    segments = 1
+    # verify_uploads checks each object's size and ETag against checksums taken while it
+    # streamed; tag_checksums also writes its md5/sha256 onto the object as s3 tags
+    verify_uploads = True
+    tag_checksums = False
+    # set zip_members to patterns of zip members to stream to s3 (e.g. ['*.jp2']) when zip
+    # products are selected; only the matching members are read. None skips zips
+    zip_members = None
+    # set staging_budget (bytes) to cap the space staged downloads take in data_path; None uses
+    # what is free at the start less staging_keep_free. staging_tmpfs stages in /dev/shm (memory)
+    staging_budget = None
+    staging_keep_free = 1024 * 1024 * 1024
+    staging_tmpfs = False
+    # set request_batch_size to the downloads sent per download-request call, and
+    # request_concurrency to the calls made at once; downloads start with the first batch back
+    request_batch_size = 500
+    request_concurrency = 2
+    # set use_async to run the asyncio engine (m2m_async.py, needs aiohttp) instead of worker
+    # threads; concurrency is then the number of transfers in flight
+    use_async = False
+    concurrency = 100
+    # bytes read from each download at a time, into one buffer reused for the whole file
+    buffer_size = 1024 * 1024
+    # set metrics_path to a file that gets a json snapshot of per-stage metrics (api latency,
+    # time to ready, MB/s, queue depths, retries) every metrics_interval seconds, and
+    # metrics_port to serve them as prometheus text on http://<host>:<port>/metrics (None for off)
+    metrics_path = "./metrics.jsonl"
+    metrics_interval = 60
+    metrics_port = None
+    # set progress_interval to the seconds between progress lines (products per state, GB done
+    # of planned, MB/s and eta; printed only when something moved), progress_path to also keep
+    # the latest progress in a json file, and progress_window to the seconds the eta's rate covers
+    progress_interval = 60
+    progress_path = "./progress.json"
+    progress_window = 900
+    # set cache_path to a directory that keeps dataset-search, scene-search and download-options
+    # responses for cache_ttl seconds, so reruns and debugging sessions reuse them (None for off);
+    # cache_max_bytes caps its size, removing the least recently used responses first
+    cache_path = "./m2m_cache/"
+    cache_ttl = 7 * 24 * 3600
+    cache_max_bytes = 1024 * 1024 * 1024
+    # set dry_run to only search, select products and write what would be transferred to plan_path
+    # (with totals, the estimated time at plan_bandwidth MB/s and the s3 footprint) without
+    # requesting anything. set use_plan to transfer the products in plan_path instead of
+    # searching; plans can be summarized and split with m2m_plan.py
+    dry_run = False
+    use_plan = False
+    plan_path = "./texas_naip_2020_plan.json"
+    plan_bandwidth = 50
 
     print("\nStarting M2MTransfer script...\n")
     time.sleep(2)
     print("\nLogging in...\n")
 
-    # instantiate and fire login method to begin script
-    transfer = M2MTransfer(service_url, data_path, dataset_name, label, spatial_filter, temporal_filter, acquisition_filter)
-    transfer.login()
+    if use_async and not dry_run:
+        from m2m_async import AsyncM2MTransfer
+        transfer_class, engine_options = AsyncM2MTransfer, {'concurrency': concurrency}
+    else:
+        transfer_class, engine_options = M2MTransfer, {}
+
+    # instantiate and fire run method to begin script
+    transfer = transfer_class(service_url, data_path, dataset_name, label, spatial_filter, temporal_filter, acquisition_filter,
+                           stream_to_s3=stream_to_s3, part_size=part_size,
+                           download_workers=download_workers, upload_workers=upload_workers,
+                           connect_timeout=connect_timeout, read_timeout=read_timeout,
+                           multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize,
+                           s3_concurrency=s3_concurrency,
+                           retrieve_min_wait=retrieve_min_wait, retrieve_max_wait=retrieve_max_wait,
+                           retrieve_timeout=retrieve_timeout, journal_path=journal_path,
+                           skip_existing=skip_existing, product_selector=product_selector,
+                           api_rate=api_rate, api_burst=api_burst, max_attempts=max_attempts, max_backoff=max_backoff,
+                           download_retries=download_retries, failed_report_path=failed_report_path,
+                           segments=segments, verify_uploads=verify_uploads, tag_checksums=tag_checksums,
+                           buffer_size=buffer_size, zip_members=zip_members,
+                           staging_budget=staging_budget, staging_keep_free=staging_keep_free,
+                           staging_tmpfs=staging_tmpfs,
+                           request_batch_size=request_batch_size, request_concurrency=request_concurrency,
+                           metrics_path=metrics_path, metrics_interval=metrics_interval, metrics_port=metrics_port,
+                           progress_interval=progress_interval, progress_path=progress_path,
+                           progress_window=progress_window,
+                           cache_path=cache_path, cache_ttl=cache_ttl, cache_max_bytes=cache_max_bytes,
+                           plan_path=plan_path if use_plan and not dry_run else None,
+                           **engine_options)
+    try:
+        if dry_run:
+            transfer.plan(plan_path, bandwidth=plan_bandwidth)
+        else:
+            transfer.run()
+    except M2MError as e:
+        print('M2M API error:', e)
+        sys.exit(1)
@@ -0,0 +1,123 @@
+# =============================================================================
+#
+# selective zip extraction used by m2m_transfer.py
+#
+# a zip's central directory sits at the end of the file, so with http Range
+# requests the member list can be read without downloading the archive. only
+# members matching the wanted patterns are then read, decompressed and streamed
+# to s3 one at a time; nothing is written to disk and unwanted members (.tif,
+# .xml, ...) are never fetched at all
+#
+# imports======================================================================
+
+import fnmatch
+import io
+import posixpath
+from zipfile import ZipFile
+
+# =============================================================================
+
+class RangeFile(io.RawIOBase):
+    # read-only, seekable file over a url served with Range support. sequential reads
+    # share one streaming response; a seek elsewhere opens a new one from there
+    def __init__(self, fetcher, url, size):
+        """
+        :param fetcher: RangedDownloader to read with (retries and resumes apply)
+        :param url: url of the file
+        :param size: total bytes, e.g. from Content-Length
+        """
+        self.fetcher = fetcher
+        self.url = url
+        self.size = size
+        self.position = 0
+        self.stream = None
+        self.stream_position = 0
+        self.leftover = b''
+        # requests made, for reporting how little of the file was read
+        self.requests = 0
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self.position = offset
+        return self.position
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        if self.position >= self.size or not len(view):
+            return 0
+        if self.stream is None or self.stream_position != self.position:
+            self.open_stream()
+        filled = 0
+        while filled < len(view):
+            if not self.leftover:
+                chunk = next(self.stream, None)
+                if chunk is None:
+                    break
+                # chunks are views of a reused buffer; keep a copy past this read
+                self.leftover = bytes(chunk)
+            take = min(len(view) - filled, len(self.leftover))
+            view[filled:filled + take] = self.leftover[:take]
+            self.leftover = self.leftover[take:]
+            filled += take
+        self.position += filled
+        self.stream_position = self.position
+        self.bytes_read += filled
+        return filled
+
+    def open_stream(self):
+        self.close_stream()
+        self.stream = self.fetcher.chunks(self.url, offset=self.position, end=self.size)
+        self.stream_position = self.position
+        self.requests += 1
+
+    def close_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = None
+        self.leftover = b''
+
+    def close(self):
+        self.close_stream()
+        super(RangeFile, self).close()
+
+
+class ZipMembers(object):
+    def __init__(self, fileobj, patterns):
+        """
+        Members of a zip matching any of patterns, read from its central directory
+        :param fileobj: seekable binary file holding the zip (a RangeFile or a local file)
+        :param patterns: fnmatch patterns matched case-insensitively against member file names, e.g. ['*.jp2']
+        """
+        self.zip = ZipFile(fileobj)
+        self.patterns = [pattern.lower() for pattern in patterns]
+        self.members = [info for info in self.zip.infolist() if self.wanted(info)]
+        self.skipped = len(self.zip.infolist()) - len(self.members)
+
+    def wanted(self, info):
+        name = posixpath.basename(info.filename).lower()
+        return not info.is_dir() and any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns)
+
+    # yield a member's decompressed bytes in chunk_size pieces; the zip's crc is checked
+    # at the end and a mismatch raises BadZipFile
+    def chunks(self, info, chunk_size=1024 * 1024):
+        with self.zip.open(info) as member:
+            for chunk in iter(lambda: member.read(chunk_size), b''):
+                yield chunk
+
+    def close(self):
+        self.zip.close()